@@ -0,0 +1,771 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import atexit
+import contextlib
+import functools
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+
+from gilt import util
+
+# The mode of a submodule in a tree.
+S_IFGITLINK = 0160000
+# The refspecs a mirror fetches from its origin.  Only branches and tags are
+# mirrored, leaving out other refs, such as pull requests and notes.
+MIRROR_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+# The seconds a git command reaching a remote may run by default, before it
+# is killed, so a connection which hangs can not stall gilt.
+NETWORK_TIMEOUT = 30 * 60
+
+_network_timeout = NETWORK_TIMEOUT
+# What dulwich reads of a repository once and keeps, relative to it.
+_DULWICH_CACHED = ('config', 'packed-refs', os.path.join('objects', 'pack'))
+
+
+class BackendError(Exception):
+    """ Error raised when a backend can not be used. """
+    pass
+
+
+class CliBackend(object):
+    """
+    Run each git operation as a ``git`` command.  Supports every repository
+    git itself does, including partial clones.
+    """
+
+    def clone(self,
+              repository,
+              destination,
+              depth=None,
+              filter=None,
+              single_branch=False,
+              reference=None,
+              debug=False):
+        """
+        Clone the specified repository as a bare mirror and return None.  See
+        `git.clone`.
+        """
+        cmd = ['git', 'clone', '--bare', repository, destination]
+        if reference:
+            cmd.append('--reference={}'.format(reference))
+        if depth:
+            cmd.append('--depth={}'.format(depth))
+        if filter:
+            cmd.append('--filter={}'.format(filter))
+        if single_branch:
+            cmd.append('--single-branch')
+        util.run_command(cmd, timeout=get_network_timeout(), debug=debug)
+
+        refspecs = MIRROR_REFSPECS
+        if single_branch:
+            # Only the branch cloned is fetched later, along with the tags
+            # pointing into it.
+            cmd = ['git', '-C', destination, 'symbolic-ref', 'HEAD']
+            ref = util.run_command(cmd, debug=debug).stdout.strip()
+            refspecs = ['+{0}:{0}'.format(ref)]
+        set_fetch_refspecs(destination, refspecs, debug=debug)
+
+    def fetch(self,
+              repository,
+              refspecs=None,
+              depth=None,
+              tags=True,
+              debug=False):
+        """
+        Update the refs of the specified mirror from its origin and return
+        None.  See `git.fetch`.
+
+        :param repository: A string containing the path to the repository.
+        :param refspecs: An optional list of strings containing the refspecs
+         to fetch.  Default is the refspecs configured for the origin.
+        :param depth: An optional int to fetch only the given number of
+         commits of history.
+        :param tags: An optional bool to also fetch the tags pointing into
+         the history fetched.  Default is True.
+        :param debug: An optional bool to toggle debug output.
+        :return: None
+        """
+        cmd = ['git', '-C', repository, 'fetch']
+        if depth:
+            cmd.append('--depth={}'.format(depth))
+        if not tags:
+            cmd.append('--no-tags')
+        if refspecs:
+            cmd.extend(['origin'] + list(refspecs))
+        util.run_command(cmd, timeout=get_network_timeout(), debug=debug)
+
+    def ls_remote(self, repository, refs, debug=False):
+        """
+        Ask the origin of the specified mirror for the given refs, in one
+        round trip, and return a list of (sha, ref) tuples for those found.
+        See `git.ls_remote`.
+        """
+        if not refs:
+            return []
+        cmd = ['git', '-C', repository, 'ls-remote', 'origin'] + list(refs)
+        result = util.run_command(
+            cmd, timeout=get_network_timeout(), debug=debug)
+        lines = result.stdout.splitlines()
+
+        return [tuple(line.split('\t', 1)) for line in lines if line]
+
+    def batch_check(self, repository, names, debug=False):
+        """
+        Look up the given object names and return a list of (sha, type)
+        tuples, one per name, which are (None, None) for missing objects.
+
+        :param repository: A string containing the path to the repository.
+        :param names: A list of strings containing object names.
+        :param debug: An optional bool to toggle debug output.
+        :return: list
+        """
+        if not names:
+            return []
+        stdin = ''.join('{}\n'.format(name) for name in names)
+        cmd = ['git', '-C', repository, 'cat-file', '--batch-check']
+        result = util.run_command(cmd, input=stdin, debug=debug)
+        lines = result.stdout.splitlines()
+
+        result = []
+        for line in lines:
+            fields = line.split()
+            if fields[1] in ('missing', 'ambiguous'):
+                result.append((None, None))
+            else:
+                result.append((fields[0], fields[1]))
+
+        return result
+
+    @contextlib.contextmanager
+    def read_tree(self, repository, treeish, debug=False):
+        """
+        Context manager which reads the given tree into a temporary index,
+        and yields an object to list and checkout its paths.
+
+        :param repository: A string containing the path to the repository.
+        :param treeish: A string containing the name of the tree to read.
+        :param debug: An optional bool to toggle debug output.
+        """
+        index_dir = tempfile.mkdtemp()
+        try:
+            env = dict(
+                os.environ, GIT_INDEX_FILE=os.path.join(index_dir, 'index'))
+            git = ['git', '--git-dir={}'.format(repository)]
+            util.run_command(
+                git + ['read-tree', treeish], env=env, debug=debug)
+            yield _CliTree(git, env, debug)
+        finally:
+            shutil.rmtree(index_dir)
+
+    def ls_tree(self, repository, treeish, debug=False):
+        """
+        List every entry beneath the given tree, including trees, and return
+        a list of (mode, sha, path) tuples, where the mode is an int.
+
+        :param repository: A string containing the path to the repository.
+        :param treeish: A string containing the name of the tree to list.
+        :param debug: An optional bool to toggle debug output.
+        :return: list
+        """
+        cmd = [
+            'git', '--git-dir={}'.format(repository), 'ls-tree', '-r', '-t',
+            '-z', treeish
+        ]
+        result = []
+
+        def add(line):
+            info, path = line.split('\t', 1)
+            mode, _, sha = info.split()
+            result.append((int(mode, 8), sha, path))
+
+        util.run_command(
+            cmd, output=util.split_records(add, '\0'), debug=debug)
+
+        return result
+
+    @contextlib.contextmanager
+    def open_objects(self, repository, debug=False):
+        """
+        Context manager which yields an object to read the blobs of the
+        repository with, and may be shared by threads.
+
+        :param repository: A string containing the path to the repository.
+        :param debug: An optional bool to toggle debug output.
+        """
+        objects = _CliObjects(repository, debug)
+        try:
+            yield objects
+        finally:
+            objects.close()
+
+    def diff_tree(self, repository, old, new, pathspecs=(), debug=False):
+        """
+        Compare two trees and return a list of (status, path) tuples, where
+        the status is 'A', 'D' or 'M', for each file which differs.
+
+        :param repository: A string containing the path to the repository.
+        :param old: A string containing the name of the old tree.
+        :param new: A string containing the name of the new tree.
+        :param pathspecs: An optional list of strings containing git
+         pathspecs to limit the comparison to.
+        :param debug: An optional bool to toggle debug output.
+        :return: list
+        """
+        cmd = [
+            'git', '--git-dir={}'.format(repository), 'diff-tree', '-r', '-z',
+            '--no-renames', '--name-status', old, new, '--'
+        ] + list(pathspecs)
+        fields = util.run_command(cmd, debug=debug).stdout.split('\0')
+
+        return zip(fields[0::2], fields[1::2])
+
+    def close(self):
+        """
+        Release whatever the backend holds open, and return None.  Called
+        when the backend is replaced, and on exit.
+        """
+        pass
+
+
+class _CliTree(object):
+    """ A tree read into a temporary index by `CliBackend.read_tree`. """
+
+    def __init__(self, git, env, debug=False):
+        self._git = git
+        self._env = env
+        self._debug = debug
+
+    def ls_files(self, pathspecs=()):
+        """
+        List the paths in the tree matching the given pathspecs and return a
+        list.  Lists every path by default.
+        """
+        cmd = self._git + ['ls-files', '-z', '--'] + list(pathspecs)
+        paths = []
+        util.run_command(
+            cmd,
+            env=self._env,
+            output=util.split_records(paths.append, '\0'),
+            debug=self._debug)
+
+        return paths
+
+    def checkout(self, destination, paths=None):
+        """
+        Write the given paths of the tree into the directory, replacing
+        whatever is there, and return None.  Writes every path by default.
+        """
+        cmd = self._git + [
+            '--work-tree={}'.format(destination), 'checkout-index', '--force'
+        ]
+        stdin = None
+        if paths is None:
+            cmd.append('--all')
+        else:
+            stdin = ''.join('{}\0'.format(p) for p in paths)
+            cmd.extend(['-z', '--stdin'])
+        util.run_command(cmd, input=stdin, env=self._env, debug=self._debug)
+
+
+class _CliObjects(object):
+    """
+    Reads blobs with ``git cat-file --batch`` processes, each serving one
+    thread, which are started when the thread first reads a blob.
+    """
+
+    def __init__(self, repository, debug=False):
+        self._cmd = [
+            'git', '--git-dir={}'.format(repository), 'cat-file', '--batch'
+        ]
+        self._debug = debug
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._procs = []
+
+    def read(self, sha):
+        """ Return the contents of the given blob as a str. """
+        chunks = []
+        self._read(sha, chunks.append)
+
+        return ''.join(chunks)
+
+    def copy(self, sha, f):
+        """ Write the contents of the given blob to a file and return None. """
+        self._read(sha, f.write)
+
+    def close(self):
+        """ Stop every process started and return None. """
+        with self._lock:
+            procs, self._procs = self._procs, []
+        for proc in procs:
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+
+    def _read(self, sha, write):
+        proc = getattr(self._local, 'proc', None)
+        if proc is None:
+            proc = util.start_command(self._cmd, debug=self._debug)
+            self._local.proc = proc
+            with self._lock:
+                self._procs.append(proc)
+
+        try:
+            proc.stdin.write('{}\n'.format(sha))
+            proc.stdin.flush()
+            header = proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != 'blob':
+                raise BackendError('Unable to read blob {}'.format(sha))
+            remaining = int(header[2])
+            while remaining:
+                data = proc.stdout.read(min(remaining, util._READ_SIZE))
+                if not data:
+                    raise BackendError('Unable to read blob {}'.format(sha))
+                write(data)
+                remaining -= len(data)
+            proc.stdout.read(1)
+        except Exception:
+            # Whatever is left of the reply would be taken for the next, so
+            # the process can serve no more requests.
+            self._local.proc = None
+            if proc.poll() is None:
+                proc.kill()
+            raise
+
+
+class DulwichBackend(CliBackend):
+    """
+    Resolve names, and read and compare trees, within the gilt process with
+    dulwich, instead of running a command each time.
+
+    Cloning and fetching still run ``git``, as do names the backend can not
+    resolve itself, such as abbreviated commit ids, and every operation on a
+    partial clone, whose objects git fetches on demand.
+    """
+
+    def __init__(self):
+        try:
+            import dulwich.diff_tree
+            import dulwich.repo
+        except ImportError:
+            raise BackendError('The dulwich backend requires dulwich.')
+        self._diff_tree = dulwich.diff_tree
+        self._repo = dulwich.repo
+        # Each repository opened, by path, with the fingerprint of what it
+        # was opened from.  Repositories replaced are closed with the rest.
+        self._repos = {}
+        self._replaced = []
+        self._repos_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def close(self):
+        with self._repos_lock:
+            repos = [repo for _, repo in self._repos.values()] + self._replaced
+            self._repos = {}
+            self._replaced = []
+        for repo in repos:
+            if repo is not None:
+                repo.close()
+
+    def batch_check(self, repository, names, debug=False):
+        repo = self._open(repository)
+        if repo is None:
+            return super(DulwichBackend, self).batch_check(repository, names,
+                                                           debug)
+
+        result = []
+        unresolved = []
+        for i, name in enumerate(names):
+            try:
+                obj = self._lookup(repo, name)
+            except _Unsupported:
+                unresolved.append(i)
+                obj = None
+            result.append((obj.id, obj.type_name) if obj else (None, None))
+        if unresolved:
+            lines = super(DulwichBackend, self).batch_check(
+                repository, [names[i] for i in unresolved], debug)
+            for i, line in zip(unresolved, lines):
+                result[i] = line
+
+        return result
+
+    @contextlib.contextmanager
+    def read_tree(self, repository, treeish, debug=False):
+        store, tree = self._get_tree(repository, treeish)
+        if tree is None:
+            with super(DulwichBackend, self).read_tree(repository, treeish,
+                                                       debug) as t:
+                yield t
+            return
+
+        if debug:
+            util.print_warn('  READ TREE: {}'.format(treeish))
+        yield _DulwichTree(store, tree.id)
+
+    def ls_tree(self, repository, treeish, debug=False):
+        store, tree = self._get_tree(repository, treeish)
+        if tree is None:
+            return super(DulwichBackend, self).ls_tree(repository, treeish,
+                                                       debug)
+
+        if debug:
+            util.print_warn('  LIST TREE: {}'.format(treeish))
+        return [(e.mode, e.sha, e.path)
+                for e in store.iter_tree_contents(
+                    tree.id, include_trees=True) if e.path]
+
+    @contextlib.contextmanager
+    def open_objects(self, repository, debug=False):
+        repo = self._open(repository)
+        if repo is None:
+            with super(DulwichBackend, self).open_objects(repository,
+                                                          debug) as objects:
+                yield objects
+            return
+
+        yield _DulwichObjects(repo.object_store)
+
+    def diff_tree(self, repository, old, new, pathspecs=(), debug=False):
+        repo = self._open(repository)
+        trees = None
+        if repo is not None:
+            try:
+                trees = [self._lookup(repo, name) for name in (old, new)]
+            except _Unsupported:
+                pass
+        if not trees or not all(t and t.type_name == 'tree' for t in trees):
+            return super(DulwichBackend, self).diff_tree(repository, old, new,
+                                                         pathspecs, debug)
+
+        if debug:
+            util.print_warn('  DIFF TREE: {} {}'.format(old, new))
+        matcher = _get_pathspec_matcher(pathspecs)
+        changes = []
+        for change in self._diff_tree.tree_changes(repo.object_store,
+                                                   trees[0].id, trees[1].id):
+            if change.type == self._diff_tree.CHANGE_DELETE:
+                status, path = 'D', change.old.path
+            elif change.type == self._diff_tree.CHANGE_ADD:
+                status, path = 'A', change.new.path
+            else:
+                status, path = 'M', change.new.path
+            if matcher(path):
+                changes.append((status, path))
+
+        return changes
+
+    def _get_tree(self, repository, treeish):
+        """
+        Look up the given tree and return a tuple of the object store and
+        the tree, which is None when only git can read it.
+        """
+        repo = self._open(repository)
+        if repo is None:
+            return None, None
+        try:
+            tree = self._lookup(repo, treeish)
+        except _Unsupported:
+            return repo.object_store, None
+        if tree is None or tree.type_name != 'tree':
+            return repo.object_store, None
+
+        return repo.object_store, tree
+
+    def _open(self, repository):
+        """
+        Return the `dulwich.repo.Repo` of the given repository, or None when
+        it is a partial clone, which only git can read.
+
+        Each repository is opened once, and again only when git rewrote its
+        packed refs, packs or config, which dulwich reads once and keeps.
+        """
+        repository = os.path.abspath(repository)
+        stamp = util.fingerprint(
+            [os.path.join(repository, name) for name in _DULWICH_CACHED])
+        with self._repos_lock:
+            cached = self._repos.get(repository)
+            if cached and cached[0] == stamp:
+                return cached[1]
+            if cached:
+                # Another thread may still be reading it.
+                self._replaced.append(cached[1])
+
+            repo = self._repo.Repo(repository)
+            try:
+                repo.get_config().get(('extensions', ), 'partialclone')
+            except KeyError:
+                pass
+            else:
+                repo.close()
+                repo = None
+            self._repos[repository] = (stamp, repo)
+
+        return repo
+
+    def _lookup(self, repo, name):
+        """
+        Resolve an object name of one of the forms gilt uses, such as
+        ``v1^{commit}``, ``refs/heads/master`` or ``<sha>:path``, and return
+        the object, or None when it is missing.  Raises `_Unsupported` when
+        only git can resolve the name.
+        """
+        store = repo.object_store
+        if ':' in name:
+            rev, path = name.split(':', 1)
+            obj = _peel(store, self._lookup_rev(repo, rev), 'tree')
+            if obj is None or not path:
+                return obj
+            try:
+                mode, sha = obj.lookup_path(store.__getitem__, path)
+                return store[sha]
+            except KeyError:
+                return None
+
+        match = re.match(r'(.*)\^\{(\w*)\}$', name)
+        if match:
+            rev, type_name = match.groups()
+            return _peel(store, self._lookup_rev(repo, rev), type_name)
+
+        return self._lookup_rev(repo, name)
+
+    def _lookup_rev(self, repo, rev):
+        """ Resolve a ref name or full commit id and return the object. """
+        store = repo.object_store
+        if re.match(r'[0-9a-f]{40}$', rev):
+            return store[rev] if rev in store else None
+        for ref in [
+                rev, 'refs/{}'.format(rev), 'refs/tags/{}'.format(rev),
+                'refs/heads/{}'.format(rev), 'refs/remotes/{}'.format(rev),
+                'refs/remotes/{}/HEAD'.format(rev)
+        ]:
+            try:
+                return store[repo.refs[ref]]
+            except KeyError:
+                continue
+        if re.match(r'[0-9a-f]{4,39}$', rev):
+            raise _Unsupported(rev)
+
+        return None
+
+
+class _Unsupported(Exception):
+    """ Raised when a name can only be resolved by git. """
+    pass
+
+
+class _DulwichTree(object):
+    """ A tree read by `DulwichBackend.read_tree`. """
+
+    def __init__(self, store, tree_id):
+        self._store = store
+        self._entries = list(store.iter_tree_contents(tree_id))
+
+    def ls_files(self, pathspecs=()):
+        """ See `_CliTree.ls_files`. """
+        matcher = _get_pathspec_matcher(pathspecs)
+
+        return [e.path for e in self._entries if matcher(e.path)]
+
+    def checkout(self, destination, paths=None):
+        """ See `_CliTree.checkout`. """
+        entries = self._entries
+        if paths is not None:
+            paths = set(paths)
+            entries = [e for e in entries if e.path in paths]
+        objects = _DulwichObjects(self._store)
+        for entry in entries:
+            path = os.path.join(destination, entry.path)
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            write_entry(objects, path, entry.mode, entry.sha)
+
+
+class _DulwichObjects(object):
+    """ Reads blobs from a dulwich object store. """
+
+    def __init__(self, store):
+        self._store = store
+        # Pack files are read through shared file objects.
+        self._lock = threading.Lock()
+
+    def read(self, sha):
+        """ See `_CliObjects.read`. """
+        return ''.join(self._get_chunks(sha))
+
+    def copy(self, sha, f):
+        """ See `_CliObjects.copy`. """
+        for chunk in self._get_chunks(sha):
+            f.write(chunk)
+
+    def _get_chunks(self, sha):
+        with self._lock:
+            try:
+                return self._store[sha].as_raw_chunks()
+            except KeyError:
+                raise BackendError('Unable to read blob {}'.format(sha))
+
+
+def _peel(store, obj, type_name):
+    """
+    Follow the given object through tags, and from a commit to its tree,
+    until it has the given type, and return it, or None when it can not.  An
+    empty type only follows tags.
+    """
+    while obj is not None and obj.type_name != type_name:
+        if obj.type_name == 'tag':
+            obj = store[obj.object[1]]
+        elif obj.type_name == 'commit' and type_name == 'tree':
+            obj = store[obj.tree]
+        elif not type_name:
+            break
+        else:
+            return None
+
+    return obj
+
+
+def set_fetch_refspecs(repository, refspecs, debug=False):
+    """
+    Replace the refspecs the specified repository fetches from its origin,
+    and return None.
+
+    :param repository: A string containing the path to the repository.
+    :param refspecs: A list of strings containing the refspecs.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    git = ['git', '-C', repository, 'config']
+    cmd = git + ['--replace-all', 'remote.origin.fetch', refspecs[0]]
+    util.run_command(cmd, debug=debug)
+    for refspec in refspecs[1:]:
+        cmd = git + ['--add', 'remote.origin.fetch', refspec]
+        util.run_command(cmd, debug=debug)
+
+
+def write_entry(objects, path, mode, sha):
+    """
+    Write a tree entry to the given path as ``git checkout-index`` would,
+    replacing any file there, and return None.
+
+    :param objects: An object to read blobs with, as yielded by the
+     ``open_objects`` method of a backend.
+    :param path: A string containing the path to write.
+    :param mode: An int containing the mode of the entry.
+    :param sha: A string containing the id of the object of the entry.
+    :return: None
+    """
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+
+    if stat.S_ISLNK(mode):
+        os.symlink(objects.read(sha), path)
+    elif stat.S_IFMT(mode) == S_IFGITLINK:
+        # Submodules are checked out as empty directories.
+        if not os.path.isdir(path):
+            os.mkdir(path)
+    else:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0777
+                     if mode & 0100 else 0666)
+        with os.fdopen(fd, 'wb') as f:
+            objects.copy(sha, f)
+
+
+def _get_pathspec_matcher(pathspecs):
+    """
+    Return a callable, which is given a path and returns a bool indicating
+    whether it matches the given git pathspecs.  Supports the `literal`,
+    `glob` and `exclude` magic gilt uses.
+
+    :param pathspecs: A list of strings containing git pathspecs.
+    :return: callable
+    """
+    includes = []
+    excludes = []
+    for pathspec in pathspecs:
+        magic = set()
+        pattern = pathspec
+        match = re.match(r':\(([^)]*)\)(.*)$', pathspec)
+        if match:
+            magic = set(match.group(1).split(','))
+            pattern = match.group(2)
+        if 'glob' in magic and util.is_glob(pattern):
+            # Like git, a pattern must match the whole path, while a plain
+            # path also matches everything beneath it.
+            matcher = util.get_pattern_matcher([pattern], parents=False)
+        else:
+            matcher = functools.partial(_is_beneath, pattern)
+        if 'exclude' in magic:
+            excludes.append(matcher)
+        else:
+            includes.append(matcher)
+
+    def matcher(path):
+        if includes and not any(m(path) for m in includes):
+            return False
+        return not any(m(path) for m in excludes)
+
+    return matcher
+
+
+def _is_beneath(prefix, path):
+    """ Return a bool indicating whether the path is, or is in, prefix. """
+    return path == prefix or path.startswith(prefix.rstrip('/') + '/')
+
+
+BACKENDS = {
+    'cli': CliBackend,
+    'dulwich': DulwichBackend,
+}
+
+
+def set_network_timeout(seconds):
+    """
+    Set the seconds a git command reaching a remote may run before it is
+    killed, and return None.
+
+    :param seconds: An int containing the timeout, or None for no timeout.
+    :return: None
+    """
+    global _network_timeout
+    _network_timeout = seconds
+
+
+def get_network_timeout():
+    """ Return the seconds a git command reaching a remote may run. """
+    return _network_timeout
+
+
+def get_backend(name):
+    """
+    Create the named backend and return it.
+
+    :param name: A string containing one of `BACKENDS`.
+    :return: object
+    """
+    return BACKENDS[name]()
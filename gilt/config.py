@@ -22,11 +22,16 @@
 
 import collections
 import errno
+import hashlib
+import json
 import os
+import re
 
 import giturlparse
 import yaml
 
+from gilt import util
+
 
 class ParseError(Exception):
     """ Error raised when a config can't be loaded properly. """
@@ -43,27 +48,27 @@ def config(filename):
     :parse filename: A string containing the path to YAML file.
     :return: list
     """
-    Config = collections.namedtuple(
-        'Config',
-        ['git', 'lock_file', 'version', 'name', 'src', 'dst', 'files'])
+    Config = collections.namedtuple('Config', [
+        'git', 'lock_file', 'fetch_file', 'version', 'name', 'src', 'pool',
+        'pool_lock_file', 'dst', 'files', 'depth', 'filter', 'single_branch',
+        'copy_strategy', 'path', 'include', 'exclude', 'checksum', 'state_file'
+    ])
 
     return [Config(**d) for d in _get_config_generator(filename)]
 
 
-def _get_files_config(src_dir, files_list):
+def _get_files_config(files_list):
     """
     Construct `FileConfig` object and return a list.
 
-    :param src_dir: A string containing the source directory.
     :param files_list: A list of dicts containing the src/dst mapping of files
      to overlay.
     :return: list
     """
-    FilesConfig = collections.namedtuple('FilesConfig', ['src', 'dst'])
+    FilesConfig = collections.namedtuple('FilesConfig',
+                                         ['src', 'dst', 'exclude'])
 
-    return [
-        FilesConfig(**d) for d in _get_files_generator(src_dir, files_list)
-    ]
+    return [FilesConfig(**d) for d in _get_files_generator(files_list)]
 
 
 def _get_config_generator(filename):
@@ -82,22 +87,132 @@ def _get_config_generator(filename):
         dst_dir = None
         if not files:
             dst_dir = _get_dst_dir(d['dst'])
+        files_config = _get_files_config(files)
+        copy_strategy = d.get('copy_strategy')
+        if copy_strategy not in (None, ) + util.COPY_STRATEGIES:
+            msg = 'Invalid copy_strategy {} for {}'.format(copy_strategy, repo)
+            raise ParseError(msg)
+        object_pool = d.get('object_pool')
+        if object_pool is not None:
+            object_pool = str(object_pool)
+            if object_pool in ('.', '..') or not re.match(r'[\w.-]+$',
+                                                          object_pool):
+                msg = 'Invalid object_pool {} for {}'.format(object_pool, repo)
+                raise ParseError(msg)
+        extract_filters = {
+            'path': d.get('path'),
+            'include': d.get('include', []),
+            'exclude': d.get('exclude', []),
+        }
+        checksum = _get_checksum(repo, d['version'], dst_dir, files_config,
+                                 extract_filters, copy_strategy)
+        # An extract keeps its state when its version changes, so the next
+        # run can update the destination in place.  Extracts of different
+        # repositories into the same destination each keep their own.
+        state_file = _get_state_file('{}\0{}'.format(dst_dir, repo)
+                                     if dst_dir else checksum)
         yield {
             'git': repo,
             'lock_file': _get_lock_file(name),
+            'fetch_file': _get_fetch_file(name),
             'version': d['version'],
             'name': name,
             'src': src_dir,
+            'pool': _get_pool(object_pool) if object_pool else None,
+            'pool_lock_file': _get_pool_lock_file(object_pool)
+            if object_pool else None,
             'dst': dst_dir,
-            'files': _get_files_config(src_dir, files)
+            'files': files_config,
+            'depth': d.get('depth'),
+            'filter': d.get('filter'),
+            'single_branch': d.get('single_branch'),
+            'copy_strategy': copy_strategy,
+            'path': extract_filters['path'],
+            'include': extract_filters['include'],
+            'exclude': extract_filters['exclude'],
+            'checksum': checksum,
+            'state_file': state_file,
         }
 
 
-def _get_files_generator(src_dir, files_list):
+def get_lockfile(filename):
     """
-    A generator which populates and return a dict.
+    Return the path of the lockfile of the given config file, which has the
+    same name with a `.lock` extension, as a str.
+
+    :param filename: A string containing the path to the YAML file.
+    :return: str
+    """
+    return '{}.lock'.format(os.path.splitext(filename)[0])
+
+
+def read_lockfile(filename):
+    """
+    Load the given lockfile and return a dict mapping each repository to a
+    dict of its versions and the commit ids they are locked to.  Returns an
+    empty dict when there is no lockfile.
+
+    :param filename: A string containing the path to the lockfile.
+    :return: dict
+    """
+    if not os.path.exists(filename):
+        return {}
+    pins = util.read_json(filename)
+    if not isinstance(pins, dict):
+        msg = 'Error parsing gilt lockfile: {}'.format(filename)
+        raise ParseError(msg)
+
+    return pins
+
+
+def write_lockfile(filename, pins):
+    """
+    Atomically replace the given lockfile with the given commits and return
+    None.
+
+    :param filename: A string containing the path to the lockfile.
+    :param pins: A dict mapping each repository to a dict of its versions
+     and the commit ids they are locked to.
+    :return: None
+    """
+    util.write_json(filename, pins, indent=2)
+
+
+def _get_checksum(repo,
+                  version,
+                  dst_dir,
+                  files_config,
+                  filters=None,
+                  copy_strategy=None):
+    """
+    Return a str identifying what the given entry writes, which changes
+    whenever the entry is edited.
+
+    :param repo: A string containing the repository of the entry.
+    :param version: A string containing the branch/tag/sha of the entry.
+    :param dst_dir: A string containing the destination of the entry.
+    :param files_config: A list of `FilesConfig` objects.
+    :param filters: An optional dict containing the subtree path, include and
+     exclude filters of an extract.
+    :param copy_strategy: An optional string containing how files are copied.
+    :return: str
+    """
+    data = [repo, str(version), dst_dir, files_config]
+    if filters and any(filters.values()):
+        data.append(filters)
+    if copy_strategy:
+        data.append(copy_strategy)
+    data = json.dumps(data, sort_keys=True)
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def _get_files_generator(files_list):
+    """
+    A generator which populates and return a dict.  The `src` of each file,
+    and its optional list of `exclude` patterns, are relative to the root of
+    the repository.
 
-    :param src_dir: A string containing the source directory.
     :param files_list: A list of dicts containing the src/dst mapping of files
      to overlay.
     :return: dict
@@ -105,8 +220,9 @@ def _get_files_generator(src_dir, files_list):
     if files_list:
         for d in files_list:
             yield {
-                'src': os.path.join(src_dir, d['src']),
-                'dst': _get_dst_dir(d['dst'])
+                'src': d['src'],
+                'dst': _get_dst_dir(d['dst']),
+                'exclude': d.get('exclude', []),
             }
 
 
@@ -146,6 +262,41 @@ def _get_lock_file(name):
         name, )
 
 
+def _get_fetch_file(name):
+    """
+    Return the file recording when the versions of the given repository were
+    last fetched, which sits next to its lock file.
+    """
+    return os.path.join(
+        _get_lock_dir(),
+        '{}.fetched'.format(name), )
+
+
+def _get_pool(name):
+    """
+    Return the repository storing the objects shared by the repositories of
+    the given object pool.
+    """
+    return os.path.join(
+        _get_pool_dir(),
+        name, )
+
+
+def _get_pool_lock_file(name):
+    """ Return the lock file for the given object pool. """
+    return os.path.join(
+        _get_lock_dir(),
+        'pool',
+        name, )
+
+
+def _get_state_file(key):
+    """ Return the file recording what was last written for the given key. """
+    return os.path.join(
+        _get_state_dir(),
+        hashlib.sha1(key).hexdigest(), )
+
+
 def _get_base_dir():
     """ Return gilt's base working directory. """
     return os.path.expanduser(BASE_WORKING_DIR)
@@ -162,6 +313,17 @@ def _get_lock_dir():
         'lock', )
 
 
+def _get_state_dir():
+    """
+    Construct gilt's state directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(
+        _get_base_dir(),
+        'state', )
+
+
 def _get_clone_dir():
     """
     Construct gilt's clone directory and return a str.
@@ -173,6 +335,17 @@ def _get_clone_dir():
         'clone', )
 
 
+def _get_pool_dir():
+    """
+    Construct gilt's object pool directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(
+        _get_base_dir(),
+        'pool', )
+
+
 def _makedirs(path):
     """
     Create a base directory of the provided path and return None.
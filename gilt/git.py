@@ -20,109 +20,1418 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
-import glob
+import collections
+import functools
 import os
 import re
 import shutil
+import stat
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
-import sh
-
+from gilt import backends
+from gilt import config
 from gilt import util
 
+# Holds a worktree of each commit materialized, whose modification time is
+# when it was last used.
+WORKTREE_DIR = 'gilt-worktree'
+REF_TYPES_FILE = 'gilt-ref-types.json'
+# Touched in a mirror whenever gilt uses it, to evict the least recently
+# used first.
+USED_FILE = 'gilt-used'
+# The order in which a version is looked up when its type is not yet known,
+# which matches the order git itself resolves an ambiguous name.
+REF_TYPES = ('tag', 'branch', 'commit')
+# Copy strategies which extract through the worktree of a commit, so every
+# destination shares the files in the cache.
+CACHED_COPY_STRATEGIES = ('reflink', 'hardlink')
+# The filters of an extract writing the whole repository.
+NO_FILTERS = {'subtree': None, 'include': [], 'exclude': []}
+
+# The refs keeping commits not on any branch or tag in a bundle.
+BUNDLE_REFS = 'refs/gilt/bundle'
+# The environment of git commands which must not reach any remote: every
+# transport is disallowed, and partial clones do not fetch missing objects.
+OFFLINE_ENV = {'GIT_ALLOW_PROTOCOL': '', 'GIT_NO_LAZY_FETCH': '1'}
+
+_backend = backends.CliBackend()
+
+
+class NotFoundError(Exception):
+    """ Error raised when a version can not be found in a repository. """
+    pass
+
 
-def clone(name, repository, destination, debug=False):
+def set_backend(name):
     """
-    Clone the specified repository into a temporary directory and return None.
+    Select the backend running git operations and return None.
+
+    :param name: A string containing one of `backends.BACKENDS`.
+    :return: None
+    """
+    global _backend
+    _backend.close()
+    _backend = backends.get_backend(name)
+
+
+def set_offline():
+    """
+    Keep every git command run from now on from reaching a remote, and
+    return None.
+
+    :return: None
+    """
+    os.environ.update(OFFLINE_ENV)
+
+
+def clone(name,
+          repository,
+          destination,
+          depth=None,
+          filter=None,
+          single_branch=False,
+          reference=None,
+          debug=False):
+    """
+    Clone the specified repository as a bare mirror and return None.
 
     :param name: A string containing the name of the repository being cloned.
     :param repository: A string containing the repository to clone.
     :param destination: A string containing the directory to clone the
      repository into.
+    :param depth: An optional int to truncate the history to the given number
+     of commits.
+    :param filter: An optional string containing a partial clone filter spec,
+     such as `blob:none` or `tree:0`.  Missing objects are fetched on demand.
+    :param single_branch: An optional bool to only clone the history of the
+     remote's default branch.
+    :param reference: An optional string containing the path to a repository,
+     such as an object pool, to borrow objects from, so only objects it
+     lacks are transferred.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    msg = '  - cloning {} to {}'.format(name, destination)
+    util.print_info(msg)
+    _backend.clone(
+        repository,
+        destination,
+        depth=depth,
+        filter=filter,
+        single_branch=single_branch,
+        reference=reference,
+        debug=debug)
+
+
+def convert(name, destination, debug=False):
+    """
+    Convert a clone with a working tree, as made by earlier versions of gilt,
+    into a bare mirror in place and return None.
+
+    :param name: A string containing the name of the repository.
+    :param destination: A string containing the directory of the clone.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    msg = '  - converting {} to a mirror'.format(name)
+    util.print_info(msg)
+    tmp_dir = '{}.tmp'.format(destination)
+    os.rename(os.path.join(destination, '.git'), tmp_dir)
+    shutil.rmtree(destination)
+    os.rename(tmp_dir, destination)
+
+    cmd = ['git', '-C', destination, 'config', 'core.bare', 'true']
+    util.run_command(cmd, debug=debug)
+    backends.set_fetch_refspecs(
+        destination, backends.MIRROR_REFSPECS, debug=debug)
+
+
+def fetch(repository, versions=None, depth=None, debug=False):
+    """
+    Update the refs of the specified mirror from its origin and return None.
+
+    Given versions, only they are fetched, in one round trip.  A branch or
+    tag is fetched by its own refspec once its type is known, a full commit
+    id by itself, where the origin allows it, and any other version by name,
+    which the origin resolves.  Other tags are never fetched along.  When
+    the origin can not provide the versions this way, every ref is fetched.
+
+    :param repository: A string containing the path to the repository.
+    :param versions: An optional list of strings containing branches/tags/
+     shas to fetch.  Others refs are left untouched.  Fetches all refs by
+     default.
+    :param depth: An optional int to fetch only the given number of commits
+     of history.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if versions:
+        refspecs = _get_refspecs(repository, versions)
+        try:
+            _backend.fetch(
+                repository,
+                refspecs=refspecs,
+                depth=depth,
+                tags=False,
+                debug=debug)
+            return
+        except util.CommandTimeout:
+            raise
+        except util.CommandError as e:
+            if debug:
+                msg = '  - unable to fetch {}: {}'.format(' '.join(refspecs),
+                                                          e)
+                util.print_warn(msg)
+
+    _backend.fetch(repository, depth=depth, debug=debug)
+
+
+def ls_remote(repository, versions, debug=False):
+    """
+    Ask the origin of the specified mirror which commits the given branches
+    point to upstream, with a single ``git ls-remote``, and return a dict
+    mapping each version asked for to its commit id, or None when the branch
+    is gone upstream.
+
+    Only versions cached as branches by `get_ref_types` are asked for, as
+    tags are not updated once resolved, and commit ids never move.  Without
+    any, the origin is not asked at all.
+
+    :param repository: A string containing the path to the repository.
+    :param versions: A list of strings containing branches/tags/shas.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    ref_types = _read_ref_types(repository)
+    branches = [str(v) for v in versions if ref_types.get(str(v)) == 'branch']
+    if not branches:
+        return {}
+
+    refs = [_get_ref_name(v, 'branch') for v in branches]
+    commits = dict((ref, sha)
+                   for sha, ref in _backend.ls_remote(repository, refs, debug))
+
+    return dict((v, commits.get(ref)) for v, ref in zip(branches, refs))
+
+
+def fetch_objects(repository, commits, debug=False):
+    """
+    Fetch the objects of the given commits which a partial clone lacks, and
+    return None.
+
+    Missing objects are asked for all at once, without the filter of the
+    clone, rather than one at a time as git would on reading them.
+
+    :param repository: A string containing the path to the repository.
+    :param commits: A list of strings containing commit ids.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if not _is_partial_clone(repository):
+        return
+
+    missing = _list_missing_objects(repository, commits, debug)
+    if not missing:
+        return
+
+    cmd = [
+        'git', '-C', repository, '-c', 'fetch.negotiationAlgorithm=noop',
+        'fetch', '--no-filter', '--no-tags', '--no-write-fetch-head',
+        '--recurse-submodules=no', '--stdin', 'origin'
+    ]
+    stdin = ''.join('{}\n'.format(sha) for sha in missing)
+    util.run_command(
+        cmd, input=stdin, timeout=backends.get_network_timeout(), debug=debug)
+
+    missing = _list_missing_objects(repository, commits, debug)
+    if missing:
+        msg = 'Unable to fetch {} objects, such as {}'.format(
+            len(missing), missing[0])
+        raise NotFoundError(msg)
+
+
+def list_missing_objects(repository, commits, debug=False):
+    """
+    Return a list of the ids of the objects in the trees of the given commits
+    which the specified partial clone lacks.  Other clones lack none.
+
+    :param repository: A string containing the path to the repository.
+    :param commits: A list of strings containing commit ids.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    if not _is_partial_clone(repository):
+        return []
+
+    return _list_missing_objects(repository, commits, debug)
+
+
+def count_objects(repository, debug=False):
+    """
+    Count the objects stored in the specified repository, and return a dict
+    of their number and the bytes they take on disk, which are both 0 when
+    the repository does not exist.
+
+    :param repository: A string containing the path to the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    if not os.path.exists(repository):
+        return {'objects': 0, 'bytes': 0}
+
+    cmd = ['git', '-C', repository, 'count-objects', '-v']
+    result = util.run_command(cmd, debug=debug)
+    counts = dict(
+        line.split(': ', 1) for line in result.stdout.splitlines() if line)
+
+    # Sizes are given in KiB.
+    return {
+        'objects': int(counts['count']) + int(counts['in-pack']),
+        'bytes': (int(counts['size']) + int(counts['size-pack'])) * 1024,
+    }
+
+
+def create_bundle(repository, filename, versions, commits=(), debug=False):
+    """
+    Write the history of the given versions of the specified repository to a
+    bundle and return None.
+
+    Branches and tags are bundled under their own refs.  Commit ids, and any
+    other commits given, are bundled under refs in `BUNDLE_REFS`, which are
+    only made in the repository while the bundle is written.
+
+    :param repository: A string containing the path to the repository.
+    :param filename: A string containing the path of the bundle to write.
+    :param versions: A list of strings containing branches/tags/shas.
+    :param commits: An optional list of strings containing commit ids to
+     bundle along with the versions.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    ref_types = get_ref_types(repository, versions, debug=debug)
+    refs = []
+    shas = list(commits)
+    for version in versions:
+        ref_type = ref_types[version]
+        if ref_type == 'branch':
+            refs.append('refs/heads/{}'.format(version))
+        elif ref_type == 'tag':
+            refs.append('refs/tags/{}'.format(version))
+        elif ref_type == 'commit':
+            shas.extend(resolve(repository, [version], debug=debug).values())
+        else:
+            msg = 'Unable to find {} in {}'.format(version, repository)
+            raise NotFoundError(msg)
+    shas = sorted(set(shas))
+    bundle_refs = ['{}/{}'.format(BUNDLE_REFS, sha) for sha in shas]
+
+    git = ['git', '-C', repository]
+    stdin = ''.join('update {} {}\n'.format(ref, sha)
+                    for ref, sha in zip(bundle_refs, shas))
+    util.run_command(git + ['update-ref', '--stdin'], input=stdin, debug=debug)
+    try:
+        cmd = git + ['bundle', 'create', filename] + refs + bundle_refs
+        util.run_command(cmd, debug=debug)
+    finally:
+        stdin = ''.join('delete {}\n'.format(ref) for ref in bundle_refs)
+        util.run_command(
+            git + ['update-ref', '--stdin'], input=stdin, debug=debug)
+
+
+def clone_bundle(name, filename, destination, repository, debug=False):
+    """
+    Clone the specified bundle as a bare mirror of the given repository, so
+    later fetches reach its origin, and return None.
+
+    :param name: A string containing the name of the repository being cloned.
+    :param filename: A string containing the path of the bundle.
+    :param destination: A string containing the directory to clone the
+     bundle into.
+    :param repository: A string containing the repository the bundle was
+     made from.
     :param debug: An optional bool to toggle debug output.
     :return: None
     """
     msg = '  - cloning {} to {}'.format(name, destination)
     util.print_info(msg)
-    cmd = sh.git.bake('clone', repository, destination)
+    util.run_command(
+        ['git', 'init', '--quiet', '--bare', destination], debug=debug)
+    # The refs in `BUNDLE_REFS` keep the commits bundled by id.
+    refspecs = backends.MIRROR_REFSPECS + ['+{0}/*:{0}/*'.format(BUNDLE_REFS)]
+    git = ['git', '-C', destination]
+    cmd = git + ['fetch', '--quiet', os.path.abspath(filename)] + refspecs
     util.run_command(cmd, debug=debug)
+    cmd = git + ['config', 'remote.origin.url', repository]
+    util.run_command(cmd, debug=debug)
+    backends.set_fetch_refspecs(
+        destination, backends.MIRROR_REFSPECS, debug=debug)
+
+
+def is_complete(repository):
+    """
+    Return a bool indicating whether the repository holds the whole history
+    of what it has, rather than being a shallow or partial clone.
+
+    :param repository: A string containing the path to the repository.
+    :return: bool
+    """
+    shallow = os.path.exists(os.path.join(repository, 'shallow'))
+
+    return not shallow and not _is_partial_clone(repository)
+
+
+def init_pool(pool, debug=False):
+    """
+    Create the specified object pool, a bare repository holding the objects
+    of the repositories sharing it, unless it exists, and return None.
+
+    :param pool: A string containing the path to the object pool.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if os.path.exists(pool):
+        return
+
+    util.run_command(['git', 'init', '--quiet', '--bare', pool], debug=debug)
+
+
+def share_objects(repository, pool, name, debug=False):
+    """
+    Move the objects of the specified mirror into the given object pool, and
+    return None.  The mirror borrows them back through its alternates, so
+    each object is stored once, however many forks share it.
+
+    The refs of the mirror are kept in the pool under `refs/forks/<name>`,
+    so the objects they reach are never pruned from it.
+
+    :param repository: A string containing the path to the repository.
+    :param pool: A string containing the path to the object pool.
+    :param name: A string containing the name of the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    # Objects are kept packed in the pool, as only packed objects of an
+    # alternate let the mirror drop its own copies.
+    refspec = '+refs/*:refs/forks/{}/*'.format(name)
+    cmd = [
+        'git', '-C', pool, '-c', 'fetch.unpackLimit=1', 'fetch', '--quiet',
+        '--no-tags', '--prune', os.path.abspath(repository), refspec
+    ]
+    util.run_command(cmd, debug=debug)
+
+    if not is_pooled(repository, pool):
+        filename = os.path.join(repository, 'objects', 'info', 'alternates')
+        config._makedirs(filename)
+        with open(filename, 'a') as f:
+            f.write('{}\n'.format(_get_pool_objects(pool)))
+    # Objects the pool now has are dropped from the mirror.
+    git = ['git', '-C', repository]
+    util.run_command(git + ['repack', '-a', '-d', '-l', '-q'], debug=debug)
+    util.run_command(git + ['prune-packed', '-q'], debug=debug)
+
+
+def remove_fork(pool, name, debug=False):
+    """
+    Remove the refs the given object pool keeps for the named mirror, so the
+    objects only it reached may be pruned, and return None.  See
+    `share_objects`.
+
+    :param pool: A string containing the path to the object pool.
+    :param name: A string containing the name of the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    cmd = [
+        'git', '-C', pool, 'for-each-ref', '--format=delete %(refname)',
+        'refs/forks/{}/'.format(name)
+    ]
+    result = util.run_command(cmd, debug=debug)
+    if result.stdout:
+        cmd = ['git', '-C', pool, 'update-ref', '--stdin']
+        util.run_command(cmd, input=result.stdout, debug=debug)
+
+
+def prune_pool(pool, debug=False):
+    """
+    Repack the given object pool, dropping every object no fork refers to
+    right away, and return None.  Callers must ensure no repository borrows
+    objects of the pool it has no ref in the pool for.
+
+    :param pool: A string containing the path to the object pool.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    cmd = ['git', '-C', pool, 'gc', '--quiet', '--prune=now']
+    util.run_command(cmd, debug=debug)
+
+
+def is_pooled(repository, pool):
+    """
+    Return a bool indicating whether the specified repository borrows the
+    objects of the given object pool.
+
+    :param repository: A string containing the path to the repository.
+    :param pool: A string containing the path to the object pool.
+    :return: bool
+    """
+    filename = os.path.join(repository, 'objects', 'info', 'alternates')
+    try:
+        with open(filename) as f:
+            alternates = [line.strip() for line in f]
+    except IOError:
+        return False
+
+    return _get_pool_objects(pool) in alternates
+
+
+def mark_used(repository):
+    """
+    Record that the specified repository was used now, and return None.
+
+    :param repository: A string containing the path to the repository.
+    :return: None
+    """
+    filename = os.path.join(repository, USED_FILE)
+    with open(filename, 'a'):
+        os.utime(filename, None)
+
+
+def get_last_used(repository):
+    """
+    Return the time the specified repository was last used as a float.  A
+    repository never marked used was last used when it last changed.
+
+    :param repository: A string containing the path to the repository.
+    :return: float
+    """
+    try:
+        return os.path.getmtime(os.path.join(repository, USED_FILE))
+    except OSError:
+        return os.path.getmtime(repository)
+
+
+def prune_worktrees(repository, max_age):
+    """
+    Remove the worktrees of the specified repository not used within the
+    given number of seconds, along with any temporary directory left beside
+    them, and return a list of their names.  See `_materialize`.
+
+    :param repository: A string containing the path to the repository.
+    :param max_age: A number of seconds a worktree is kept after its last
+     use.
+    :return: list
+    """
+    dirname = os.path.join(repository, WORKTREE_DIR)
+    if not os.path.isdir(dirname):
+        return []
+
+    now = time.time()
+    removed = []
+    for name in sorted(os.listdir(dirname)):
+        path = os.path.join(dirname, name)
+        if now - os.path.getmtime(path) < max_age:
+            continue
+        shutil.rmtree(path)
+        removed.append(name)
+
+    return removed
+
+
+def maintain(repository, prune=True, debug=False):
+    """
+    Repack the specified repository, prune what is unreachable, and write its
+    commit-graph and multi-pack-index, so later fetches and reads are fast,
+    and return None.
+
+    :param repository: A string containing the path to the repository.
+    :param prune: An optional bool to prune unreachable objects.  An object
+     pool is not, as clones may borrow objects its refs no longer reach.  See
+     `prune_pool`.  Default is True.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    git = ['git', '-C', repository]
+    cmd = git + ['gc', '--quiet']
+    if not prune:
+        cmd = git + [
+            '-c', 'gc.pruneExpire=never', 'gc', '--quiet', '--prune=never'
+        ]
+    util.run_command(cmd, debug=debug)
+    cmd = git + ['commit-graph', 'write', '--reachable', '--no-progress']
+    util.run_command(cmd, debug=debug)
+    # A fork sharing an object pool may have no packs of its own.
+    pack_dir = os.path.join(repository, 'objects', 'pack')
+    if any(name.endswith('.pack') for name in os.listdir(pack_dir)):
+        cmd = git + ['multi-pack-index', 'write', '--no-progress']
+        util.run_command(cmd, debug=debug)
+
+
+def get_ref_types(repository, versions, debug=False):
+    """
+    Resolve the type of each of the given versions against the local
+    repository, and return a dict mapping each version to 'branch', 'tag',
+    'commit' or None when it is not present locally.
+
+    Resolved types are cached in the repository, so later runs only confirm
+    a version is still present.  All versions are looked up by a single
+    ``git cat-file --batch-check``, so no network access is required.
+
+    :param repository: A string containing the path to the repository.
+    :param versions: A list of strings containing branches/tags/shas.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    cached = _read_ref_types(repository)
+    ref_types = dict(cached)
+    queries = []
+    for version in versions:
+        ref_type = ref_types.get(str(version))
+        if ref_type:
+            queries.append((version, ref_type))
+        else:
+            queries.extend((version, t) for t in REF_TYPES)
+    names = [_get_ref_name(*q) for q in queries]
+    objects = _batch_check(repository, names, debug)
+
+    result = dict((version, None) for version in versions)
+    for (version, ref_type), (sha, object_type) in zip(queries, objects):
+        if result[version] or object_type not in ('commit', 'tag'):
+            continue
+        if ref_type == 'commit' and not sha.startswith(str(version)):
+            continue
+        result[version] = ref_type
+        ref_types[str(version)] = ref_type
+    if ref_types != cached:
+        _write_ref_types(repository, ref_types)
+
+    return result
 
 
-def extract(repository, destination, version, debug=False):
+def resolve(repository, versions, debug=False):
+    """
+    Resolve each of the given versions to a commit id, with a single
+    ``git cat-file --batch-check``, and return a dict mapping each version
+    found to its commit id.
+
+    :param repository: A string containing the path to the repository.
+    :param versions: A list of strings containing branches/tags/shas.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    names = ['{}^{{commit}}'.format(version) for version in versions]
+    objects = _batch_check(repository, names, debug)
+
+    return dict((version, sha)
+                for version, (sha, object_type) in zip(versions, objects)
+                if object_type == 'commit')
+
+
+def extract(repository,
+            destination,
+            version,
+            commit=None,
+            state_file=None,
+            strategy='auto',
+            subtree=None,
+            include=(),
+            exclude=(),
+            force=False,
+            debug=False):
     """
     Extract the specified repository/version into the given directory and
     return None.
 
+    When a state file is given, the commit extracted is recorded in it, and
+    the next extract into the same directory only writes and deletes the
+    paths which differ between the two commits.  Every path is written again
+    when the filters or the copy strategy change, or when forced.
+
     :param repository: A string containing the path to the repository to be
      extracted.
     :param destination: A string containing the directory to clone the
      repository into.  Relative to the directory ``gilt`` is running
      in. Must end with a '/'.
     :param version: A string containing the branch/tag/sha to be exported.
+    :param commit: An optional string containing the commit id the version
+     is already resolved to.
+    :param state_file: An optional string containing the path to the file
+     recording what was last extracted into the destination.
+    :param strategy: An optional string containing one of
+     `util.COPY_STRATEGIES`.  With `reflink` or `hardlink`, files are
+     materialized in the worktree of the commit and copied from there.
+     Default is `auto`, which writes files straight from the repository.
+    :param subtree: An optional string containing the directory of the
+     repository to extract, instead of its root.
+    :param include: An optional list of strings containing globs of the paths
+     to extract, relative to the subtree.  Extracts every path by default.
+    :param exclude: An optional list of strings containing globs of paths to
+     leave out, relative to the subtree.
+    :param force: An optional bool to write every path again, such as when
+     the destination was modified.  Paths extracted before, which the commit
+     leaves out, are still deleted.  Default is False.
     :param debug: An optional bool to toggle debug output.
     :return: None
     """
-    with util.saved_cwd():
-        os.chdir(repository)
-        _get_branch(version, debug)
-        cmd = sh.git.bake(
-            'checkout-index', force=True, all=True, prefix=destination)
-        util.run_command(cmd, debug=debug)
-        msg = '  - extracting ({}) {} to {}'.format(version, repository,
-                                                    destination)
+    commit = commit or _get_commit(repository, version, debug)
+    filters = {
+        'subtree': subtree.strip('/') if subtree else None,
+        'include': list(include),
+        'exclude': list(exclude),
+    }
+    previous = None
+    previous_filters = filters
+    previous_strategy = strategy
+    if state_file and os.path.isdir(destination):
+        state = util.read_json(state_file) or {}
+        if state.get('repository') == repository:
+            previous = state.get('commit')
+            previous_filters = state.get('filters', NO_FILTERS)
+            previous_strategy = state.get('strategy')
+    unchanged = (not force and previous_filters == filters and
+                 previous_strategy == strategy)
+
+    if previous == commit and unchanged:
+        msg = '  - skipping ({}) {} is up to date'.format(version, destination)
         util.print_info(msg)
+        return
+
+    if previous and not _is_tree(
+            repository,
+            _get_treeish(previous, previous_filters['subtree']), debug):
+        previous = None
+    if previous and unchanged:
+        _checkout_changes(
+            repository,
+            destination,
+            previous,
+            commit,
+            strategy=strategy,
+            filters=filters,
+            debug=debug)
+    else:
+        paths = None
+        if previous:
+            # Remove whatever was extracted before, which the new commit and
+            # filters leave out.
+            old_paths = _list_paths(repository, previous, previous_filters,
+                                    debug)
+            paths = _list_paths(repository, commit, filters, debug)
+            for path in set(old_paths) - set(paths):
+                _remove(destination, path)
+        _checkout(
+            repository,
+            destination,
+            commit,
+            paths,
+            strategy=strategy,
+            filters=filters,
+            debug=debug)
+    if state_file:
+        state = {
+            'repository': repository,
+            'commit': commit,
+            'filters': filters,
+            'strategy': strategy,
+        }
+        util.write_json(state_file, state)
+    msg = '  - extracting ({}) {} to {}'.format(version, repository,
+                                                destination)
+    util.print_info(msg)
 
 
-def overlay(repository, files, version, debug=False):
+def overlay(repository,
+            files,
+            version,
+            commit=None,
+            strategy='auto',
+            jobs=1,
+            debug=False):
     """
     Overlay files from the specified repository/version into the given
-    directory and return None.
+    directory and return a list of the paths written.
+
+    Each file and glob match is copied by one of a pool of threads.  Copies
+    whose destinations overlap are made by the same thread, in the order of
+    the given files, so a later copy still overwrites an earlier one.
 
     :param repository: A string containing the path to the repository to be
      extracted.
     :param files: A list of `FileConfig` objects.
     :param version: A string containing the branch/tag/sha to be exported.
+    :param commit: An optional string containing the commit id the version
+     is already resolved to.
+    :param strategy: An optional string containing one of
+     `util.COPY_STRATEGIES`.  With `reflink` or `hardlink`, files are
+     materialized in the worktree of the commit and copied from there.
+     Default is `auto`, which writes files straight from the repository.
+    :param jobs: An optional int containing the number of threads to copy
+     with.  Default is 1.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: list
+    """
+    commit = commit or _get_commit(repository, version, debug)
+    if strategy in CACHED_COPY_STRATEGIES or _is_partial_clone(repository):
+        # Entries with exclude patterns are listed on their own, so they do
+        # not exclude anything from other entries.
+        pathspecs = [[
+            p for fc in files if not fc.exclude for p in _get_pathspecs(fc.src)
+        ]]
+        pathspecs.extend(
+            _get_pathspecs(fc.src, fc.exclude) for fc in files if fc.exclude)
+        pathspecs = [p for p in pathspecs if p]
+        worktree = _get_worktree(repository, commit, pathspecs, debug)
+        source = _WorktreeFiles(worktree, strategy)
+        return _overlay_files(source, files, version, jobs)
+
+    with _backend.open_objects(repository, debug) as objects:
+        entries = _backend.ls_tree(repository, _get_treeish(commit), debug)
+        source = _TreeFiles(entries, objects)
+        return _overlay_files(source, files, version, jobs)
+
+
+def _overlay_files(source, files, version, jobs=1):
     """
-    with util.saved_cwd():
-        os.chdir(repository)
-        _get_branch(version, debug)
+    Copy the given files from the source and return a list of the paths
+    written.  See `overlay`.
+
+    :param source: A `_WorktreeFiles` or `_TreeFiles` object.
+    :param files: A list of `FileConfig` objects.
+    :param version: A string containing the branch/tag/sha being copied.
+    :param jobs: An optional int containing the number of threads to copy
+     with.  Default is 1.
+    :return: list
+    """
+    copies = []
+    options = []
+    for fc in files:
+        excluded = util.get_pattern_matcher(fc.exclude)
+        ignore = excluded if fc.exclude else None
+        if util.is_glob(fc.src):
+            for path in source.glob(fc.src, fc.exclude):
+                copies.append((path, fc.dst))
+                options.append((False, ignore))
+        elif not excluded(fc.src):
+            # A directory replaces the directory at its destination.
+            copies.append((os.path.normpath(fc.src), fc.dst))
+            options.append((True, ignore))
+
+    def copy_lane(lane):
+        written = []
+        for i in lane:
+            src, dst = copies[i]
+            replace, ignore = options[i]
+            if replace and os.path.isdir(dst) and source.isdir(src):
+                shutil.rmtree(dst)
+            source.copy(src, dst, ignore)
+            written.append((i, _get_copy_destination(src, dst, source.isdir)))
+        return written
+
+    lanes = _get_copy_lanes(copies, source.isdir)
+    if jobs > 1 and len(lanes) > 1:
+        pool = ThreadPool(min(jobs, len(lanes)))
+        try:
+            results = pool.map(copy_lane, lanes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [copy_lane(lane) for lane in lanes]
 
-        for fc in files:
-            if '*' in fc.src:
-                for filename in glob.glob(fc.src):
-                    util.copy(filename, fc.dst)
-                    msg = '  - copied ({}) {} to {}'.format(version, filename,
-                                                            fc.dst)
-                    util.print_info(msg)
+    for src, dst in copies:
+        msg = '  - copied ({}) {} to {}'.format(version, src, dst)
+        util.print_info(msg)
+
+    return [path for i, path in sorted(w for r in results for w in r)]
+
+
+class _WorktreeFiles(object):
+    """ The files of a commit, as materialized in its worktree. """
+
+    def __init__(self, worktree, strategy='auto'):
+        self._worktree = worktree
+        self._strategy = strategy
+
+    def glob(self, pattern, exclude=()):
+        """ Return a sorted list of the paths matching the pattern. """
+        return [
+            os.path.relpath(path, self._worktree)
+            for path in util.iglob(self._worktree, pattern, exclude)
+        ]
+
+    def isdir(self, path):
+        """ Return a bool indicating whether the path is a directory. """
+        return os.path.isdir(os.path.join(self._worktree, path))
+
+    def copy(self, path, dst, ignore=None):
+        """
+        Copy the path to the destination like `util.copy`, leaving out the
+        paths beneath it the given callable returns True for, and return
+        None.
+        """
+        if ignore is not None:
+            ignore = functools.partial(_is_excluded, self._worktree, ignore)
+        util.copy(
+            os.path.join(self._worktree, path), dst, self._strategy, ignore)
+
+
+class _TreeFiles(object):
+    """
+    The files of a commit, as listed by its tree, which are written straight
+    from the objects of the repository.  See `_WorktreeFiles`.
+    """
+
+    def __init__(self, entries, objects):
+        self._objects = objects
+        self._entries = {'': (stat.S_IFDIR, None)}
+        self._children = collections.defaultdict(list)
+        for mode, sha, path in entries:
+            self._entries[path] = (mode, sha)
+            dirname, name = os.path.split(path)
+            self._children[dirname].append((name, stat.S_ISDIR(mode)))
+        for children in self._children.values():
+            children.sort()
+
+    def glob(self, pattern, exclude=()):
+        return list(util.iglob('', pattern, exclude, listdir=self._list_dir))
+
+    def isdir(self, path):
+        entry = self._entries.get(_normalize_path(path))
+        return entry is not None and stat.S_ISDIR(entry[0])
+
+    def copy(self, path, dst, ignore=None):
+        path = _normalize_path(path)
+        entry = self._entries.get(path)
+        if entry is None:
+            raise NotFoundError('Unable to find {}'.format(path))
+        mode, sha = entry
+        if stat.S_ISDIR(mode):
+            self._copy_tree(path, dst, ignore)
+            return
+
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(path))
+        backends.write_entry(self._objects, dst, mode, sha)
+
+    def _copy_tree(self, path, dst, ignore=None):
+        os.makedirs(dst)
+        for name, is_dir in self._children[path]:
+            src = os.path.join(path, name)
+            if ignore is not None and ignore(src):
+                continue
+            if is_dir:
+                self._copy_tree(src, os.path.join(dst, name), ignore)
             else:
-                if os.path.isdir(fc.dst) and os.path.isdir(fc.src):
-                    shutil.rmtree(fc.dst)
-                util.copy(fc.src, fc.dst)
-                msg = '  - copied ({}) {} to {}'.format(version, fc.src,
-                                                        fc.dst)
-                util.print_info(msg)
+                mode, sha = self._entries[src]
+                backends.write_entry(self._objects,
+                                     os.path.join(dst, name), mode, sha)
+
+    def _list_dir(self, path):
+        return self._children.get(_normalize_path(path), [])
+
+
+def _normalize_path(path):
+    """ Return a path within a tree in the form it is listed as a str. """
+    path = os.path.normpath(path)
+
+    return '' if path == '.' else path
 
 
-def _get_branch(version, debug=False):
+def _is_excluded(worktree, excluded, path):
+    """ Return a bool indicating whether the worktree path is excluded. """
+    return excluded(os.path.relpath(path, worktree))
+
+
+def _is_partial_clone(repository):
+    """
+    Return a bool indicating whether the repository is a partial clone,
+    which git would fetch missing objects of one at a time.  Packs fetched
+    from the remote of a partial clone are marked by a `.promisor` file.
     """
-    Handle switching to the specified version and return None.
+    pack_dir = os.path.join(repository, 'objects', 'pack')
+    try:
+        return any(name.endswith('.promisor') for name in os.listdir(pack_dir))
+    except OSError:
+        return False
 
-    1. Fetch the origin.
-    2. Checkout the specified version.
-    3. Clean the repository before we begin.
-    4. Pull the origin when a branch; _not_ a commit id.
 
-    :param version: A string containing the branch/tag/sha to be exported.
+def _get_copy_lanes(copies, isdir=os.path.isdir):
+    """
+    Split the given copies into lanes, so that copies whose destinations
+    overlap share a lane, and return a list of lists of indexes into the
+    copies.
+
+    A destination overlaps another when they are the same path, or one is
+    beneath the other.  Copies keep their relative order within a lane, and
+    lanes are ordered by their first copy.
+
+    :param copies: A list of (src, dst) tuples of strings, in the order they
+     must be made.
+    :param isdir: An optional callable returning whether a source is a
+     directory.  Default is `os.path.isdir`.
+    :return: list
+    """
+    parents = range(len(copies))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        parents[max(i, j)] = min(i, j)
+
+    # The first copy to each destination, and the copies to anywhere beneath
+    # a path.  Once a copy to a path joins the copies beneath it, it stands
+    # in for all of them.
+    exact = {}
+    beneath = {}
+    for i, (src, dst) in enumerate(copies):
+        path = os.path.normpath(_get_copy_destination(src, dst, isdir))
+        for j in beneath.pop(path, []):
+            union(i, j)
+        ancestor = path
+        while True:
+            if ancestor in exact:
+                union(i, exact[ancestor])
+            beneath.setdefault(ancestor, []).append(i)
+            parent = os.path.dirname(ancestor)
+            if parent == ancestor:
+                break
+            ancestor = parent
+        exact.setdefault(path, i)
+
+    lanes = collections.OrderedDict()
+    for i in range(len(copies)):
+        lanes.setdefault(find(i), []).append(i)
+
+    return lanes.values()
+
+
+def _get_copy_destination(src, dst, isdir=os.path.isdir):
+    """ Return the path `util.copy` wrote the given source to as a str. """
+    if os.path.isdir(dst) and not isdir(src):
+        return os.path.join(dst, os.path.basename(src))
+
+    return dst
+
+
+def _get_commit(repository, version, debug=False):
+    """
+    Resolve the specified version to a commit id and return a str.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch/tag/sha to be resolved.
+    :param debug: An optional bool to toggle debug output.
+    :return: str
+    """
+    commits = resolve(repository, [version], debug)
+    if version not in commits:
+        msg = 'Unable to find {} in {}'.format(version, repository)
+        raise NotFoundError(msg)
+
+    return commits[version]
+
+
+def _get_pool_objects(pool):
+    """ Return the object directory of the given pool as a str. """
+    return os.path.join(os.path.abspath(pool), 'objects')
+
+
+def _list_missing_objects(repository, commits, debug=False):
+    """
+    Return a list of the ids of the objects in the trees of the given commits
+    which the specified repository lacks, without fetching any of them.  The
+    history of the commits is not walked, as materializing them never reads
+    it.
+    """
+    cmd = [
+        'git', '-C', repository, 'rev-list', '--objects', '--no-walk',
+        '--missing=print'
+    ]
+    missing = []
+
+    def add(line):
+        if line.startswith('?'):
+            missing.append(line[1:])
+
+    util.run_command(
+        cmd + list(commits), output=util.split_records(add), debug=debug)
+
+    return missing
+
+
+def _get_ref_name(version, ref_type):
+    """ Return the name to look up a version of the given type as a str. """
+    if ref_type == 'branch':
+        return 'refs/heads/{}'.format(version)
+    elif ref_type == 'tag':
+        return 'refs/tags/{}^{{commit}}'.format(version)
+
+    return '{}^{{commit}}'.format(version)
+
+
+def _get_refspecs(repository, versions):
+    """
+    Return a list of the refspecs fetching each of the given versions into
+    the mirror.  See `fetch`.
+    """
+    ref_types = _read_ref_types(repository)
+    refspecs = []
+    for version in versions:
+        version = str(version)
+        ref_type = ref_types.get(version)
+        if ref_type == 'branch':
+            refspecs.append('+refs/heads/{0}:refs/heads/{0}'.format(version))
+        elif ref_type == 'tag':
+            refspecs.append('+refs/tags/{0}:refs/tags/{0}'.format(version))
+        else:
+            # The mirror refspec of the origin stores a branch or tag fetched
+            # by name under its own ref.
+            refspecs.append(version)
+
+    return refspecs
+
+
+def _is_commit_id(version):
+    """ Return a bool indicating whether the version is a full commit id. """
+    return bool(re.match(r'[0-9a-f]{40}$', version))
+
+
+def _batch_check(repository, names, debug=False):
+    """
+    Look up the given object names and return a list of (sha, type) tuples,
+    one per name, which are (None, None) for missing objects.
+
+    :param repository: A string containing the path to the repository.
+    :param names: A list of strings containing object names.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    return _backend.batch_check(repository, names, debug=debug)
+
+
+def _read_ref_types(repository):
+    """ Return the cached ref types of the repository as a dict. """
+    filename = os.path.join(repository, REF_TYPES_FILE)
+
+    return util.read_json(filename) or {}
+
+
+def _write_ref_types(repository, ref_types):
+    """ Atomically replace the cached ref types of the repository. """
+    util.write_json(os.path.join(repository, REF_TYPES_FILE), ref_types)
+
+
+def _get_pathspecs(src, exclude=()):
+    """
+    Return a list of git pathspecs covering everything the given source of a
+    `FilesConfig` may refer to.
+
+    :param src: A string containing a path or glob, relative to the root of
+     the repository.
+    :param exclude: An optional list of strings containing globs of paths to
+     leave out.
+    :return: list
+    """
+    if util.is_glob(src):
+        # Unlike `glob.glob`, git only matches files, so also match whatever
+        # is beneath a matching directory.
+        pathspecs = [':(glob){}'.format(src), ':(glob){}/**'.format(src)]
+    else:
+        pathspecs = [':(literal){}'.format(src)]
+
+    return pathspecs + _get_exclude_pathspecs(exclude)
+
+
+def _get_filter_pathspecs(include, exclude):
+    """
+    Return a list of git pathspecs matching the paths an extract with the
+    given filters writes, or an empty list when it writes every path.
+
+    :param include: A list of strings containing paths or globs to extract.
+    :param exclude: A list of strings containing globs of paths to leave out.
+    :return: list
+    """
+    if not include and not exclude:
+        return []
+    pathspecs = [p for src in include or ['**'] for p in _get_pathspecs(src)]
+
+    return pathspecs + _get_exclude_pathspecs(exclude)
+
+
+def _get_exclude_pathspecs(exclude):
+    """ Return a list of git pathspecs leaving out the given globs. """
+    pathspecs = []
+    for pattern in exclude:
+        pathspecs.extend([
+            ':(exclude,glob){}'.format(pattern),
+            ':(exclude,glob){}/**'.format(pattern)
+        ])
+
+    return pathspecs
+
+
+def _get_treeish(commit, subtree=None):
+    """ Return the name of the tree of a commit, or its subtree, as a str. """
+    if subtree:
+        return '{}:{}'.format(commit, subtree)
+
+    return '{}^{{tree}}'.format(commit)
+
+
+def _is_tree(repository, treeish, debug=False):
+    """ Return a bool indicating whether the tree exists in the repository. """
+    sha, object_type = _batch_check(repository, [treeish], debug)[0]
+
+    return object_type == 'tree'
+
+
+def _list_paths(repository, commit, filters, debug=False):
+    """
+    List the paths an extract of the specified commit with the given filters
+    writes and return a list.
+
+    :param repository: A string containing the path to the repository.
+    :param commit: A string containing the commit id.
+    :param filters: A dict containing the subtree, include and exclude
+     filters of the extract.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    treeish = _get_treeish(commit, filters['subtree'])
+    pathspecs = _get_filter_pathspecs(filters['include'], filters['exclude'])
+    with _read_tree(repository, treeish, debug) as tree:
+        return tree.ls_files(pathspecs)
+
+
+def _get_worktree(repository, commit, pathspecs, debug=False):
+    """
+    Materialize the paths of the specified commit matching any of the given
+    lists of pathspecs into a worktree keyed by the commit, and return its
+    path as a str.
+
+    :param repository: A string containing the path to the repository.
+    :param commit: A string containing the commit id to materialize.
+    :param pathspecs: A list of lists of strings containing git pathspecs.
+     Each list is matched on its own, so its exclude pathspecs only apply to
+     it.
+    :param debug: An optional bool to toggle debug output.
+    :return: str
+    """
+    with _read_tree(repository, commit, debug) as tree:
+        paths = []
+        for p in pathspecs:
+            paths.extend(tree.ls_files(p))
+        paths = list(collections.OrderedDict.fromkeys(paths))
+        return _materialize(tree, repository, commit, paths)
+
+
+def _materialize(tree, repository, commit, paths, prefix=None):
+    """
+    Write the given paths of the tree into the worktree keyed by the
+    specified commit, and return the path of the worktree as a str.  When the
+    tree is a subtree of the commit, its paths are written beneath the given
+    prefix, and the path of the prefix is returned.
+
+    Only paths not already in the worktree are written.  They are checked out
+    into a temporary directory, then renamed into place, so concurrent runs
+    never see a partially written file.  A path always has the same contents
+    within a commit, so it is never rewritten once it exists.
+
+    :param tree: The tree of the commit, or of a subtree, as yielded by
+     `_read_tree`.
+    :param repository: A string containing the path to the repository.
+    :param commit: A string containing the commit id of the tree.
+    :param paths: A list of strings containing the paths to write.
+    :param prefix: An optional string containing the path of the subtree.
+    :return: str
+    """
+    worktree = os.path.join(repository, WORKTREE_DIR, commit)
+    if os.path.isdir(worktree):
+        # Record the use, so the worktree is not pruned while read.
+        os.utime(worktree, None)
+    if prefix:
+        worktree = os.path.join(worktree, prefix)
+    paths = [
+        p for p in paths if not os.path.lexists(os.path.join(worktree, p))
+    ]
+    if not paths:
+        return worktree
+
+    tmp_dir = _get_tmp_dir(repository)
+    try:
+        tree.checkout(tmp_dir, paths)
+        for p in paths:
+            path = os.path.join(worktree, p)
+            config._makedirs(path)
+            os.rename(os.path.join(tmp_dir, p), path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return worktree
+
+
+def _get_tmp_dir(repository):
+    """ Create a temporary directory beside the worktrees and return it. """
+    dirname = os.path.join(repository, WORKTREE_DIR)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    return tempfile.mkdtemp(dir=dirname)
+
+
+def _checkout(repository,
+              destination,
+              commit,
+              paths=None,
+              strategy='auto',
+              filters=None,
+              debug=False):
+    """
+    Write the tree of the specified commit into the given directory through a
+    temporary index, leaving the repository untouched, and return None.
+
+    :param repository: A string containing the path to the repository.
+    :param destination: A string containing the directory to write into.
+    :param commit: A string containing the commit id to checkout.
+    :param paths: An optional list of strings containing the paths to write.
+     Writes every path the filters match by default.
+    :param strategy: An optional string containing one of
+     `util.COPY_STRATEGIES`.  See `extract`.
+    :param filters: An optional dict containing the subtree, include and
+     exclude filters of the extract.  See `extract`.
     :param debug: An optional bool to toggle debug output.
     :return: None
     """
-    cmd = sh.git.bake('fetch')
-    util.run_command(cmd, debug=debug)
-    cmd = sh.git.bake('checkout', version)
-    util.run_command(cmd, debug=debug)
-    cmd = sh.git.bake('clean', '-d', '-x', '-f')
-    util.run_command(cmd, debug=debug)
-    if not re.match(r'\b[0-9a-f]{7,40}\b', str(version)):
-        cmd = sh.git.bake('pull', rebase=True, ff_only=True)
-        util.run_command(cmd, debug=debug)
+    filters = filters or NO_FILTERS
+    treeish = _get_treeish(commit, filters['subtree'])
+    pathspecs = _get_filter_pathspecs(filters['include'], filters['exclude'])
+    config._makedirs(os.path.join(destination, ''))
+    with _read_tree(repository, treeish, debug) as tree:
+        cached = strategy in CACHED_COPY_STRATEGIES
+        if paths is None and (pathspecs or cached):
+            paths = tree.ls_files(pathspecs)
+        if not cached:
+            tree.checkout(destination, paths)
+            return
+        worktree = _materialize(tree, repository, commit, paths,
+                                filters['subtree'])
+
+    for p in paths:
+        _copy_path(worktree, destination, p, strategy)
+
+
+def _copy_path(worktree, destination, path, strategy):
+    """
+    Copy the given path from the worktree into the directory as
+    ``git checkout-index`` would write it, and return None.
+
+    :param worktree: A string containing the worktree to copy from.
+    :param destination: A string containing the directory to copy into.
+    :param path: A string containing the path relative to both.
+    :param strategy: A string containing one of `util.COPY_STRATEGIES`.
+    :return: None
+    """
+    src = os.path.join(worktree, path)
+    dst = os.path.join(destination, path)
+    config._makedirs(dst)
+    if os.path.islink(src):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(os.readlink(src), dst)
+    elif os.path.isdir(src):
+        # Submodules are checked out as empty directories.
+        if not os.path.isdir(dst):
+            os.mkdir(dst)
+    else:
+        util.copy_file(src, dst, strategy)
+
+
+def _checkout_changes(repository,
+                      destination,
+                      previous,
+                      commit,
+                      strategy='auto',
+                      filters=None,
+                      debug=False):
+    """
+    Update the given directory, holding the tree of the previous commit, to
+    the tree of the specified commit, and return None.  Only paths which
+    differ between the two commits are written or deleted.
+
+    :param repository: A string containing the path to the repository.
+    :param destination: A string containing the directory to update.
+    :param previous: A string containing the commit id in the directory.
+    :param commit: A string containing the commit id to checkout.
+    :param strategy: An optional string containing one of
+     `util.COPY_STRATEGIES`.  See `extract`.
+    :param filters: An optional dict containing the subtree, include and
+     exclude filters of the extract.  See `extract`.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    filters = filters or NO_FILTERS
+    pathspecs = _get_filter_pathspecs(filters['include'], filters['exclude'])
+    changes = _backend.diff_tree(
+        repository,
+        _get_treeish(previous, filters['subtree']),
+        _get_treeish(commit, filters['subtree']),
+        pathspecs,
+        debug=debug)
+
+    for status, path in changes:
+        if status == 'D':
+            _remove(destination, path)
+    paths = [path for status, path in changes if status != 'D']
+    if paths:
+        _checkout(
+            repository,
+            destination,
+            commit,
+            paths,
+            strategy=strategy,
+            filters=filters,
+            debug=debug)
+
+
+def _remove(destination, path):
+    """
+    Remove the given path from the directory, along with any parent
+    directories left empty, and return None.  The path of a submodule is
+    a directory, which is left in place when it is not empty, as git does.
+
+    :param destination: A string containing the directory.
+    :param path: A string containing the path relative to the directory.
+    :return: None
+    """
+    filename = os.path.join(destination, path)
+    if os.path.isdir(filename) and not os.path.islink(filename):
+        try:
+            os.rmdir(filename)
+        except OSError:
+            return
+    elif os.path.lexists(filename):
+        os.remove(filename)
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(destination, parent))
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def _read_tree(repository, treeish, debug=False):
+    """
+    Context manager which reads the given tree, and yields an object with
+    ``ls_files(pathspecs)`` and ``checkout(destination, paths)`` methods.
+
+    :param repository: A string containing the path to the repository.
+    :param treeish: A string containing the name of the tree to read.
+    :param debug: An optional bool to toggle debug output.
+    """
+    return _backend.read_tree(repository, treeish, debug=debug)
@@ -20,16 +20,42 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
+import collections
+import contextlib
 import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 
 import click
 import fasteners
 
 import gilt
+from gilt import backends
 from gilt import config
 from gilt import git
 from gilt import util
 
+# The most origins asked for versions at once.
+LS_REMOTE_JOBS = 16
+# The seconds in each unit of a duration.
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+# The bytes in each unit of a size.
+SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+# The seconds after its last use a clone may be evicted, as another gilt
+# may still be copying from it.
+EVICT_GRACE = 60 * 60
+
+# The threading.Lock of each object pool, by lock file.  See `_lock_pool`.
+_pool_locks = {}
+_pool_locks_lock = threading.Lock()
+
 
 class NotFoundError(Exception):
     """ Error raised when a config can not be found. """
@@ -50,32 +76,1426 @@ def main():
     '--debug/--no-debug',
     default=False,
     help='Enable or disable debug mode. Default is disabled.')
+@click.option(
+    '--network-timeout',
+    default='30m',
+    envvar='GILT_NETWORK_TIMEOUT',
+    callback=lambda ctx, param, value: _parse_duration(value),
+    help='Kill git commands reaching a remote after running this long, such '
+    'as 90s or 1h.  0 for no timeout.  Default 30m')
 @click.version_option(version=gilt.__version__)
 @click.pass_context
-def cli(ctx, config, debug):  # pragma: no cover
+def cli(ctx, config, debug, network_timeout):  # pragma: no cover
     ctx.obj['args'] = {}
     ctx.obj['args']['debug'] = debug
     ctx.obj['args']['config'] = config
+    backends.set_network_timeout(network_timeout or None)
 
 
 @click.command()
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.option(
+    '--copy-jobs',
+    default=4,
+    type=click.IntRange(min=1),
+    help='Number of files to copy in parallel for each entry.  Default 4')
+@click.option(
+    '--depth',
+    type=click.IntRange(min=1),
+    help='Clone and fetch only this many commits of history.  Can be '
+    'overridden per entry.  Default is full history')
+@click.option(
+    '--filter',
+    help='Partial clone filter, such as blob:none or tree:0.  Can be '
+    'overridden per entry.  Default is no filter')
+@click.option(
+    '--single-branch/--no-single-branch',
+    default=None,
+    help='Clone only the default branch, and fetch only the versions in '
+    'use.  Can be overridden per entry.  Default is disabled')
+@click.option(
+    '--copy-strategy',
+    type=click.Choice(util.COPY_STRATEGIES),
+    default='auto',
+    help='How files are written: straight from the repository (auto, '
+    'copy), cloned from the cache with reflinks (reflink), or hardlinked '
+    'to the cache (hardlink).  Falls back when unsupported.  Can be '
+    'overridden per entry.  Default auto')
+@click.option(
+    '--backend',
+    default='cli',
+    type=click.Choice(sorted(backends.BACKENDS)),
+    help='Run git operations as git commands (cli), or resolve versions and '
+    'read trees within gilt (dulwich), which requires dulwich.  Default cli')
+@click.option(
+    '--fetch-ttl',
+    default='0',
+    callback=lambda ctx, param, value: _parse_duration(value),
+    help='Skip checking versions fetched by any gilt within this long, such '
+    'as 60s, 5m or 1h.  Default 0, always check')
+@click.option(
+    '--offline/--no-offline',
+    default=False,
+    help='Resolve every version from the repositories already cloned, '
+    'without any network access.  Default is disabled')
+@click.option(
+    '--max-cache-size',
+    envvar='GILT_MAX_CACHE_SIZE',
+    callback=lambda ctx, param, value: _parse_size(value),
+    help='Evict the least recently used clones once the clone cache is '
+    'larger than this, such as 500M or 10G.  Default is unlimited')
 @click.pass_context
-def overlay(ctx):  # pragma: no cover
+def overlay(ctx, jobs, copy_jobs, depth, filter, single_branch, copy_strategy,
+            backend, fetch_ttl, offline, max_cache_size):  # pragma: no cover
     """ Install gilt dependencies """
     args = ctx.obj.get('args')
     filename = args.get('config')
     debug = args.get('debug')
     _setup(filename)
+    try:
+        git.set_backend(backend)
+    except backends.BackendError as e:
+        raise click.BadParameter(str(e), param_hint='--backend')
 
-    for c in config.config(filename):
-        with fasteners.InterProcessLock(c.lock_file):
+    configs = _apply_defaults(
+        config.config(filename),
+        depth=depth,
+        filter=filter,
+        single_branch=single_branch,
+        copy_strategy=copy_strategy)
+    groups = _group_by_repository(configs)
+    pins = config.read_lockfile(config.get_lockfile(filename))
+    pinned = dict((g[0].lock_file, _get_pinned(g, pins)) for g in groups)
+    if offline:
+        git.set_offline()
+        commits, missing = _resolve_offline(groups, pinned, debug)
+        if missing:
+            util.print_error('Not found in the cache:')
+            for m in missing:
+                util.print_error('  - {}'.format(m))
+            sys.exit(1)
+        remote_commits = {}
+    else:
+        commits = {}
+        remote_commits = _ls_remotes(groups, fetch_ttl, pinned, debug)
+    shared = _get_shared_paths(configs)
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(
+            lambda lane: _overlay_lane(
+                lane,
+                remote_commits=remote_commits,
+                fetch_ttl=fetch_ttl,
+                pinned=pinned,
+                commits=commits,
+                copy_jobs=copy_jobs,
+                shared=shared,
+                debug=debug),
+            _get_overlay_lanes(configs))
+    finally:
+        pool.close()
+        pool.join()
+
+    if max_cache_size is not None:
+        _evict_clones(max_cache_size, [c.src for c in configs], debug)
+    if not all(results):
+        sys.exit(1)
+
+
+@click.command()
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.option(
+    '--depth',
+    type=click.IntRange(min=1),
+    help='Clone and fetch only this many commits of history.  Can be '
+    'overridden per entry.  Default is full history')
+@click.option(
+    '--filter',
+    help='Partial clone filter, such as blob:none or tree:0.  Can be '
+    'overridden per entry.  Default is no filter')
+@click.option(
+    '--single-branch/--no-single-branch',
+    default=None,
+    help='Clone only the default branch, and fetch only the versions in '
+    'use.  Can be overridden per entry.  Default is disabled')
+@click.option(
+    '--max-cache-size',
+    envvar='GILT_MAX_CACHE_SIZE',
+    callback=lambda ctx, param, value: _parse_size(value),
+    help='Evict the least recently used clones once the clone cache is '
+    'larger than this, such as 500M or 10G.  Default is unlimited')
+@click.pass_context
+def prefetch(ctx, jobs, depth, filter, single_branch,
+             max_cache_size):  # pragma: no cover
+    """ Clone or fetch gilt dependencies without installing them """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+    _setup(filename)
+
+    configs = _apply_defaults(
+        config.config(filename),
+        depth=depth,
+        filter=filter,
+        single_branch=single_branch)
+    groups = _group_by_repository(configs)
+    pins = config.read_lockfile(config.get_lockfile(filename))
+    pinned = dict((g[0].lock_file, _get_pinned(g, pins)) for g in groups)
+    remote_commits = _ls_remotes(groups, pinned=pinned, debug=debug)
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(
+            lambda g: _prefetch_group(
+                g,
+                remote_commits=remote_commits.get(g[0].lock_file),
+                pinned=pinned[g[0].lock_file],
+                debug=debug),
+            groups)
+    finally:
+        pool.close()
+        pool.join()
+
+    if max_cache_size is not None:
+        _evict_clones(max_cache_size, [c.src for c in configs], debug)
+    if not all(results):
+        sys.exit(1)
+
+
+@click.command()
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.pass_context
+def lock(ctx, jobs):  # pragma: no cover
+    """ Lock every version to the commit it is at """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+    _setup(filename)
+
+    configs = config.config(filename)
+    pins = _lock_groups(_group_by_repository(configs), jobs, debug)
+    if pins is None:
+        sys.exit(1)
+    config.write_lockfile(config.get_lockfile(filename), pins)
+
+
+@click.command()
+@click.argument('names', nargs=-1)
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.pass_context
+def update(ctx, names, jobs):  # pragma: no cover
+    """ Lock the versions of the named repositories, or all, again """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+    _setup(filename)
+
+    configs = config.config(filename)
+    lockfile = config.get_lockfile(filename)
+    try:
+        pins = _update_pins(configs,
+                            config.read_lockfile(lockfile), names, jobs, debug)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='NAMES')
+    if pins is None:
+        sys.exit(1)
+    config.write_lockfile(lockfile, pins)
+
+
+def _update_pins(configs, pins, names=(), jobs=1, debug=False):
+    """
+    Lock the versions of the given `Config` objects whose repository is
+    named, or all of them, to the commits they are at, and return a dict of
+    the locked commits as `config.read_lockfile` does, or None on failure.
+    Others keep their locked commit, unless they are no longer configured.
+
+    :param configs: A list of `Config` objects.
+    :param pins: A dict as returned by `config.read_lockfile`.
+    :param names: An optional list of strings containing the names or urls
+     of the repositories to update.  Default is all of them.
+    :param jobs: An optional int containing the number of repositories to
+     process in parallel.  Default is 1.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    unknown = set(names) - set(c.name for c in configs) - set(c.git
+                                                              for c in configs)
+    if unknown:
+        msg = 'No such repository {}'.format(', '.join(sorted(unknown)))
+        raise ValueError(msg)
+
+    selected = [
+        c for c in configs if not names or c.name in names or c.git in names
+    ]
+    result = {}
+    for c in configs:
+        commit = pins.get(c.git, {}).get(str(c.version))
+        if commit and c not in selected:
+            result.setdefault(c.git, {})[str(c.version)] = commit
+    updated = _lock_groups(_group_by_repository(selected), jobs, debug)
+    if updated is None:
+        return None
+    for repository, commits in updated.items():
+        result.setdefault(repository, {}).update(commits)
+
+    return result
+
+
+def _lock_groups(groups, jobs=1, debug=False):
+    """
+    Resolve the versions of each group of `Config` objects, fetching them as
+    `overlay` does, and return a dict of the commits they are at, as
+    `config.read_lockfile` does, or None when any failed.
+
+    :param groups: A list of lists of `Config` objects sharing a lock file.
+    :param jobs: An optional int containing the number of repositories to
+     process in parallel.  Default is 1.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    remote_commits = _ls_remotes(groups, debug=debug)
+
+    def lock_group(configs):
+        with util.buffered_output():
+            util.print_info('{}:'.format(configs[0].name))
+            try:
+                commits = _update_repository(
+                    configs,
+                    remote_commits.get(configs[0].lock_file),
+                    debug=debug)
+                for version in _unique(c.version for c in configs):
+                    if version not in commits:
+                        msg = 'Unable to find {}'.format(version)
+                        raise git.NotFoundError(msg)
+                    msg = '  - locked ({}) {}'.format(version,
+                                                      commits[version])
+                    util.print_info(msg)
+            except Exception as e:
+                if debug:
+                    util.print_error(traceback.format_exc())
+                msg = '  - failed to lock {}: {}'.format(configs[0].git, e)
+                util.print_error(msg)
+                return None
+            return [(c.git, str(c.version), commits[c.version])
+                    for c in configs]
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(lock_group, groups)
+    finally:
+        pool.close()
+        pool.join()
+
+    if not all(r is not None for r in results):
+        return None
+    pins = {}
+    for repository, version, commit in (p for r in results for p in r):
+        pins.setdefault(repository, {})[version] = commit
+
+    return pins
+
+
+@click.group()
+def cache():  # pragma: no cover
+    """ Manage the clone cache """
+    pass
+
+
+@cache.command('export')
+@click.argument('destination')
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.pass_context
+def export_cache(ctx, destination, jobs):  # pragma: no cover
+    """ Write the versions in use to a directory, or tar, of bundles """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+    _setup(filename)
+
+    groups = _group_by_repository(config.config(filename))
+    pins = config.read_lockfile(config.get_lockfile(filename))
+    pinned = dict((g[0].lock_file, _get_pinned(g, pins)) for g in groups)
+    _, missing = _resolve_offline(groups, pinned, debug)
+    if missing:
+        util.print_error('Not found in the cache:')
+        for m in missing:
+            util.print_error('  - {}'.format(m))
+        sys.exit(1)
+
+    with _bundle_dir(destination, write=True) as directory:
+        results = _parallel_map(
+            lambda g: _export_group(
+                g, directory, pinned=pinned[g[0].lock_file], debug=debug),
+            groups, jobs)
+    if not all(results):
+        sys.exit(1)
+
+
+@cache.command('import')
+@click.argument('source', type=click.Path(exists=True))
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.option(
+    '--max-cache-size',
+    envvar='GILT_MAX_CACHE_SIZE',
+    callback=lambda ctx, param, value: _parse_size(value),
+    help='Evict the least recently used clones once the clone cache is '
+    'larger than this, such as 500M or 10G.  Default is unlimited')
+@click.pass_context
+def import_cache(ctx, source, jobs, max_cache_size):  # pragma: no cover
+    """ Clone repositories missing from the cache from bundles """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+    _setup(filename)
+
+    configs = config.config(filename)
+    with _bundle_dir(source) as directory:
+        results = _parallel_map(lambda g: _import_group(g, directory, debug),
+                                _group_by_repository(configs), jobs)
+    if max_cache_size is not None:
+        _evict_clones(max_cache_size, [c.src for c in configs], debug)
+    if not all(results):
+        sys.exit(1)
+
+
+@cache.command('gc')
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of repositories to process in parallel.  Default 1')
+@click.option(
+    '--max-cache-size',
+    envvar='GILT_MAX_CACHE_SIZE',
+    callback=lambda ctx, param, value: _parse_size(value),
+    help='Evict the least recently used clones once the clone cache is '
+    'larger than this, such as 500M or 10G.  Default is unlimited')
+@click.pass_context
+def gc_cache(ctx, jobs, max_cache_size):  # pragma: no cover
+    """ Evict clones over the size limit and repack the rest """
+    args = ctx.obj.get('args')
+    filename = args.get('config')
+    debug = args.get('debug')
+
+    clone_dir = config._get_clone_dir()
+    if not os.path.exists(clone_dir):
+        return
+    if max_cache_size is not None:
+        keep = []
+        if os.path.exists(filename):
+            keep = [c.src for c in config.config(filename)]
+        _evict_clones(max_cache_size, keep, debug)
+
+    repositories = [(name, os.path.join(clone_dir, name),
+                     config._get_lock_file(name), False)
+                    for name in sorted(os.listdir(clone_dir))]
+    repositories.extend(('pool/{}'.format(name), pool, lock_file, True)
+                        for name, pool, lock_file in _list_pools())
+    results = _parallel_map(
+        lambda r: _maintain_repository(*r, debug=debug), repositories, jobs)
+    if not all(results):
+        sys.exit(1)
+
+
+@contextlib.contextmanager
+def _bundle_dir(path, write=False):
+    """
+    Context manager yielding the directory of bundles at the given path.  A
+    path ending in `.tar` is an archive of the bundles instead, extracted to
+    a temporary directory, or, when writing, archived from it on exit.
+
+    :param path: A string containing the path of the directory or archive.
+    :param write: An optional bool to create the directory or archive.
+    :return: str
+    """
+    if not path.endswith('.tar'):
+        if write:
+            config._makedirs(os.path.join(path, ''))
+        yield path
+        return
+
+    directory = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.gilt-bundles-')
+    try:
+        if not write:
+            with tarfile.open(path) as tar:
+                tar.extractall(directory, _get_bundle_members(tar))
+        yield directory
+        if write:
+            with tarfile.open(path, 'w') as tar:
+                for name in sorted(os.listdir(directory)):
+                    tar.add(os.path.join(directory, name), arcname=name)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _get_bundle_members(tar):
+    """
+    Return a list of the bundles in the given `tarfile.TarFile`, leaving out
+    anything which would be extracted outside of its directory.
+    """
+    return [
+        m for m in tar.getmembers()
+        if m.isfile() and m.name.endswith('.bundle') and os.path.basename(
+            m.name) == m.name
+    ]
+
+
+def _parallel_map(func, items, jobs=1):
+    """
+    Call the given function with each of the given items, on the given
+    number of threads, and return a list of the results.
+    """
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_bundle(directory, name):
+    """ Return the path of the bundle of the named repository as a str. """
+    return os.path.join(directory, '{}.bundle'.format(name))
+
+
+def _export_group(configs, directory, pinned=None, debug=False):
+    """
+    Write the versions of the given `Config` objects, which share a
+    repository, to a bundle in the given directory, and return a bool
+    indicating success.  A shallow or partial clone is skipped, as it lacks
+    the history a bundle must have.
+
+    :param configs: A list of `Config` objects sharing a lock file.
+    :param directory: A string containing the directory to write to.
+    :param pinned: An optional dict mapping versions to the commit ids they
+     are locked to, as returned by `_get_pinned`.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    pinned = pinned or {}
+    c = configs[0]
+    bundle = _get_bundle(directory, c.name)
+    with util.buffered_output():
+        util.print_info('{}:'.format(c.name))
+        try:
+            with fasteners.InterProcessLock(c.lock_file):
+                if not git.is_complete(c.src):
+                    msg = '  - skipping, a shallow or partial clone'
+                    util.print_warn(msg)
+                    return True
+                versions = _unique(c.version for c in configs
+                                   if c.version not in pinned)
+                git.create_bundle(
+                    c.src,
+                    bundle,
+                    versions,
+                    commits=_unique(pinned.values()),
+                    debug=debug)
+        except Exception as e:
+            if debug:
+                util.print_error(traceback.format_exc())
+            msg = '  - failed to export {}: {}'.format(c.git, e)
+            util.print_error(msg)
+            return False
+        util.print_info('  - exported to {}'.format(os.path.basename(bundle)))
+
+    return True
+
+
+def _import_group(configs, directory, debug=False):
+    """
+    Clone the repository shared by the given `Config` objects from its
+    bundle in the given directory, unless it is already cloned or has no
+    bundle, and return a bool indicating success.
+
+    :param configs: A list of `Config` objects sharing a lock file.
+    :param directory: A string containing the directory of bundles.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    c = configs[0]
+    bundle = _get_bundle(directory, c.name)
+    with util.buffered_output():
+        util.print_info('{}:'.format(c.name))
+        if not os.path.exists(bundle):
+            util.print_warn('  - skipping, no bundle')
+            return True
+        try:
+            with fasteners.InterProcessLock(c.lock_file):
+                if os.path.exists(c.src):
+                    util.print_warn('  - skipping, already cloned')
+                    return True
+                git.clone_bundle(c.name, bundle, c.src, c.git, debug=debug)
+                git.mark_used(c.src)
+        except Exception as e:
+            if debug:
+                util.print_error(traceback.format_exc())
+            msg = '  - failed to import {}: {}'.format(c.git, e)
+            util.print_error(msg)
+            return False
+
+    return True
+
+
+def _evict_clones(max_size, keep=(), debug=False):
+    """
+    Remove the least recently used clones until the clone cache, with its
+    object pools, takes no more than the given number of bytes, and return a
+    list of the names of the clones removed.
+
+    Worktrees of commits not used within `EVICT_GRACE` seconds are removed
+    first, from every clone not locked by another gilt.  Clones at the given
+    paths are kept, as are clones used within `EVICT_GRACE` seconds, or
+    locked by another gilt, which may still be reading them.  The refs an
+    object pool keeps for a clone are removed with it, and the pool is
+    pruned of the objects no other clone needs.
+
+    :param max_size: An int containing the most bytes the cache may take.
+    :param keep: An optional list of strings containing the paths of clones
+     never to remove.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    clone_dir = config._get_clone_dir()
+    clones = []
+    for name in os.listdir(clone_dir):
+        src = os.path.join(clone_dir, name)
+        _prune_worktrees(name, src, blocking=False)
+        size = util.get_disk_usage(src)
+        clones.append((git.get_last_used(src), name, src, size))
+    pools = _list_pools()
+    total = sum(size for _, _, _, size in clones)
+    total += sum(util.get_disk_usage(pool) for _, pool, _ in pools)
+
+    evicted = []
+    for _, name, src, size in sorted(clones):
+        if total <= max_size:
+            break
+        if src in keep:
+            continue
+        lock = fasteners.InterProcessLock(config._get_lock_file(name))
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            # Another gilt may have used the clone since it was listed.
+            if time.time() - git.get_last_used(src) < EVICT_GRACE:
+                continue
+            borrowed = [p for p in pools if git.is_pooled(src, p[1])]
+            shutil.rmtree(src)
+            fetch_file = config._get_fetch_file(name)
+            if os.path.exists(fetch_file):
+                os.remove(fetch_file)
+        finally:
+            lock.release()
+        total -= size
+        evicted.append(name)
+        msg = 'Evicted {} from the clone cache, freeing {} bytes'.format(name,
+                                                                         size)
+        util.print_info(msg)
+
+        for pool_name, pool, pool_lock_file in borrowed:
+            with _lock_pool(pool_lock_file):
+                git.remove_fork(pool, name, debug=debug)
+            if total > max_size:
+                total -= _prune_pool(pool_name, pool, pool_lock_file, debug)
+
+    return evicted
+
+
+def _prune_worktrees(name, src, blocking=True):
+    """
+    Remove the worktrees of the given clone not used within `EVICT_GRACE`
+    seconds under its lock, and return a list of their names.  Nothing is
+    removed when the lock is held by another gilt, unless blocking.
+
+    :param name: A string containing the name of the clone.
+    :param src: A string containing the path to the clone.
+    :param blocking: An optional bool to wait for the lock.  Default is True.
+    :return: list
+    """
+    lock = fasteners.InterProcessLock(config._get_lock_file(name))
+    if not lock.acquire(blocking=blocking):
+        return []
+    try:
+        return git.prune_worktrees(src, EVICT_GRACE)
+    finally:
+        lock.release()
+
+
+def _list_pools():
+    """
+    Return a list of (name, path, lock file) tuples of strings, one for each
+    object pool in the cache.
+    """
+    pool_dir = config._get_pool_dir()
+    if not os.path.exists(pool_dir):
+        return []
+
+    return [(name, config._get_pool(name), config._get_pool_lock_file(name))
+            for name in sorted(os.listdir(pool_dir))]
+
+
+def _prune_pool(name, pool, lock_file, debug=False):
+    """
+    Drop the objects of the given object pool no clone refers to any more,
+    and return the number of bytes freed as an int.
+
+    A clone borrows objects from a pool reachable from the refs of other
+    clones, so the pool is only pruned while every clone borrowing from it
+    is complete and locked, after the refs of each are shared with it again.
+
+    :param name: A string containing the name of the object pool.
+    :param pool: A string containing the path to the object pool.
+    :param lock_file: A string containing the path to its lock file.
+    :param debug: An optional bool to toggle debug output.
+    :return: int
+    """
+    clone_dir = config._get_clone_dir()
+    borrowers = [
+        n for n in sorted(os.listdir(clone_dir))
+        if git.is_pooled(os.path.join(clone_dir, n), pool)
+    ]
+    locks = []
+    try:
+        for n in borrowers:
+            lock = fasteners.InterProcessLock(config._get_lock_file(n))
+            if not lock.acquire(blocking=False):
+                return 0
+            locks.append(lock)
+            if not git.is_complete(os.path.join(clone_dir, n)):
+                return 0
+        with _lock_pool(lock_file):
+            for n in borrowers:
+                src = os.path.join(clone_dir, n)
+                git.share_objects(src, pool, n, debug=debug)
+            size = util.get_disk_usage(pool)
+            git.prune_pool(pool, debug=debug)
+            freed = size - util.get_disk_usage(pool)
+    finally:
+        for lock in locks:
+            lock.release()
+
+    msg = 'Pruned object pool {}, freeing {} bytes'.format(name, freed)
+    util.print_info(msg)
+
+    return freed
+
+
+def _maintain_repository(name, src, lock_file, pool=False, debug=False):
+    """
+    Repack the given clone or object pool under its lock, and remove the
+    worktrees of commits not used within `EVICT_GRACE` seconds, and return
+    a bool indicating success.  An object pool is only pruned by
+    `_prune_pool`.
+
+    :param name: A string containing the name of the repository.
+    :param src: A string containing the path to the repository.
+    :param lock_file: A string containing the path to its lock file.
+    :param pool: An optional bool indicating the repository is an object
+     pool.  Default is False.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    with util.buffered_output():
+        util.print_info('{}:'.format(name))
+        try:
+            with fasteners.InterProcessLock(lock_file):
+                if not os.path.exists(src):
+                    return True
+                removed = git.prune_worktrees(src, EVICT_GRACE)
+                git.maintain(src, prune=not pool, debug=debug)
+            if removed:
+                msg = '  - removed {} unused worktrees'.format(len(removed))
+                util.print_info(msg)
+            msg = '  - repacked, {} bytes'.format(util.get_disk_usage(src))
+            util.print_info(msg)
+        except Exception as e:
+            if debug:
+                util.print_error(traceback.format_exc())
+            msg = '  - failed to repack {}: {}'.format(name, e)
+            util.print_error(msg)
+            return False
+
+    return True
+
+
+def _parse_size(value):
+    """
+    Parse a size such as `1024`, `500M` or `10G`, and return the number of
+    bytes as an int, or None when no size is given.
+
+    :param value: A string containing the size.
+    :return: int
+    """
+    if value is None:
+        return None
+    match = re.match(r'(\d+)([kmgt]?)b?$', value.strip().lower())
+    if not match:
+        msg = 'Invalid size {}, expected a number of bytes, k, m, g or t'
+        raise click.BadParameter(msg.format(value))
+    number, unit = match.groups()
+
+    return int(number) * SIZE_UNITS[unit]
+
+
+def _parse_duration(value):
+    """
+    Parse a duration such as `90`, `60s`, `5m`, `1h` or `1d`, and return the
+    number of seconds as an int.
+
+    :param value: A string containing the duration.
+    :return: int
+    """
+    match = re.match(r'(\d+)([smhd]?)$', value.strip())
+    if not match:
+        msg = 'Invalid duration {}, expected a number of s, m, h or d'.format(
+            value)
+        raise click.BadParameter(msg)
+    number, unit = match.groups()
+
+    return int(number) * DURATION_UNITS[unit or 's']
+
+
+def _apply_defaults(configs, **defaults):
+    """
+    Fill fields left unset by each of the given `Config` objects with the
+    given defaults, and return a list of `Config` objects.  The checksum of
+    an entry given a default copy strategy is updated to match.
+
+    :param configs: A list of `Config` objects.
+    :param defaults: Keyword arguments containing `Config` fields.
+    :return: list
+    """
+    result = []
+    for c in configs:
+        values = dict((k, v) for k, v in defaults.items()
+                      if getattr(c, k) is None)
+        if values.get('copy_strategy'):
+            filters = {
+                'path': c.path,
+                'include': c.include,
+                'exclude': c.exclude,
+            }
+            values['checksum'] = config._get_checksum(c.git, c.version, c.dst,
+                                                      c.files, filters,
+                                                      values['copy_strategy'])
+        result.append(c._replace(**values))
+
+    return result
+
+
+def _group_by_repository(configs):
+    """
+    Group the given `Config` objects by repository and return a list of
+    lists.
+
+    Entries sharing a repository share a clone and lock file, so it is
+    updated once for all of them.  Groups are returned in the order their
+    repository first appears in the config.
+
+    :param configs: A list of `Config` objects.
+    :return: list
+    """
+    groups = collections.OrderedDict()
+    for c in configs:
+        groups.setdefault(c.lock_file, []).append(c)
+
+    return groups.values()
+
+
+def _get_overlay_lanes(configs):
+    """
+    Split the given `Config` objects into lanes, so that entries sharing a
+    repository, or whose destinations overlap, share a lane, and return a
+    list of lists of `Config` objects, each overlaid in order by one worker.
+
+    A destination overlaps another when they are the same path, or one is
+    beneath the other.  Entries keep their order in the config within a
+    lane, and lanes are ordered by their first entry.
+
+    :param configs: A list of `Config` objects.
+    :return: list
+    """
+    destinations = [[
+        os.path.join(os.path.normpath(dst), '')
+        for dst in ([c.dst] if c.dst else [fc.dst for fc in c.files])
+    ] for c in configs]
+    parents = range(len(configs))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, paths in enumerate(destinations):
+        for j in range(i):
+            if configs[i].lock_file == configs[j].lock_file or any(
+                    a.startswith(b) or b.startswith(a)
+                    for a in paths for b in destinations[j]):
+                parents[find(i)] = find(j)
+
+    lanes = collections.OrderedDict()
+    for i, c in enumerate(configs):
+        lanes.setdefault(find(i), []).append(c)
+
+    return lanes.values()
+
+
+def _ls_remotes(groups, fetch_ttl=0, pinned=None, debug=False):
+    """
+    Ask the origin of each repository already cloned which commits its
+    branches point to upstream, all in parallel, and return a dict mapping
+    the lock file of each group to a dict of versions to commit ids.
+
+    Repositories not cloned yet, whose versions were all fetched within the
+    given number of seconds or are locked, or whose origin can not be asked,
+    are left out, so they are fetched as usual.
+
+    :param groups: A list of lists of `Config` objects sharing a lock file.
+    :param fetch_ttl: An optional int containing the number of seconds a
+     fetch is fresh for.  Default is 0.
+    :param pinned: An optional dict mapping the lock file of each group to a
+     dict of its locked versions, as returned by `_get_pinned`.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    pinned = pinned or {}
+    now = time.time()
+    groups = [
+        g for g in groups
+        if os.path.exists(g[0].src) and not all(
+            c.version in pinned.get(c.lock_file, {}) or _is_fresh(
+                c, c.version, fetch_ttl, now) for c in g)
+    ]
+    if not groups:
+        return {}
+
+    def ls_remote(configs):
+        c = configs[0]
+        versions = _unique(
+            c.version for c in configs
+            if c.version not in pinned.get(c.lock_file, {}))
+        try:
+            return c.lock_file, git.ls_remote(c.src, versions, debug=debug)
+        except Exception as e:
+            if debug:
+                msg = '  - unable to ask {} for versions: {}'.format(c.git, e)
+                util.print_warn(msg)
+            return c.lock_file, None
+
+    pool = ThreadPool(min(len(groups), LS_REMOTE_JOBS))
+    try:
+        results = pool.map(ls_remote, groups)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict((k, v) for k, v in results if v is not None)
+
+
+def _get_shared_paths(configs):
+    """
+    Return a dict mapping the state file of each of the given `Config`
+    objects to a list of the paths beneath what it last wrote, which other
+    entries last wrote, such as files overlaid into the destination of an
+    extract.
+
+    :param configs: A list of `Config` objects.
+    :return: dict
+    """
+    written = dict((c.state_file, [
+        os.path.normpath(path)
+        for path in (util.read_json(c.state_file) or {}).get('paths', [])
+    ]) for c in configs)
+
+    result = {}
+    for state_file, paths in written.items():
+        prefixes = tuple(os.path.join(path, '') for path in paths)
+        result[state_file] = [
+            path for other, other_paths in written.items()
+            if other != state_file for path in other_paths
+            if path.startswith(prefixes)
+        ]
+
+    return result
+
+
+def _overlay_lane(configs,
+                  remote_commits=None,
+                  fetch_ttl=0,
+                  pinned=None,
+                  commits=None,
+                  copy_jobs=1,
+                  shared=None,
+                  debug=False):
+    """
+    Overlay each of the given `Config` objects in order, and return a bool
+    indicating success.
+
+    Each repository is updated once, when its first entry is reached, and
+    each distinct version is resolved once, however many entries refer to
+    it.  Once a repository fails to update, its remaining entries fail
+    without trying again.  Given the commits of its versions, a repository
+    is not updated at all.
+
+    :param configs: A list of `Config` objects, as returned by
+     `_get_overlay_lanes`.
+    :param remote_commits: An optional dict mapping the lock file of each
+     repository to a dict of the commit ids its versions point to upstream,
+     as returned by `_ls_remotes`.
+    :param fetch_ttl: An optional int containing the number of seconds a
+     fetch is fresh for.  Default is 0.
+    :param pinned: An optional dict mapping the lock file of each repository
+     to a dict of its locked versions, as returned by `_get_pinned`.
+    :param commits: An optional dict mapping the lock file of each
+     repository to a dict of the commit ids its versions resolve to, as
+     returned by `_resolve_offline`.
+    :param copy_jobs: An optional int containing the number of threads each
+     entry copies files with.  Default is 1.
+    :param shared: An optional dict mapping state files to the paths other
+     entries write beneath, as returned by `_get_shared_paths`.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    remote_commits = remote_commits or {}
+    pinned = pinned or {}
+    commits = dict(commits or {})
+    shared = shared or {}
+    repositories = dict((g[0].lock_file, g)
+                        for g in _group_by_repository(configs))
+    failed = {}
+    success = True
+    for c in configs:
+        with util.buffered_output():
             util.print_info('{}:'.format(c.name))
-            if not os.path.exists(c.src):
-                git.clone(c.name, c.git, c.src, debug=debug)
-            if c.dst:
-                git.extract(c.src, c.dst, c.version, debug=debug)
+            try:
+                if c.lock_file in failed:
+                    raise failed[c.lock_file]
+                if c.lock_file not in commits:
+                    try:
+                        commits[c.lock_file] = _update_repository(
+                            repositories[c.lock_file],
+                            remote_commits.get(c.lock_file), fetch_ttl,
+                            pinned.get(c.lock_file), debug)
+                    except Exception as e:
+                        failed[c.lock_file] = e
+                        raise
+                _overlay_config(c, commits[c.lock_file].get(c.version),
+                                copy_jobs, shared.get(c.state_file, ()), debug)
+            except Exception as e:
+                success = False
+                if debug:
+                    util.print_error(traceback.format_exc())
+                msg = '  - failed to overlay {}: {}'.format(c.git, e)
+                util.print_error(msg)
+
+    return success
+
+
+def _prefetch_group(configs, remote_commits=None, pinned=None, debug=False):
+    """
+    Clone or fetch the repository shared by the given `Config` objects, along
+    with every object of their versions, report what was transferred, and
+    return a bool indicating success.
+
+    :param configs: A list of `Config` objects sharing a lock file.
+    :param remote_commits: An optional dict mapping versions to the commit
+     ids they point to upstream, as returned by `git.ls_remote`.
+    :param pinned: An optional dict mapping versions to the commit ids they
+     are locked to, as returned by `_get_pinned`.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    c = configs[0]
+    with util.buffered_output():
+        util.print_info('{}:'.format(c.name))
+        try:
+            before = git.count_objects(c.src, debug=debug)
+            commits = _update_repository(
+                configs, remote_commits, pinned=pinned, debug=debug)
+            for version in _unique(c.version for c in configs):
+                if version not in commits:
+                    msg = 'Unable to find {}'.format(version)
+                    raise git.NotFoundError(msg)
+            with fasteners.InterProcessLock(c.lock_file):
+                git.fetch_objects(
+                    c.src, _unique(commits.values()), debug=debug)
+                after = git.count_objects(c.src, debug=debug)
+        except Exception as e:
+            if debug:
+                util.print_error(traceback.format_exc())
+            msg = '  - failed to prefetch {}: {}'.format(c.git, e)
+            util.print_error(msg)
+            return False
+
+        # Counts may shrink when git packs objects after a fetch.
+        msg = '  - transferred {} objects, {} bytes'.format(
+            max(after['objects'] - before['objects'], 0),
+            max(after['bytes'] - before['bytes'], 0))
+        util.print_info(msg)
+
+    return True
+
+
+def _update_repository(configs,
+                       remote_commits=None,
+                       fetch_ttl=0,
+                       pinned=None,
+                       debug=False):
+    """
+    Clone or fetch the repository shared by the given `Config` objects, and
+    return a dict mapping each of their versions to a commit id.
+
+    The repository is fetched at most once, and only when some version is
+    not yet present locally, or is a branch which moved upstream.  Without
+    the commits branches point to upstream, every branch is assumed to have
+    moved.  Only those versions are fetched.  The clone options of the first
+    entry apply to the whole repository.
+
+    A version fetched, or found unchanged upstream, by any gilt within the
+    given number of seconds is not fetched again.  When and at which commit
+    each version was last seen is recorded in the fetch file next to the
+    lock file.
+
+    Locked versions resolve to their locked commit, which is only fetched
+    when it is not present locally.
+
+    A repository with an object pool is cloned borrowing the objects of the
+    pool, and whatever it fetches is moved into the pool.
+
+    :param configs: A list of `Config` objects sharing a lock file.
+    :param remote_commits: An optional dict mapping versions to the commit
+     ids they point to upstream, as returned by `git.ls_remote`.
+    :param fetch_ttl: An optional int containing the number of seconds a
+     fetch is fresh for.  Default is 0.
+    :param pinned: An optional dict mapping versions to the commit ids they
+     are locked to, as returned by `_get_pinned`.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    pinned = pinned or {}
+    versions = _unique(c.version for c in configs if c.version not in pinned)
+    locked = _unique(pinned.values())
+    c = configs[0]
+    narrow = bool(c.depth or c.single_branch)
+    now = time.time()
+    with fasteners.InterProcessLock(c.lock_file):
+        cloned = not os.path.exists(c.src)
+        if cloned:
+            if c.pool:
+                with _lock_pool(c.pool_lock_file):
+                    git.init_pool(c.pool, debug=debug)
+            git.clone(
+                c.name,
+                c.git,
+                c.src,
+                depth=c.depth,
+                filter=c.filter,
+                single_branch=c.single_branch,
+                reference=c.pool,
+                debug=debug)
+        elif os.path.exists(os.path.join(c.src, '.git')):
+            git.convert(c.name, c.src, debug=debug)
+
+        commits = None
+        stale = []
+        seen = []
+        if versions:
+            ref_types = git.get_ref_types(c.src, versions, debug=debug)
+            missing = [v for v in versions if ref_types[v] is None]
+            branches = [v for v in versions if ref_types[v] == 'branch']
+            if cloned:
+                # Branches are up to date right after a clone, though a
+                # narrow clone may still lack some versions.
+                stale = missing if narrow else []
+                seen = versions
+            else:
+                if remote_commits is not None or fetch_ttl:
+                    commits = git.resolve(c.src, versions, debug=debug)
+                if remote_commits is None:
+                    moved = branches
+                else:
+                    # Branches not asked for upstream are assumed to have
+                    # moved, while those gone upstream are left as they are.
+                    moved = [
+                        v for v in branches
+                        if str(v) not in remote_commits or remote_commits[str(
+                            v)] not in (None, commits.get(v))
+                    ]
+                    seen = [v for v in branches if remote_commits.get(str(v))]
+                if fetch_ttl:
+                    moved = [
+                        v for v in moved
+                        if not _is_fresh(c, v, fetch_ttl, now, commits.get(v))
+                    ]
+                stale = _unique(missing + moved)
+        if locked:
+            present = git.resolve(c.src, locked, debug=debug)
+            stale.extend(sha for sha in locked if sha not in present)
+        if stale:
+            git.fetch(c.src, versions=stale, depth=c.depth, debug=debug)
+            commits = None
+            seen = _unique(seen + [v for v in stale if v in versions])
+
+        if versions:
+            commits = commits or git.resolve(c.src, versions, debug=debug)
+            if seen:
+                _record_fetch(c, seen, commits, now)
+        if locked and stale:
+            present = git.resolve(c.src, locked, debug=debug)
+            for version, sha in pinned.items():
+                if sha not in present:
+                    msg = 'Unable to find {}, locked for {}, in {}'.format(
+                        sha, version, c.git)
+                    raise git.NotFoundError(msg)
+        if c.pool and (cloned or stale or not git.is_pooled(c.src, c.pool)):
+            _share_objects(c, debug)
+        git.mark_used(c.src)
+
+    if pinned:
+        commits = dict(commits or {})
+        commits.update(pinned)
+
+    return commits
+
+
+def _resolve_offline(groups, pinned=None, debug=False):
+    """
+    Resolve the versions of each group of `Config` objects from the
+    repositories already cloned, and return a tuple of a dict mapping the
+    lock file of each group to a dict of the commit ids of its versions, and
+    a list of strings describing each version which can not be found, or
+    whose objects a partial clone lacks.
+
+    :param groups: A list of lists of `Config` objects sharing a lock file.
+    :param pinned: An optional dict mapping the lock file of each group to a
+     dict of its locked versions, as returned by `_get_pinned`.
+    :param debug: An optional bool to toggle debug output.
+    :return: tuple
+    """
+    pinned = pinned or {}
+    result = {}
+    missing = []
+    for configs in groups:
+        c = configs[0]
+        locked = pinned.get(c.lock_file, {})
+        versions = _unique(c.version for c in configs)
+        if not os.path.exists(c.src):
+            missing.extend('{} ({}): not cloned'.format(c.name, v)
+                           for v in versions)
+            continue
+
+        with fasteners.InterProcessLock(c.lock_file):
+            if os.path.exists(os.path.join(c.src, '.git')):
+                git.convert(c.name, c.src, debug=debug)
+            names = _unique(locked.get(v, v) for v in versions)
+            found = git.resolve(c.src, names, debug=debug)
+            # A partial clone may lack objects it can not fetch offline.
+            incomplete = [
+                sha for sha in _unique(found.values())
+                if git.list_missing_objects(
+                    c.src, [sha], debug=debug)
+            ]
+            git.mark_used(c.src)
+        commits = {}
+        for v in versions:
+            commit = found.get(locked.get(v, v))
+            if commit in incomplete:
+                missing.append('{} ({}): objects of {} not fetched'.format(
+                    c.name, v, commit))
+            elif commit:
+                commits[v] = commit
+            elif v in locked:
+                missing.append('{} ({}): locked commit {}'.format(c.name, v,
+                                                                  locked[v]))
             else:
-                git.overlay(c.src, c.files, c.version, debug=debug)
+                missing.append('{} ({})'.format(c.name, v))
+        result[c.lock_file] = commits
+
+    return result, missing
+
+
+def _share_objects(c, debug=False):
+    """
+    Move the objects of the clone of the given `Config` object into its
+    object pool, under the lock of the pool, and return None.  A shallow or
+    partial clone only borrows objects from the pool, as it lacks history the
+    pool would need.
+
+    :param c: A `Config` object.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if not git.is_complete(c.src):
+        return
+
+    with _lock_pool(c.pool_lock_file):
+        git.init_pool(c.pool, debug=debug)
+        git.share_objects(c.src, c.pool, c.name, debug=debug)
+
+
+@contextlib.contextmanager
+def _lock_pool(lock_file):
+    """
+    Context manager holding the lock of an object pool, shared by any number
+    of repositories, both against other gilts and other threads of this one.
+    A `fasteners.InterProcessLock` alone is held by the whole process.
+
+    :param lock_file: A string containing the path to the lock file of the
+     object pool.
+    :return: None
+    """
+    with _pool_locks_lock:
+        lock = _pool_locks.setdefault(lock_file, threading.Lock())
+    with lock:
+        with fasteners.InterProcessLock(lock_file):
+            yield
+
+
+def _get_pinned(configs, pins):
+    """
+    Return a dict mapping the versions of the given `Config` objects, which
+    share a lock file, to the commit ids the lockfile locks them to.
+
+    :param configs: A list of `Config` objects sharing a lock file.
+    :param pins: A dict as returned by `config.read_lockfile`.
+    :return: dict
+    """
+    pinned = {}
+    for c in configs:
+        commit = pins.get(c.git, {}).get(str(c.version))
+        if commit:
+            pinned[c.version] = commit
+
+    return pinned
+
+
+def _is_fresh(c, version, fetch_ttl, now, commit=None):
+    """
+    Return a bool indicating whether the version of the given `Config`
+    object was fetched within the given number of seconds, and, when a
+    commit is given, is still at that commit.
+    """
+    if not fetch_ttl:
+        return False
+    fetched = (util.read_json(c.fetch_file) or {}).get(str(version))
+    if not fetched or now - fetched['time'] >= fetch_ttl:
+        return False
+
+    return commit is None or commit == fetched['commit']
+
+
+def _record_fetch(c, versions, commits, now):
+    """
+    Record the given versions of the repository of the `Config` object as
+    fetched now, at the given commits, and return None.
+    """
+    fetched = util.read_json(c.fetch_file) or {}
+    for version in versions:
+        if version in commits:
+            fetched[str(version)] = {'commit': commits[version], 'time': now}
+    util.write_json(c.fetch_file, fetched)
+
+
+def _overlay_config(c, commit=None, copy_jobs=1, shared=(), debug=False):
+    """
+    Materialize the given `Config` object at the given commit and return
+    None.  Skipped when the entry, commit and the destination are all
+    unchanged since the last run.
+
+    :param c: A `Config` object.
+    :param commit: An optional string containing the commit id the version
+     is resolved to.
+    :param copy_jobs: An optional int containing the number of threads to
+     copy files with.  Default is 1.
+    :param shared: An optional list of strings containing the paths other
+     entries write beneath the destination, which do not count as changes
+     to it.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    state = util.read_json(c.state_file) or {}
+    paths = state.get('paths', [])
+    fingerprint = state.get('fingerprint')
+    modified = (fingerprint is not None and
+                fingerprint != util.fingerprint(paths, shared))
+    if (commit and not modified and state.get('commit') == commit and
+            state.get('checksum') == c.checksum):
+        util.print_info('  - skipping ({}) up to date'.format(c.version))
+        return
+
+    # Materializing a version reads objects and never modifies the
+    # repository, so it needs no lock.
+    if c.dst:
+        git.extract(
+            c.src,
+            c.dst,
+            c.version,
+            commit=commit,
+            state_file=c.state_file,
+            strategy=c.copy_strategy,
+            subtree=c.path,
+            include=c.include,
+            exclude=c.exclude,
+            force=modified,
+            debug=debug)
+        paths = [c.dst]
+    else:
+        paths = git.overlay(
+            c.src,
+            c.files,
+            c.version,
+            commit=commit,
+            strategy=c.copy_strategy,
+            jobs=copy_jobs,
+            debug=debug)
+
+    state = util.read_json(c.state_file) or {}
+    state.update({
+        'checksum': c.checksum,
+        'commit': commit,
+        'paths': paths,
+        'fingerprint': util.fingerprint(paths, shared),
+    })
+    util.write_json(c.state_file, state)
+
+
+def _unique(items):
+    """ Return a list of the given items without duplicates, in order. """
+    return list(collections.OrderedDict.fromkeys(items))
 
 
 def _setup(filename):
@@ -83,10 +1503,17 @@ def _setup(filename):
         msg = 'Unable to find {}. Exiting.'.format(filename)
         raise NotFoundError(msg)
 
-    working_dirs = [config._get_lock_dir(), config._get_clone_dir()]
+    working_dirs = [
+        config._get_lock_dir(), config._get_clone_dir(),
+        config._get_state_dir()
+    ]
     for working_dir in working_dirs:
         if not os.path.exists(working_dir):
             os.makedirs(working_dir)
 
 
 cli.add_command(overlay)
+cli.add_command(prefetch)
+cli.add_command(lock)
+cli.add_command(update)
+cli.add_command(cache)
@@ -20,40 +20,326 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
+import collections
 import contextlib
+import ctypes
 import errno
+import fcntl
+import functools
+import hashlib
+import json
 import os
+import pipes
+import re
+import select
 import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
 
 import colorama
 
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 colorama.init(autoreset=True)
 
+_output = threading.local()
+_output_lock = threading.Lock()
+
+# The ways `copy` can write a file.  `auto` and `reflink` clone the file
+# when the filesystem supports it, `hardlink` links to the source, and `copy`
+# reads and writes every byte.  Each falls back to the next cheapest way.
+COPY_STRATEGIES = ('auto', 'reflink', 'hardlink', 'copy')
+# ioctl(2) request sharing the extents of one file with another on Linux.
+_FICLONE = 0x40049409
+_COPY_CHUNK_SIZE = 1 << 30
+# Errors meaning a way of copying is unsupported for the given files, rather
+# than the copy itself failed.
+_UNSUPPORTED_ERRNOS = (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                       errno.EOPNOTSUPP, errno.EXDEV)
+_LINK_ERRNOS = (errno.EMLINK, errno.EPERM, errno.EXDEV)
+
+# Bytes read from the output of a command at a time, and the most of its
+# error output kept to report a failure with.
+_READ_SIZE = 1 << 16
+_STDERR_LIMIT = 1 << 16
+
+# Characters which make a path a pattern.
+GLOB_CHARS = '*?['
+_segment_regexes = {}
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except (OSError, TypeError):  # pragma: no cover
+    _libc = None
+
+
+class CommandError(Exception):
+    """ Error raised when a command exits unsuccessfully. """
+
+    def __init__(self, msg, result):
+        super(CommandError, self).__init__(msg)
+        self.result = result
+
+
+class CommandTimeout(CommandError):
+    """ Error raised when a command is killed after running too long. """
+    pass
+
+
+# The outcome of `run_command`.  `cmd` is the list of arguments run,
+# `exit_code` its exit status, `stdout` and `stderr` what it wrote, and
+# `duration` the seconds it ran for.
+CommandResult = collections.namedtuple('CommandResult',
+                                       'cmd exit_code stdout stderr duration')
+
 
 def print_info(msg):
     """ Print the given message to STDOUT. """
-    print msg
+    _print(msg)
 
 
 def print_warn(msg):
     """ Print the given message to STDOUT in YELLOW. """
-    print '{}{}'.format(colorama.Fore.YELLOW, msg)
+    _print('{}{}'.format(colorama.Fore.YELLOW, msg))
 
 
-def run_command(cmd, debug=False):
+def print_error(msg):
+    """ Print the given message to STDOUT in RED. """
+    _print('{}{}'.format(colorama.Fore.RED, msg))
+
+
+@contextlib.contextmanager
+def buffered_output():
     """
-    Execute the given command and return None.
+    Context manager to hold back messages printed by the current thread, and
+    print them as a single block on exit.  Keeps the output of concurrently
+    processed entries from interleaving.
+    """
+    _output.buffer = []
+    try:
+        yield
+    finally:
+        lines = _output.buffer
+        del _output.buffer
+        with _output_lock:
+            for line in lines:
+                print line
+
 
-    :param cmd: A `sh.Command` object to execute.
+def _print(msg):
+    buf = getattr(_output, 'buffer', None)
+    if buf is not None:
+        buf.append(msg)
+    else:
+        with _output_lock:
+            print msg
+
+
+def run_command(cmd,
+                input=None,
+                env=None,
+                timeout=None,
+                output=None,
+                debug=False):
+    """
+    Execute the given command and return a `CommandResult`.
+
+    Output is read as it is written, so a command never blocks on a full
+    pipe, and only the last 64KiB of its error output is kept.
+
+    :param cmd: A list of strings containing the command and its arguments.
+    :param input: An optional string to write to the standard input of the
+     command.  Default is to give it none.
+    :param env: An optional dict containing the environment of the command.
+     Default is to inherit the environment of gilt.
+    :param timeout: An optional number of seconds after which the command is
+     killed.  Default is no timeout.
+    :param output: An optional callable given each chunk of standard output
+     as it is read, which is then not kept in the result.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: CommandResult
     """
+    cmd = list(cmd)
+    line = ' '.join(pipes.quote(arg) for arg in cmd)
     if debug:
         msg = '  PWD: {}'.format(os.getcwd())
         print_warn(msg)
-        msg = '  COMMAND: {}'.format(cmd)
+        msg = '  COMMAND: {}'.format(line)
+        print_warn(msg)
+
+    start = time.time()
+    stdin = subprocess.PIPE if input is not None else open(os.devnull)
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            close_fds=True)
+    finally:
+        if input is None:
+            stdin.close()
+    stdout = []
+    stderr = ['']
+    on_stdout = stdout.append if output is None else output
+    on_stderr = functools.partial(_append_tail, stderr)
+    deadline = start + timeout if timeout else None
+    try:
+        timed_out = not _communicate(proc, input, on_stdout, on_stderr,
+                                     deadline)
+    except BaseException:
+        _kill(proc)
+        raise
+    if timed_out:
+        _kill(proc)
+    else:
+        proc.wait()
+    duration = time.time() - start
+    result = CommandResult(cmd, proc.returncode, ''.join(stdout), stderr[0],
+                           duration)
+    if debug:
+        msg = '  EXIT: {} ({:.3f}s)'.format(proc.returncode, duration)
+        print_warn(msg)
+
+    if timed_out:
+        msg = '{} timed out after {:.1f}s'.format(line, duration)
+        raise CommandTimeout(msg, result)
+    if proc.returncode:
+        msg = '{} exited {}: {}'.format(line, proc.returncode,
+                                        result.stderr.strip())
+        raise CommandError(msg, result)
+
+    return result
+
+
+def split_records(on_record, separator='\n'):
+    """
+    Return a callable to give as the `output` of `run_command`, which hands
+    each record of the output, ended by the given separator, to the given
+    callable as soon as it is read, so the whole output is never held at
+    once.  Empty records are skipped.
+
+    :param on_record: A callable given each record as a string.
+    :param separator: An optional string ending each record.  Default is a
+     newline.
+    :return: function
+    """
+    rest = ['']
+
+    def output(chunk):
+        records = (rest[0] + chunk).split(separator)
+        rest[0] = records.pop()
+        for record in records:
+            if record:
+                on_record(record)
+
+    return output
+
+
+def start_command(cmd, env=None, debug=False):
+    """
+    Start the given command with pipes to its standard input and output, and
+    return a `subprocess.Popen`, for commands which serve many requests.
+    Its error output is discarded.
+
+    :param cmd: A list of strings containing the command and its arguments.
+    :param env: An optional dict containing the environment of the command.
+     Default is to inherit the environment of gilt.
+    :param debug: An optional bool to toggle debug output.
+    :return: subprocess.Popen
+    """
+    if debug:
+        msg = '  COMMAND: {}'.format(' '.join(pipes.quote(arg) for arg in cmd))
         print_warn(msg)
-    cmd()
+
+    with open(os.devnull, 'wb') as devnull:
+        return subprocess.Popen(
+            list(cmd),
+            bufsize=-1,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            env=env,
+            close_fds=True)
+
+
+def _communicate(proc, input, on_stdout, on_stderr, deadline=None):
+    """
+    Write the given input to the running process, hand what it writes to
+    the given callables until it closes its output, and return True.
+    Returns False when the deadline passes first.
+    """
+    sinks = {
+        proc.stdout.fileno(): (proc.stdout, on_stdout),
+        proc.stderr.fileno(): (proc.stderr, on_stderr),
+    }
+    writers = []
+    if proc.stdin:
+        if input:
+            writers.append(proc.stdin.fileno())
+        else:
+            proc.stdin.close()
+    offset = 0
+    while sinks or writers:
+        remaining = None
+        if deadline:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+        try:
+            readable, writable, _ = select.select(sinks.keys(), writers, [],
+                                                  remaining)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if writable:
+            try:
+                offset += os.write(writers[0],
+                                   input[offset:offset + select.PIPE_BUF])
+            except OSError as e:
+                # The command exited without reading all of its input.
+                if e.errno != errno.EPIPE:
+                    raise
+                offset = len(input)
+            if offset >= len(input):
+                writers = []
+                proc.stdin.close()
+        for fd in readable:
+            data = os.read(fd, _READ_SIZE)
+            f, sink = sinks[fd]
+            if data:
+                sink(data)
+            else:
+                f.close()
+                del sinks[fd]
+
+    return True
+
+
+def _append_tail(buf, data):
+    """ Append data to the string held by a list, keeping its tail. """
+    buf[0] = (buf[0] + data)[-_STDERR_LIMIT:]
+
+
+def _kill(proc):
+    """ Kill the given process if it is still running, and reap it. """
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+    for f in (proc.stdin, proc.stdout, proc.stderr):
+        if f and not f.closed:
+            f.close()
 
 
 @contextlib.contextmanager
@@ -66,7 +352,7 @@ def saved_cwd():
         os.chdir(saved)
 
 
-def copy(src, dst):
+def copy(src, dst, strategy='auto', ignore=None):
     """
     Handle the copying of a file or directory.
 
@@ -76,12 +362,473 @@ def copy(src, dst):
      source ends with a '/', will become a recursive directory copy of source.
     :param dst: A string containing the path to the destination.  If the
      destination ends with a '/', will copy into the target directory.
+    :param strategy: An optional string containing one of `COPY_STRATEGIES`
+     to write each file with.  Default is `auto`.
+    :param ignore: An optional callable, which is given the path of each file
+     and directory beneath a source directory, and returns True to skip it.
     :return: None
     """
     try:
-        shutil.copytree(src, dst)
+        _copytree(src, dst, strategy, ignore)
     except OSError as exc:
         if exc.errno == errno.ENOTDIR:
-            shutil.copy(src, dst)
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            copy_file(src, dst, strategy)
         else:
             raise
+
+
+def _copytree(src, dst, strategy, ignore=None):
+    """ Recursively copy a directory like `shutil.copytree`. """
+    names = os.listdir(src)
+    os.makedirs(dst)
+    for name in names:
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        if ignore is not None and ignore(srcname):
+            continue
+        if os.path.isdir(srcname):
+            _copytree(srcname, dstname, strategy, ignore)
+        else:
+            copy_file(srcname, dstname, strategy)
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, strategy='auto'):
+    """
+    Copy the contents and mode of the given file, following symlinks, and
+    return None.
+
+    Unless the strategy is `copy`, the file is cloned when the filesystem
+    supports reflinks, and otherwise copied by the kernel with
+    `copy_file_range` or `sendfile`, before falling back to copying through
+    userspace.  With `hardlink`, the destination is first linked to the
+    source, and shares its contents from then on.  An existing destination
+    is replaced rather than written to, so a file it is linked to is never
+    modified.
+
+    :param src: A string containing the path to the file to copy.
+    :param dst: A string containing the path to the destination file.
+    :param strategy: An optional string containing one of `COPY_STRATEGIES`.
+     Default is `auto`.
+    :return: None
+    """
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.remove(dst)
+    if strategy == 'hardlink' and _link(src, dst):
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if strategy == 'copy' or not (_reflink(fsrc, fdst) or _copy_file_range(
+                fsrc, fdst) or _sendfile(fsrc, fdst)):
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copymode(src, dst)
+
+
+def _link(src, dst):
+    """ Hardlink dst to src and return a bool indicating success. """
+    try:
+        os.link(os.path.realpath(src), dst)
+    except OSError as exc:
+        if exc.errno in _LINK_ERRNOS:
+            return False
+        raise
+
+    return True
+
+
+def _reflink(fsrc, fdst):
+    """ Clone the open file fsrc into fdst and return a bool. """
+    if not sys.platform.startswith('linux'):  # pragma: no cover
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except (IOError, OSError) as exc:
+        if exc.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+
+    return True
+
+
+def _copy_file_range(fsrc, fdst):
+    """ Copy the open file fsrc into fdst in the kernel and return a bool. """
+    func = _get_libc_function('copy_file_range', [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint
+    ])
+    if func is None:
+        return False
+
+    return _kernel_copy(lambda: func(fsrc.fileno(), None, fdst.fileno(), None,
+                                     _COPY_CHUNK_SIZE, 0))
+
+
+def _sendfile(fsrc, fdst):
+    """ Copy the open file fsrc into fdst in the kernel and return a bool. """
+    func = _get_libc_function('sendfile', [
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t
+    ])
+    if func is None:
+        return False
+
+    return _kernel_copy(
+        lambda: func(fdst.fileno(), fsrc.fileno(), None, _COPY_CHUNK_SIZE))
+
+
+def _get_libc_function(name, argtypes):
+    """ Return the named libc function, or None when it is missing. """
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = ctypes.c_ssize_t
+
+    return func
+
+
+def _kernel_copy(call):
+    """
+    Repeat the given call, which copies the next chunk of a file and returns
+    the number of bytes copied, until it returns 0, and return a bool
+    indicating whether the call is supported.
+    """
+    copied = 0
+    while True:
+        n = call()
+        if n > 0:
+            copied += n
+        elif n == 0:
+            return True
+        else:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if not copied and err in _UNSUPPORTED_ERRNOS:
+                return False
+            raise OSError(err, os.strerror(err))
+
+
+def is_glob(pattern):
+    """ Return a bool indicating whether the given path is a pattern. """
+    return any(c in pattern for c in GLOB_CHARS)
+
+
+def iglob(root, pattern, exclude=(), listdir=None):
+    """
+    Return a generator of the paths beneath the given directory which match
+    the pattern, and no exclude pattern, in sorted order.
+
+    Patterns are relative to the directory.  `*` matches any part of a name,
+    `?` any one character and `[...]` any character of a class.  A `**`
+    component matches zero or more directories, and everything beneath a
+    directory when it ends the pattern.  As with `glob.glob`, wildcards do
+    not match names starting with a '.'.
+
+    Directories are listed once each, and only when some path beneath them
+    may still match.  Excluded directories are never descended into.
+
+    :param root: A string containing the path to the directory to search.
+    :param pattern: A string containing the pattern to match.
+    :param exclude: An optional list of strings containing patterns of paths
+     to leave out.
+    :param listdir: An optional callable, which is given the path of a
+     directory and returns a sorted list of (name, is_dir) tuples for its
+     entries, to search something other than the filesystem.
+    :return: generator
+    """
+    segments = _split_pattern(pattern)
+    positions = _closure(segments, [0]) - set([len(segments)])
+    if not positions:
+        return iter([])
+
+    return _iglob(root, '', segments, positions,
+                  get_pattern_matcher(exclude), listdir)
+
+
+def get_pattern_matcher(patterns, parents=True):
+    """
+    Return a callable, which is given a path and returns a bool indicating
+    whether it matches any of the given patterns, or is beneath a directory
+    which does.  See `iglob` for the syntax of patterns.
+
+    :param patterns: A list of strings containing patterns.
+    :param parents: An optional bool to also match paths beneath a matching
+     directory.  Default is True.
+    :return: callable
+    """
+    regexes = [_compile_pattern(p) for p in patterns]
+    if not regexes:
+        return lambda path: False
+
+    def matcher(path):
+        path = path.replace(os.sep, '/')
+        while path and path not in ('.', '/'):
+            if any(r.match(path) for r in regexes):
+                return True
+            if not parents:
+                break
+            path = os.path.dirname(path)
+        return False
+
+    return matcher
+
+
+def _iglob(root, path, segments, positions, excluded, listdir=None):
+    """
+    Yield the paths in the given directory which match the pattern, after
+    reaching the given positions in its segments, and recurse into any
+    directory which may contain more.
+    """
+    end = len(segments)
+    dirname = os.path.join(root, path)
+    if listdir is not None:
+        entries = listdir(dirname)
+    elif not any(is_glob(segments[p]) for p in positions):
+        # Only literal names can match, so look them up rather than listing
+        # the whole directory.
+        entries = []
+        for name in sorted(set(segments[p] for p in positions)):
+            try:
+                st = os.lstat(os.path.join(dirname, name))
+            except OSError:
+                continue
+            entries.append((name, stat.S_ISDIR(st.st_mode)))
+    else:
+        entries = _list_dir(dirname)
+
+    for name, is_dir in entries:
+        relpath = os.path.join(path, name)
+        if excluded(relpath):
+            continue
+        reached = set()
+        for p in positions:
+            if segments[p] == '**':
+                if is_dir and _match_segment('*', name):
+                    reached.add(p)
+            elif _match_segment(segments[p], name):
+                reached.add(p + 1)
+        if end in reached:
+            yield os.path.join(root, relpath)
+        reached = _closure(segments, reached) - set([end])
+        if is_dir and reached:
+            for match in _iglob(root, relpath, segments, reached, excluded,
+                                listdir):
+                yield match
+
+
+def _list_dir(dirname):
+    """
+    Return a sorted list of (name, is_dir) tuples for the entries of the
+    given directory, where a symlink is never a directory.
+    """
+    try:
+        if _scandir is not None:
+            return sorted((e.name, e.is_dir(follow_symlinks=False))
+                          for e in _scandir(dirname))
+        names = os.listdir(dirname)
+    except OSError:
+        return []
+
+    entries = []
+    for name in names:
+        try:
+            mode = os.lstat(os.path.join(dirname, name)).st_mode
+        except OSError:
+            # Removed since it was listed.
+            continue
+        entries.append((name, stat.S_ISDIR(mode)))
+
+    return sorted(entries)
+
+
+def _split_pattern(pattern):
+    """ Return the segments of the given pattern as a list. """
+    segments = [s for s in pattern.split('/') if s not in ('', '.')]
+    if segments and segments[-1] == '**':
+        # Everything beneath is the same as anything at any depth beneath.
+        segments.append('*')
+
+    return segments
+
+
+def _closure(segments, positions):
+    """ Add the positions reached by a `**` matching nothing to a set. """
+    result = set()
+    for p in positions:
+        result.add(p)
+        while p < len(segments) and segments[p] == '**':
+            p += 1
+            result.add(p)
+
+    return result
+
+
+def _match_segment(segment, name):
+    """ Return a bool indicating whether the name matches the segment. """
+    if not is_glob(segment):
+        return segment == name
+    if name.startswith('.') and not segment.startswith('.'):
+        return False
+    regex = _segment_regexes.get(segment)
+    if regex is None:
+        regex = re.compile(_translate(segment) + r'\Z')
+        _segment_regexes[segment] = regex
+
+    return bool(regex.match(name))
+
+
+def _compile_pattern(pattern):
+    """ Return a regex matching paths against the whole pattern. """
+    segments = _split_pattern(pattern)
+    parts = []
+    for i, segment in enumerate(segments):
+        if segment == '**':
+            parts.append('(?:[^/]+/)*')
+        else:
+            parts.append(_translate(segment))
+            if i < len(segments) - 1:
+                parts.append('/')
+
+    return re.compile(''.join(parts) + r'\Z')
+
+
+def _translate(segment):
+    """ Return a regex for a segment of a pattern as a str. """
+    i, n = 0, len(segment)
+    result = []
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and segment[j] in '!^':
+                j += 1
+            if j < n and segment[j] == ']':
+                j += 1
+            while j < n and segment[j] != ']':
+                j += 1
+            if j >= n:
+                result.append(re.escape(c))
+            else:
+                chars = segment[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                result.append('[{}]'.format(chars))
+        else:
+            result.append(re.escape(c))
+
+    return ''.join(result)
+
+
+def fingerprint(paths, exclude=()):
+    """
+    Return a str summarizing the type, size and modification time of the
+    given paths and everything beneath them.  It changes whenever a file is
+    added, removed or modified, without reading any file contents.
+
+    Directories are summarized by their type alone, as the entries within
+    them are walked, so writing the excluded paths leaves it unchanged.
+
+    :param paths: A list of strings containing paths to files or directories.
+    :param exclude: An optional list of strings containing paths to leave
+     out, along with everything beneath them.
+    :return: str
+    """
+    exclude = frozenset(os.path.normpath(path) for path in exclude)
+    h = hashlib.sha1()
+    for path in paths:
+        for filename in _walk(path, exclude):
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                h.update('{}\0missing\0'.format(filename))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                h.update('{}\0{}\0'.format(filename, st.st_mode))
+                continue
+            h.update('{}\0{}\0{}\0{}\0'.format(filename, st.st_mode,
+                                               st.st_size, st.st_mtime))
+
+    return h.hexdigest()
+
+
+def get_disk_usage(path):
+    """
+    Return the bytes the given path and everything beneath it take on disk,
+    as an int, without following symlinks.
+
+    :param path: A string containing a path to a file or directory.
+    :return: int
+    """
+    total = 0
+    for filename in _walk(path):
+        try:
+            total += os.lstat(filename).st_blocks * 512
+        except OSError:
+            pass
+
+    return total
+
+
+def _walk(path, exclude=frozenset()):
+    path = os.path.normpath(path)
+    if path in exclude:
+        return
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            if exclude:
+                dirs[:] = [
+                    name for name in dirs
+                    if os.path.join(root, name) not in exclude
+                ]
+                files = [
+                    name for name in files
+                    if os.path.join(root, name) not in exclude
+                ]
+            dirs.sort()
+            for name in sorted(dirs + files):
+                yield os.path.join(root, name)
+
+
+def read_json(filename):
+    """
+    Load the given JSON file and return its contents, or None when the file
+    is missing or unreadable.
+
+    :param filename: A string containing the path to the file.
+    :return: object
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(filename, data, indent=None):
+    """
+    Atomically replace the given file with the JSON encoded data and return
+    None.
+
+    :param filename: A string containing the path to the file.
+    :param data: An object to encode.
+    :param indent: An optional int to write the data indented by, with
+     sorted keys, for files meant to be read and diffed.
+    :return: None
+    """
+    tmp_filename = '{}.{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        if indent:
+            json.dump(
+                data, f, indent=indent, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        else:
+            json.dump(data, f)
+    os.rename(tmp_filename, filename)
@@ -26,6 +26,7 @@ import shutil
 import string
 
 import pytest
+import sh
 
 pytest_plugins = ['helpers_namespace']
 
@@ -77,6 +78,32 @@ def gilt_data():
     }]
 
 
+@pytest.fixture()
+def git_repository(tmpdir):
+    """
+    Create a local repository and return its path.  The first commit is
+    tagged `v1`, and a second commit on master removes `baz_manage`.
+    """
+    d = tmpdir.mkdir('upstream')
+    git = sh.git.bake('-C', d.strpath, '-c', 'user.name=gilt', '-c',
+                      'user.email=gilt@gilt')
+    git.init()
+    d.join('README').write('one')
+    d.ensure('roles', 'foo', 'tasks', 'main.yml').write('main')
+    d.ensure('tests', 'test_foo.py')
+    for f in ['foo_manage', 'bar_manage', 'baz_manage']:
+        d.join(f).write(f)
+    git.add('--all')
+    git.commit(message='one')
+    git.tag('v1')
+    d.join('README').write('two')
+    d.join('baz_manage').remove()
+    git.add('--all')
+    git.commit(message='two')
+
+    return d.strpath
+
+
 @pytest.helpers.register
 def os_split(s):
     rest, tail = os.path.split(s)
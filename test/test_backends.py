@@ -0,0 +1,213 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import os
+import stat
+import sys
+
+import pytest
+import sh
+
+from gilt import backends
+from gilt import git
+
+dulwich = pytest.importorskip('dulwich')
+
+
+@pytest.fixture()
+def clone_dir(temp_dir, git_repository):
+    """
+    Add an executable and a symlink to the upstream repository, and return
+    the path to a clone of it.
+    """
+    run = os.path.join(git_repository, 'run.sh')
+    with open(run, 'w') as f:
+        f.write('run')
+    os.chmod(run, 0755)
+    os.symlink('README', os.path.join(git_repository, 'link'))
+    upstream = sh.git.bake('-C', git_repository, '-c', 'user.name=gilt', '-c',
+                           'user.email=gilt@gilt')
+    upstream.add('--all')
+    upstream.commit(message='three')
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+
+    return clone_dir
+
+
+def test_batch_check_matches_cli(clone_dir):
+    cli = backends.CliBackend()
+    commit = cli.batch_check(clone_dir, ['master^{commit}'])[0][0]
+    names = [
+        'master^{commit}', 'refs/heads/master', 'refs/tags/v1^{commit}',
+        'v1^{commit}', 'v1^{tree}', '{}^{{commit}}'.format(commit),
+        '{}^{{commit}}'.format(commit[:7]), '{}:roles'.format(commit),
+        '{}:README'.format(commit), '{}:missing'.format(commit),
+        'missing^{commit}', 'deadbeef^{commit}'
+    ]
+
+    x = cli.batch_check(clone_dir, names)
+    assert x == backends.DulwichBackend().batch_check(clone_dir, names)
+
+
+def test_batch_check_falls_back_for_abbreviated_ids(mocker, clone_dir):
+    spy = mocker.spy(backends.CliBackend, 'batch_check')
+    backend = backends.DulwichBackend()
+    backend.batch_check(clone_dir, ['master^{commit}'])
+
+    assert not spy.called
+
+    backend.batch_check(clone_dir, ['master^{commit}', 'abc1234^{commit}'])
+
+    assert ['abc1234^{commit}'] == spy.call_args[0][2]
+
+
+def test_read_tree_checkout(temp_dir, clone_dir):
+    backend = backends.DulwichBackend()
+    dst_dir = os.path.join(temp_dir.strpath, 'dst')
+    with backend.read_tree(clone_dir, 'master^{tree}') as tree:
+        assert isinstance(tree, backends._DulwichTree)
+        x = ['README', 'link', 'run.sh']
+        assert x == tree.ls_files([':(literal)README', ':(glob)[lr]*'])
+        tree.checkout(dst_dir)
+
+    assert 'two' == open(os.path.join(dst_dir, 'README')).read()
+    assert 'README' == os.readlink(os.path.join(dst_dir, 'link'))
+    assert os.stat(os.path.join(dst_dir, 'run.sh')).st_mode & stat.S_IXUSR
+    x = os.path.join(dst_dir, 'roles', 'foo', 'tasks', 'main.yml')
+    assert os.path.exists(x)
+
+
+def test_diff_tree_matches_cli(clone_dir):
+    args = (clone_dir, 'v1^{tree}', 'master^{tree}')
+    pathspecs = [':(glob)**', ':(exclude,glob)*.sh']
+    cli = backends.CliBackend()
+    dulwich_backend = backends.DulwichBackend()
+
+    x = sorted(cli.diff_tree(*args))
+    assert x == sorted(dulwich_backend.diff_tree(*args))
+    x = sorted(cli.diff_tree(*args, pathspecs=pathspecs))
+    assert x == sorted(dulwich_backend.diff_tree(*args, pathspecs=pathspecs))
+
+
+def test_ls_tree_matches_cli(clone_dir):
+    cli = backends.CliBackend()
+    result = cli.ls_tree(clone_dir, 'master^{tree}')
+
+    assert (0120000, 'link') == [(m, p) for m, _, p in result
+                                 if p == 'link'][0]
+    assert ('roles', 'roles/foo') == tuple(p for m, _, p in result
+                                           if stat.S_ISDIR(m))[:2]
+    x = sorted(result)
+    assert x == sorted(backends.DulwichBackend().ls_tree(clone_dir,
+                                                         'master^{tree}'))
+
+
+@pytest.mark.parametrize('backend', [
+    backends.CliBackend(),
+    backends.DulwichBackend(),
+])
+def test_open_objects(mocker, temp_dir, clone_dir, backend):
+    entries = dict(
+        (p, sha) for _, sha, p in backend.ls_tree(clone_dir, 'master^{tree}'))
+    spy = mocker.spy(backends.util, 'start_command')
+    with backend.open_objects(clone_dir) as objects:
+        assert 'README' == objects.read(entries['link'])
+        with open(os.path.join(temp_dir.strpath, 'README'), 'wb') as f:
+            objects.copy(entries['README'], f)
+        assert 'two' == objects.read(entries['README'])
+        with pytest.raises(backends.BackendError):
+            objects.read('0' * 40)
+        assert 'run' == objects.read(entries['run.sh'])
+
+    assert 'two' == open(os.path.join(temp_dir.strpath, 'README')).read()
+    # One process serves every read, until a failed read stops it.
+    assert spy.call_count <= 2
+
+
+def test_write_entry(temp_dir, clone_dir):
+    backend = backends.CliBackend()
+    entries = dict(
+        (p, (mode, sha))
+        for mode, sha, p in backend.ls_tree(clone_dir, 'master^{tree}'))
+    with backend.open_objects(clone_dir) as objects:
+        for name in ['link', 'run.sh', 'README']:
+            path = os.path.join(temp_dir.strpath, name)
+            backends.write_entry(objects, path, *entries[name])
+
+    assert 'README' == os.readlink(os.path.join(temp_dir.strpath, 'link'))
+    x = os.stat(os.path.join(temp_dir.strpath, 'run.sh')).st_mode
+    assert x & stat.S_IXUSR
+    x = os.stat(os.path.join(temp_dir.strpath, 'README')).st_mode
+    assert not x & stat.S_IXUSR
+
+
+def test_partial_clone_uses_cli(clone_dir):
+    sh.git('-C', clone_dir, 'config', 'extensions.partialclone', 'origin')
+    backend = backends.DulwichBackend()
+    with backend.read_tree(clone_dir, 'master^{tree}') as tree:
+        assert isinstance(tree, backends._CliTree)
+
+
+def test_dulwich_reuses_repo_until_git_rewrites_it(mocker, clone_dir):
+    backend = backends.DulwichBackend()
+    repo = backend._open(clone_dir)
+    assert repo is backend._open(clone_dir)
+    before = backend.batch_check(clone_dir, ['master^{commit}'])
+
+    # Packed refs are read once by dulwich, so a repo reading them must be
+    # replaced once git rewrites them.
+    sh.git('-C', clone_dir, 'update-ref', 'refs/heads/master', 'master^')
+    sh.git('-C', clone_dir, 'pack-refs', '--all')
+    x = backends.CliBackend().batch_check(clone_dir, ['master^{commit}'])
+    assert x == backend.batch_check(clone_dir, ['master^{commit}'])
+    assert before != x
+    replacement = backend._open(clone_dir)
+    assert repo is not replacement
+
+    for r in [repo, replacement]:
+        mocker.patch.object(r, 'close')
+    backend.close()
+    repo.close.assert_called_once_with()
+    replacement.close.assert_called_once_with()
+
+
+def test_get_pathspec_matcher():
+    matcher = backends._get_pathspec_matcher([
+        ':(literal)roles', ':(glob)docs', ':(glob)*.yml',
+        ':(exclude,glob)**/tests/**'
+    ])
+
+    assert matcher('roles/foo/main.yml')
+    assert matcher('docs/index.rst')
+    assert matcher('site.yml')
+    assert not matcher('other/site.yml')
+    assert not matcher('roles/foo/tests/main.yml')
+    assert not matcher('rolesx')
+    assert backends._get_pathspec_matcher([])('anything')
+
+
+def test_get_backend_without_dulwich(mocker):
+    mocker.patch.dict(sys.modules, {'dulwich.repo': None})
+
+    with pytest.raises(backends.BackendError):
+        backends.get_backend('dulwich')
@@ -40,8 +40,20 @@ def test_config(gilt_config_file):
     assert ('.gilt', 'clone', 'retr0h.ansible-etcd') == os_split(r.src)[-3:]
     assert ('.gilt', 'lock', 'retr0h.ansible-etcd'
             ) == os_split(r.lock_file)[-3:]
+    assert ('.gilt', 'lock', 'retr0h.ansible-etcd.fetched'
+            ) == os_split(r.fetch_file)[-3:]
     assert ('roles', 'retr0h.ansible-etcd', '') == os_split(r.dst)[-3:]
     assert [] == r.files
+    assert r.depth is None
+    assert r.filter is None
+    assert r.single_branch is None
+    assert r.pool is None
+    assert r.pool_lock_file is None
+    assert r.copy_strategy is None
+    assert r.path is None
+    assert [] == r.include
+    assert [] == r.exclude
+    assert ('.gilt', 'state') == os_split(r.state_file)[-3:-1]
 
     r = result[1]
     assert 'https://github.com/lorin/openstack-ansible-modules.git' == r.git
@@ -49,9 +61,11 @@ def test_config(gilt_config_file):
     assert 'lorin.openstack-ansible-modules' == r.name
     assert 'lorin.openstack-ansible-modules' == os_split(r.src)[-1]
     assert r.dst is None
+    assert ('.gilt', 'state') == os_split(r.state_file)[-3:-1]
+    assert r.state_file != result[0].state_file
+    assert r.checksum != result[0].checksum
     f = r.files[0]
-    x = ('.gilt', 'clone', 'lorin.openstack-ansible-modules', '*_manage')
-    assert x == os_split(f.src)[-4:]
+    assert '*_manage' == f.src
     assert ('library', '') == os_split(f.dst)[-2:]
 
 
@@ -101,6 +115,85 @@ def test_config_missing_dst_key(gilt_config_file):
         config.config(gilt_config_file)
 
 
+@pytest.fixture()
+def invalid_copy_strategy_data():
+    return [{
+        'git': 'https://github.com/retr0h/ansible-etcd.git',
+        'version': 'master',
+        'dst': 'roles/retr0h.ansible-etcd/',
+        'copy_strategy': 'foo'
+    }]
+
+
+@pytest.mark.parametrize(
+    'gilt_config_file', ['invalid_copy_strategy_data'],
+    indirect=['gilt_config_file'])
+def test_config_invalid_copy_strategy(gilt_config_file):
+    with pytest.raises(config.ParseError):
+        config.config(gilt_config_file)
+
+
+@pytest.fixture()
+def object_pool_data():
+    return [{
+        'git': 'https://github.com/retr0h/ansible-etcd.git',
+        'version': 'master',
+        'dst': 'roles/retr0h.ansible-etcd/',
+        'object_pool': 'etcd'
+    }]
+
+
+@pytest.mark.parametrize(
+    'gilt_config_file', ['object_pool_data'], indirect=['gilt_config_file'])
+def test_config_object_pool(gilt_config_file):
+    result = config.config(gilt_config_file)
+    os_split = pytest.helpers.os_split
+
+    r = result[0]
+    assert ('.gilt', 'pool', 'etcd') == os_split(r.pool)[-3:]
+    assert ('lock', 'pool', 'etcd') == os_split(r.pool_lock_file)[-3:]
+
+
+@pytest.fixture()
+def shared_dst_data():
+    return [{
+        'git': 'https://github.com/retr0h/ansible-etcd.git',
+        'version': 'master',
+        'dst': 'roles/shared/'
+    }, {
+        'git': 'https://github.com/lorin/openstack-ansible-modules.git',
+        'version': 'master',
+        'dst': 'roles/shared/'
+    }]
+
+
+@pytest.mark.parametrize(
+    'gilt_config_file', ['shared_dst_data'], indirect=['gilt_config_file'])
+def test_config_state_file_per_repository(gilt_config_file):
+    result = config.config(gilt_config_file)
+
+    assert result[0].dst == result[1].dst
+    assert result[0].state_file != result[1].state_file
+
+
+@pytest.fixture()
+def invalid_object_pool_data():
+    return [{
+        'git': 'https://github.com/retr0h/ansible-etcd.git',
+        'version': 'master',
+        'dst': 'roles/retr0h.ansible-etcd/',
+        'object_pool': '../etcd'
+    }]
+
+
+@pytest.mark.parametrize(
+    'gilt_config_file', ['invalid_object_pool_data'],
+    indirect=['gilt_config_file'])
+def test_config_invalid_object_pool(gilt_config_file):
+    with pytest.raises(config.ParseError):
+        config.config(gilt_config_file)
+
+
 @pytest.fixture()
 def missing_files_src_key_data():
     return [{
@@ -152,10 +245,12 @@ def test_get_config_generator(gilt_config_file):
 
 def test_get_files_generator(temp_dir):
     files_list = [{'src': 'foo', 'dst': 'bar/'}]
-    result = [i for i in config._get_files_generator('/tmp/dir', files_list)]
+    result = [i for i in config._get_files_generator(files_list)]
 
     assert isinstance(result, list)
     assert isinstance(result[0], dict)
+    assert 'foo' == result[0]['src']
+    assert [] == result[0]['exclude']
 
 
 @pytest.mark.parametrize(
@@ -186,6 +281,34 @@ def test_get_dst_dir(temp_dir):
     assert os.path.join(temp_dir.strpath, 'roles', 'foo') == result
 
 
+def test_get_checksum(temp_dir):
+    files_config = config._get_files_config([{'src': 'foo', 'dst': 'bar/'}])
+    result = config._get_checksum('repo', 'master', None, files_config)
+
+    assert 40 == len(result)
+    assert result == config._get_checksum('repo', 'master', None, files_config)
+    assert result != config._get_checksum('repo', 'v1', None, files_config)
+    assert result != config._get_checksum('repo', 'master', '/dst/', [])
+
+    filters = {'path': None, 'include': [], 'exclude': []}
+    result = config._get_checksum('repo', 'master', '/dst/', [])
+    assert result == config._get_checksum('repo', 'master', '/dst/', [],
+                                          filters)
+    filters['exclude'] = ['tests']
+    assert result != config._get_checksum('repo', 'master', '/dst/', [],
+                                          filters)
+    assert result != config._get_checksum('repo', 'master', '/dst/', [], None,
+                                          'hardlink')
+
+
+def test_get_state_file():
+    result = config._get_state_file('/foo/bar/')
+    parts = pytest.helpers.os_split(result)
+
+    assert ('.gilt', 'state') == parts[-3:-1]
+    assert result != config._get_state_file('/foo/baz/')
+
+
 def test_get_clone_dir():
     parts = pytest.helpers.os_split(config._get_clone_dir())
 
@@ -231,3 +354,26 @@ def test_makedirs_passes_if_exists(temp_dir):
 def test_makedirs_raises(temp_dir):
     with pytest.raises(OSError):
         config._makedirs('')
+
+
+def test_get_lockfile():
+    assert '/foo/gilt.lock' == config.get_lockfile('/foo/gilt.yml')
+
+
+def test_lockfile_round_trips(temp_dir):
+    filename = temp_dir.join('gilt.lock').strpath
+    pins = {'https://example.com/a.git': {'master': 'abc'}}
+    config.write_lockfile(filename, pins)
+
+    assert pins == config.read_lockfile(filename)
+
+
+def test_read_lockfile_handles_missing_file(temp_dir):
+    assert {} == config.read_lockfile(temp_dir.join('gilt.lock').strpath)
+
+
+def test_read_lockfile_raises_on_invalid_lockfile(temp_dir):
+    filename = temp_dir.join('gilt.lock')
+    filename.write('[]')
+    with pytest.raises(config.ParseError):
+        config.read_lockfile(filename.strpath)
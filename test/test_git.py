@@ -22,11 +22,14 @@
 
 import glob
 import os
+import shutil
 
 import pytest
 import sh
 
+from gilt import backends
 from gilt import git
+from gilt import util
 
 slow = pytest.mark.skipif(
     not pytest.config.getoption("--runslow"),
@@ -81,13 +84,12 @@ def test_overlay(mocker, temp_dir):
 
     # yapf: disable
     files = [
-        mocker.Mock(src=os.path.join(clone_dir, '*_manage'), dst=dst_dir),
-        mocker.Mock(src=os.path.join(clone_dir, 'nova_quota'), dst=dst_dir),
-        mocker.Mock(src=os.path.join(clone_dir, 'neutron_router'),
+        mocker.Mock(exclude=[], src='*_manage', dst=dst_dir),
+        mocker.Mock(exclude=[], src='nova_quota', dst=dst_dir),
+        mocker.Mock(exclude=[], src='neutron_router',
                     dst=os.path.join(dst_dir, 'neutron_router.py')),
-        mocker.Mock(
-            src=os.path.join(clone_dir, 'tests'),
-            dst=os.path.join(dst_dir, 'tests'))
+        mocker.Mock(exclude=[], src='tests',
+                    dst=os.path.join(dst_dir, 'tests'))
     ]
     # yapf: enable
     git.clone(name, repo, clone_dir)
@@ -113,8 +115,7 @@ def test_overlay_existing_directory(mocker, temp_dir):
 
     files = [
         mocker.Mock(
-            src=os.path.join(clone_dir, 'tests'),
-            dst=os.path.join(dst_dir, 'tests'))
+            exclude=[], src='tests', dst=os.path.join(dst_dir, 'tests'))
     ]
     git.clone(name, repo, clone_dir)
     git.overlay(clone_dir, files, branch)
@@ -122,47 +123,949 @@ def test_overlay_existing_directory(mocker, temp_dir):
     assert 2 == len(glob.glob('{}/*'.format(os.path.join(dst_dir, 'tests'))))
 
 
+@pytest.fixture(params=['cli', 'dulwich'])
+def git_backend(request):
+    if request.param == 'dulwich':
+        pytest.importorskip('dulwich')
+    git.set_backend(request.param)
+    yield request.param
+    git.set_backend('cli')
+
+
 @pytest.fixture()
 def patched_run_command(mocker):
     return mocker.patch('gilt.util.run_command')
 
 
-def test_get_branch(mocker, patched_run_command):
-    git._get_branch('branch')
-    # yapf: disable
+def test_fetch(mocker, patched_run_command):
+    git.fetch('/repo')
     expected = [
-        mocker.call(sh.git.bake('fetch'), debug=False),
-        mocker.call(sh.git.bake('checkout', 'branch'), debug=False),
-        mocker.call(sh.git.bake('clean', '-d', '-x', '-f'), debug=False),
-        mocker.call(sh.git.bake('pull', rebase=True, ff_only=True),
-                    debug=False)
+        mocker.call(
+            ['git', '-C', '/repo', 'fetch'],
+            timeout=backends.NETWORK_TIMEOUT,
+            debug=False)
     ]
-    # yapf: enable
 
     assert expected == patched_run_command.mock_calls
 
 
-def test_get_branch_does_not_pull_on_sha(mocker, patched_run_command):
-    git._get_branch('e14ebe0')
-    # yapf: disable
+def test_fetch_versions(mocker, patched_run_command):
+    mocker.patch(
+        'gilt.git._read_ref_types',
+        return_value={'master': 'branch',
+                      'v1': 'tag'})
+    git.fetch('/repo', versions=['master', 'v1', 'v2'], depth=1)
+    cmd = [
+        'git', '-C', '/repo', 'fetch', '--depth=1', '--no-tags', 'origin',
+        '+refs/heads/master:refs/heads/master', '+refs/tags/v1:refs/tags/v1',
+        'v2'
+    ]
     expected = [
-        mocker.call(sh.git.bake('fetch'), debug=False),
-        mocker.call(sh.git.bake('checkout', 'e14ebe0'), debug=False),
-        mocker.call(sh.git.bake('clean', '-d', '-x', '-f'), debug=False)
+        mocker.call(
+            cmd, timeout=backends.NETWORK_TIMEOUT, debug=False)
     ]
-    # yapf: enable
 
     assert expected == patched_run_command.mock_calls
 
 
-def test_get_branch_handles_int_sha(mocker, patched_run_command):
-    git._get_branch(1234567)
-    # yapf: disable
+def test_fetch_versions_falls_back_to_all_refs(mocker, patched_run_command):
+    patched_run_command.side_effect = [
+        git.util.CommandError('boom', None), None
+    ]
+    git.fetch('/repo', versions=['abc1234'])
+    x = mocker.call(
+        ['git', '-C', '/repo', 'fetch'],
+        timeout=backends.NETWORK_TIMEOUT,
+        debug=False)
+
+    assert x == patched_run_command.mock_calls[-1]
+    assert 2 == patched_run_command.call_count
+
+
+def test_fetch_versions_does_not_fall_back_after_timeout(mocker,
+                                                         patched_run_command):
+    patched_run_command.side_effect = git.util.CommandTimeout('slow', None)
+    with pytest.raises(git.util.CommandTimeout):
+        git.fetch('/repo', versions=['abc1234'])
+
+    assert 1 == patched_run_command.call_count
+
+
+def test_fetch_uses_network_timeout(mocker, patched_run_command):
+    mocker.patch('gilt.backends._network_timeout', 90)
+    git.fetch('/repo')
+
+    assert 90 == patched_run_command.call_args[1]['timeout']
+
+
+def test_fetch_versions_only_fetches_their_refs(temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    upstream = sh.git.bake('-C', git_repository, '-c', 'user.name=gilt', '-c',
+                           'user.email=gilt@gilt')
+    upstream.commit(message='three', allow_empty=True)
+    upstream.tag('v2')
+    upstream.branch('other')
+    assert {'master': 'branch'} == git.get_ref_types(clone_dir, ['master'])
+    git.fetch(clone_dir, versions=['master'])
+
+    x = git._get_commit(clone_dir, 'master')
+    assert x == str(upstream('rev-parse', 'master')).strip()
+    assert {
+        'v2': None,
+        'other': None
+    } == git.get_ref_types(clone_dir, ['v2', 'other'])
+
+    git.fetch(clone_dir, versions=['v2'])
+    assert {
+        'v2': 'tag',
+        'other': None
+    } == git.get_ref_types(clone_dir, ['v2', 'other'])
+
+
+def test_clone_options(mocker, patched_run_command):
+    patched_run_command.return_value.stdout = 'refs/heads/master\n'
+    git.clone(
+        'upstream',
+        '/upstream',
+        '/clone',
+        depth=1,
+        filter='blob:none',
+        single_branch=True)
+    cmd = [
+        'git', 'clone', '--bare', '/upstream', '/clone', '--depth=1',
+        '--filter=blob:none', '--single-branch'
+    ]
+    git_config = ['git', '-C', '/clone', 'config', '--replace-all']
     expected = [
-        mocker.call(sh.git.bake('fetch'), debug=False),
-        mocker.call(sh.git.bake('checkout', '1234567'), debug=False),
-        mocker.call(sh.git.bake('clean', '-d', '-x', '-f'), debug=False)
+        mocker.call(
+            cmd, timeout=backends.NETWORK_TIMEOUT, debug=False),
+        mocker.call(
+            ['git', '-C', '/clone', 'symbolic-ref', 'HEAD'], debug=False),
+        mocker.call(
+            git_config +
+            ['remote.origin.fetch', '+refs/heads/master:refs/heads/master'],
+            debug=False),
     ]
-    # yapf: enable
 
-    assert expected == patched_run_command.mock_calls
+    assert expected == patched_run_command.call_args_list
+
+
+def test_clone_only_mirrors_branches_and_tags(temp_dir, git_repository):
+    sh.git('-C', git_repository, 'update-ref', 'refs/pull/1/head', 'HEAD')
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    sh.git('-C', destination, 'update-ref', '-d', 'refs/heads/master')
+    git.fetch(destination)
+
+    refs = str(
+        sh.git('-C', destination, 'for-each-ref', '--format=%(refname)'))
+    assert 'refs/heads/master' in refs
+    assert 'refs/tags/v1' in refs
+    assert 'refs/pull/' not in refs
+
+
+def test_clone_shallow(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    url = 'file://{}'.format(git_repository)
+    git.clone('upstream', url, destination, depth=1)
+
+    assert os.path.exists(os.path.join(destination, 'shallow'))
+    assert {'v1': None} == git.get_ref_types(destination, ['v1'])
+
+    git.fetch(destination, versions=['v1'], depth=1)
+    assert {'v1': 'tag'} == git.get_ref_types(destination, ['v1'])
+
+
+def test_fetch_objects(temp_dir, git_repository):
+    sh.git('-C', git_repository, 'config', 'uploadpack.allowFilter', 'true')
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    url = 'file://{}'.format(git_repository)
+    git.clone('upstream', url, destination, filter='tree:0')
+    commit = git._get_commit(destination, 'master')
+    v1 = git._get_commit(destination, 'v1')
+
+    assert git.list_missing_objects(destination, [commit])
+    git.fetch_objects(destination, [commit])
+    assert [] == git.list_missing_objects(destination, [commit])
+    # Only the trees of the commits are fetched, not their history.
+    assert git.list_missing_objects(destination, [v1])
+
+
+def test_fetch_objects_skips_full_clone(mocker, temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    patched_run_command = mocker.patch('gilt.util.run_command')
+    git.fetch_objects(destination, ['abc'])
+
+    assert not patched_run_command.called
+    assert [] == git.list_missing_objects(destination, ['abc'])
+
+
+def test_count_objects(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    assert {'objects': 0, 'bytes': 0} == git.count_objects(destination)
+
+    git.clone('upstream', git_repository, destination)
+    result = git.count_objects(destination)
+    assert 0 < result['objects']
+    assert 0 < result['bytes']
+
+
+def test_bundle_round_trip(temp_dir, git_repository):
+    source = os.path.join(temp_dir.strpath, 'source')
+    git.clone('upstream', git_repository, source)
+    first = git._get_commit(source, 'v1')
+    bundle = os.path.join(temp_dir.strpath, 'upstream.bundle')
+    git.create_bundle(source, bundle, ['master', first[:7]])
+
+    assert '' == str(sh.git('-C', source, 'for-each-ref', git.BUNDLE_REFS))
+
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone_bundle('upstream', bundle, destination, git_repository)
+    result = git.resolve(destination, ['master', first])
+    assert git._get_commit(source, 'master') == result['master']
+    assert first == result[first]
+    assert {'v1': None} == git.get_ref_types(destination, ['v1'])
+
+    git.fetch(destination)
+    assert {'v1': 'tag'} == git.get_ref_types(destination, ['v1'])
+
+
+def test_create_bundle_raises_on_missing_version(temp_dir, git_repository):
+    source = os.path.join(temp_dir.strpath, 'source')
+    git.clone('upstream', git_repository, source)
+    bundle = os.path.join(temp_dir.strpath, 'upstream.bundle')
+    with pytest.raises(git.NotFoundError):
+        git.create_bundle(source, bundle, ['missing'])
+
+
+def test_is_complete(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    assert git.is_complete(destination)
+
+    shallow = os.path.join(temp_dir.strpath, 'shallow')
+    url = 'file://{}'.format(git_repository)
+    git.clone('upstream', url, shallow, depth=1)
+    assert not git.is_complete(shallow)
+
+
+def test_mark_used(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    os.utime(destination, (100, 100))
+    assert 100 == git.get_last_used(destination)
+
+    git.mark_used(destination)
+    assert 100 < git.get_last_used(destination)
+
+
+def test_maintain(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    git.maintain(destination)
+
+    pack_dir = os.path.join(destination, 'objects', 'pack')
+    assert os.path.exists(os.path.join(pack_dir, 'multi-pack-index'))
+    assert os.path.exists(
+        os.path.join(destination, 'objects', 'info', 'commit-graph'))
+    assert 40 == len(git._get_commit(destination, 'master'))
+
+
+def test_prune_worktrees(temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'master')
+    worktree = git._get_worktree(clone_dir, commit, [['README']])
+    assert [] == git.prune_worktrees(clone_dir, 60)
+
+    # Using a worktree again keeps it.
+    os.utime(worktree, (0, 0))
+    git._get_worktree(clone_dir, commit, [['README']])
+    assert [] == git.prune_worktrees(clone_dir, 60)
+    os.utime(worktree, (0, 0))
+    assert [commit] == git.prune_worktrees(clone_dir, 60)
+    assert not os.path.exists(worktree)
+
+
+def test_share_objects(temp_dir, git_repository):
+    pool = os.path.join(temp_dir.strpath, 'pool')
+    git.init_pool(pool)
+    upstream = os.path.join(temp_dir.strpath, 'upstream')
+    git.clone('upstream', git_repository, upstream, reference=pool)
+    assert git.is_pooled(upstream, pool)
+    git.share_objects(upstream, pool, 'upstream')
+
+    fork_repository = os.path.join(temp_dir.strpath, 'fork.git')
+    sh.git.clone(git_repository, fork_repository)
+    sh.git('-C', fork_repository, '-c', 'user.name=gilt', '-c',
+           'user.email=gilt@gilt', 'commit', '--allow-empty', '-m', 'fork')
+    fork = os.path.join(temp_dir.strpath, 'fork')
+    git.clone('fork', fork_repository, fork, reference=pool)
+    git.share_objects(fork, pool, 'fork')
+
+    for repository in [upstream, fork]:
+        assert {'objects': 0, 'bytes': 0} == git.count_objects(repository)
+        git.maintain(repository)
+        assert 40 == len(git._get_commit(repository, 'master'))
+    refs = str(sh.git('-C', pool, 'for-each-ref', '--format=%(refname)'))
+    assert 'refs/forks/fork/heads/master' in refs
+    assert 'refs/forks/upstream/heads/master' in refs
+
+
+def test_remove_fork_and_prune_pool(temp_dir, git_repository):
+    pool = os.path.join(temp_dir.strpath, 'pool')
+    git.init_pool(pool)
+    fork_repository = os.path.join(temp_dir.strpath, 'fork.git')
+    sh.git.clone(git_repository, fork_repository)
+    sh.git('-C', fork_repository, '-c', 'user.name=gilt', '-c',
+           'user.email=gilt@gilt', 'commit', '--allow-empty', '-m', 'fork')
+    fork = os.path.join(temp_dir.strpath, 'fork')
+    git.clone('fork', fork_repository, fork)
+    git.share_objects(fork, pool, 'fork')
+    commit = git._get_commit(fork, 'master')
+    shutil.rmtree(fork)
+
+    git.remove_fork(pool, 'fork')
+    refs = str(sh.git('-C', pool, 'for-each-ref', '--format=%(refname)'))
+    assert 'refs/forks/fork/' not in refs
+    sh.git('-C', pool, 'config', 'gc.pruneExpire', 'now')
+    git.maintain(pool, prune=False)
+    sh.git('-C', pool, 'cat-file', '-e', commit)
+    git.prune_pool(pool)
+    with pytest.raises(sh.ErrorReturnCode):
+        sh.git('-C', pool, 'cat-file', '-e', commit)
+
+
+def test_share_objects_adds_alternates(temp_dir, git_repository):
+    pool = os.path.join(temp_dir.strpath, 'pool')
+    git.init_pool(pool)
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    assert not git.is_pooled(destination, pool)
+
+    git.share_objects(destination, pool, 'upstream')
+    assert git.is_pooled(destination, pool)
+    assert 0 == git.count_objects(destination)['objects']
+    assert 40 == len(git._get_commit(destination, 'master'))
+
+
+def test_clone_is_bare_mirror(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+
+    assert os.path.exists(os.path.join(destination, 'HEAD'))
+    assert not os.path.exists(os.path.join(destination, 'README'))
+
+
+def test_set_offline(mocker, temp_dir, git_repository):
+    mocker.patch.dict(os.environ)
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, destination)
+    git.set_offline()
+
+    assert 'master' in git.resolve(destination, ['master'])
+    with pytest.raises(util.CommandError):
+        git.fetch(destination)
+
+
+def test_convert(temp_dir, git_repository):
+    destination = os.path.join(temp_dir.strpath, 'clone')
+    sh.git.clone(git_repository, destination)
+    git.convert('upstream', destination)
+
+    assert not os.path.exists(os.path.join(destination, '.git'))
+    assert os.path.exists(os.path.join(destination, 'HEAD'))
+    refspecs = sh.git('-C',
+                      destination,
+                      'config',
+                      '--get-all',
+                      'remote.origin.fetch',
+                      _tty_out=False)
+    assert backends.MIRROR_REFSPECS == str(refspecs).split()
+    git.fetch(destination)
+    assert 40 == len(git._get_commit(destination, 'master'))
+
+
+def test_extract_local(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'v1')
+
+    assert 'one' == open(os.path.join(dst_dir, 'README')).read()
+    assert 3 == len(glob.glob('{}/*_manage'.format(dst_dir)))
+    assert not os.path.exists(os.path.join(clone_dir, 'index'))
+
+
+def test_overlay_local(mocker, temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    files = [
+        mocker.Mock(
+            exclude=[], src='*_manage', dst=dst_dir),
+        mocker.Mock(
+            exclude=[], src='roles', dst=os.path.join(dst_dir, 'roles')),
+    ]
+    git.clone('upstream', git_repository, clone_dir)
+    result = git.overlay(clone_dir, files, 'master')
+
+    x = [
+        os.path.join(dst_dir, 'bar_manage'),
+        os.path.join(dst_dir, 'foo_manage'),
+        os.path.join(dst_dir, 'roles'),
+    ]
+    assert x == sorted(result)
+    assert 2 == len(glob.glob('{}/*_manage'.format(dst_dir)))
+    x = os.path.join(dst_dir, 'roles', 'foo', 'tasks', 'main.yml')
+    assert os.path.exists(x)
+
+
+def test_overlay_parallel_keeps_order(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    files = [
+        mocker.Mock(
+            exclude=[], src='*_manage', dst=dst_dir),
+        mocker.Mock(
+            exclude=[], src='roles/foo', dst=os.path.join(dst_dir, 'foo')),
+        mocker.Mock(
+            exclude=[], src='README', dst=os.path.join(dst_dir, 'foo_manage')),
+        mocker.Mock(
+            exclude=[], src='tests', dst=os.path.join(dst_dir, 'foo')),
+    ]
+    git.clone('upstream', git_repository, clone_dir)
+    result = git.overlay(clone_dir, files, 'master', jobs=4)
+
+    x = [
+        os.path.join(dst_dir, 'bar_manage'),
+        os.path.join(dst_dir, 'foo_manage'),
+        os.path.join(dst_dir, 'foo'),
+        os.path.join(dst_dir, 'foo_manage'),
+        os.path.join(dst_dir, 'foo'),
+    ]
+    assert x == result
+    assert 'two' == open(os.path.join(dst_dir, 'foo_manage')).read()
+    assert ['test_foo.py'] == os.listdir(os.path.join(dst_dir, 'foo'))
+
+
+def test_overlay_glob_does_not_replace_directory(mocker, temp_dir,
+                                                 git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    files = [
+        mocker.Mock(
+            src='README', dst=dst_dir, exclude=[]),
+        mocker.Mock(
+            src='tes[t]s', dst=dst_dir, exclude=[]),
+    ]
+    git.clone('upstream', git_repository, clone_dir)
+
+    with pytest.raises(OSError):
+        git.overlay(clone_dir, files, 'master')
+    assert os.path.exists(os.path.join(dst_dir, 'README'))
+
+
+def test_overlay_from_objects(mocker, temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    os.symlink('README', os.path.join(git_repository, 'link'))
+    sh.git('-C', git_repository, 'add', 'link')
+    sh.git('-C', git_repository, '-c', 'user.name=gilt', '-c',
+           'user.email=gilt@gilt', 'commit', '-m', 'link')
+    files = [
+        mocker.Mock(
+            src='link', dst=dst_dir, exclude=[]),
+        mocker.Mock(
+            src='roles/', dst=os.path.join(dst_dir, 'roles'), exclude=[]),
+        mocker.Mock(
+            src='[Rt]*', dst=dst_dir, exclude=['tests']),
+    ]
+    git.clone('upstream', git_repository, clone_dir)
+    spy = mocker.spy(git, '_get_worktree')
+    result = git.overlay(clone_dir, files, 'master', jobs=4)
+
+    x = [
+        os.path.join(dst_dir, 'link'),
+        os.path.join(dst_dir, 'roles'),
+        os.path.join(dst_dir, 'README'),
+    ]
+    assert x == result
+    assert 'README' == os.readlink(os.path.join(dst_dir, 'link'))
+    x = os.path.join(dst_dir, 'roles', 'foo', 'tasks', 'main.yml')
+    assert 'main' == open(x).read()
+    assert not os.path.exists(os.path.join(clone_dir, git.WORKTREE_DIR))
+    assert not spy.called
+
+
+def test_overlay_missing_path_from_objects(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    files = [mocker.Mock(src='missing', dst=temp_dir.strpath, exclude=[])]
+    git.clone('upstream', git_repository, clone_dir)
+
+    with pytest.raises(git.NotFoundError):
+        git.overlay(clone_dir, files, 'master')
+
+
+def test_overlay_hardlink_uses_worktree(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    files = [mocker.Mock(src='README', dst=dst_dir, exclude=[])]
+    git.clone('upstream', git_repository, clone_dir)
+    git.overlay(clone_dir, files, 'master', strategy='hardlink')
+
+    assert 2 == os.stat(os.path.join(dst_dir, 'README')).st_nlink
+
+
+def test_get_copy_lanes(temp_dir):
+    d = temp_dir.strpath
+    copies = [
+        ('/src/a', os.path.join(d, 'a')),
+        ('/src/b', os.path.join(d, 'b')),
+        ('/src/c', os.path.join(d, 'a', 'c')),
+        ('/src/d', os.path.join(d, 'a')),
+        ('/src/e', os.path.join(d, 'b', '')),
+    ]
+    result = git._get_copy_lanes(copies)
+
+    assert [[0, 2, 3], [1, 4]] == list(result)
+
+
+def test_get_copy_lanes_into_directory(temp_dir):
+    d = temp_dir.strpath
+    copies = [('/src/a', d), ('/src/b', d), ('/src/a', d)]
+    result = git._get_copy_lanes(copies)
+
+    assert [[0, 2], [1]] == list(result)
+
+
+def test_get_copy_lanes_joins_every_copy_beneath(temp_dir):
+    d = os.path.join(temp_dir.strpath, 'd')
+    copies = [
+        ('/src/x', os.path.join(d, 'a')),
+        ('/src/y', os.path.join(d, 'b')),
+        ('/src/z', d),
+    ]
+    result = git._get_copy_lanes(copies, isdir=lambda src: False)
+
+    assert [[0, 1, 2]] == list(result)
+
+
+def test_get_commit(temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    tag = git._get_commit(clone_dir, 'v1')
+    master = git._get_commit(clone_dir, 'master')
+
+    assert 40 == len(tag)
+    assert tag != master
+    assert tag == git._get_commit(clone_dir, tag[:7])
+
+
+def test_get_worktree(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'v1')
+    pathspecs = git._get_pathspecs('roles') + git._get_pathspecs('f*')
+    result = git._get_worktree(clone_dir, commit, [pathspecs])
+
+    assert os.path.join(clone_dir, git.WORKTREE_DIR, commit) == result
+    assert [commit] == os.listdir(os.path.dirname(result))
+    x = ['foo_manage', 'roles']
+    assert x == sorted(os.listdir(result))
+    x = os.path.join(result, 'roles', 'foo', 'tasks', 'main.yml')
+    assert os.path.exists(x)
+
+
+def test_get_worktree_adds_missing_paths(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'v1')
+    git._get_worktree(clone_dir, commit, [git._get_pathspecs('README')])
+    spy = mocker.spy(git.util, 'run_command')
+    pathspecs = git._get_pathspecs('README')
+    git._get_worktree(clone_dir, commit, [pathspecs])
+
+    # Only read-tree and ls-files, nothing left to checkout.
+    assert 2 == spy.call_count
+
+    pathspecs = [git._get_pathspecs('README'), git._get_pathspecs('tests')]
+    result = git._get_worktree(clone_dir, commit, pathspecs)
+
+    assert ['README', 'tests'] == sorted(os.listdir(result))
+    assert 'one' == open(os.path.join(result, 'README')).read()
+
+
+def test_get_pathspecs():
+    assert [':(literal)foo/bar'] == git._get_pathspecs('foo/bar')
+    x = [':(glob)*_manage', ':(glob)*_manage/**']
+    assert x == git._get_pathspecs('*_manage')
+    x = [
+        ':(glob)roles/**/*.yml', ':(glob)roles/**/*.yml/**',
+        ':(exclude,glob)**/tests', ':(exclude,glob)**/tests/**'
+    ]
+    assert x == git._get_pathspecs('roles/**/*.yml', ['**/tests'])
+
+
+def test_overlay_recursive_glob_with_exclude(mocker, temp_dir, git_repository,
+                                             git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    os.mkdir(dst_dir)
+    files = [
+        mocker.Mock(
+            src='**/*.py', dst=dst_dir, exclude=[]),
+        mocker.Mock(
+            src='**/*.yml', dst=dst_dir, exclude=[]),
+        mocker.Mock(
+            src='*',
+            dst=os.path.join(dst_dir, 'all', ''),
+            exclude=['roles', 'tests']),
+        mocker.Mock(
+            src='roles',
+            dst=os.path.join(dst_dir, 'roles'),
+            exclude=['**/tasks']),
+    ]
+    os.mkdir(files[2].dst)
+    git.clone('upstream', git_repository, clone_dir)
+    result = git.overlay(clone_dir, files, 'master')
+
+    x = [
+        os.path.join(dst_dir, 'test_foo.py'),
+        os.path.join(dst_dir, 'main.yml'),
+        os.path.join(dst_dir, 'all', 'README'),
+        os.path.join(dst_dir, 'all', 'bar_manage'),
+        os.path.join(dst_dir, 'all', 'foo_manage'),
+        os.path.join(dst_dir, 'roles'),
+    ]
+    assert x == result
+    assert [] == os.listdir(os.path.join(dst_dir, 'roles', 'foo'))
+
+
+def test_get_ref_types(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'master')
+    versions = ['master', 'v1', 'v2', commit, commit[:7], 'deadbeef']
+    result = git.get_ref_types(clone_dir, versions)
+
+    assert 'branch' == result['master']
+    assert 'tag' == result['v1']
+    assert 'commit' == result[commit]
+    assert 'commit' == result[commit[:7]]
+    assert result['v2'] is None
+    assert result['deadbeef'] is None
+
+
+def test_get_ref_types_is_cached(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    git.get_ref_types(clone_dir, ['master', 'v1', 'v2'])
+    ref_types = git._read_ref_types(clone_dir)
+
+    assert {'master': 'branch', 'v1': 'tag'} == ref_types
+
+    spy = mocker.spy(git, '_batch_check')
+    result = git.get_ref_types(clone_dir, ['v1'])
+
+    assert {'v1': 'tag'} == result
+    assert ['refs/tags/v1^{commit}'] == spy.call_args[0][1]
+
+
+def test_ls_remote(mocker, temp_dir, git_repository):
+    sh.git('-C', git_repository, 'branch', 'gone')
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'master')
+    git.get_ref_types(clone_dir, ['master', 'v1', 'gone', commit])
+    sh.git('-C', git_repository, 'branch', '-D', 'gone')
+    spy = mocker.spy(git._backend, 'ls_remote')
+    result = git.ls_remote(clone_dir,
+                           ['master', 'v1', 'gone', commit, 'missing'])
+
+    assert {'master': commit, 'gone': None} == result
+    assert 1 == spy.call_count
+    assert ['refs/heads/master', 'refs/heads/gone'] == spy.call_args[0][1]
+
+
+def test_ls_remote_skips_without_branches(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    git.get_ref_types(clone_dir, ['v1'])
+    spy = mocker.spy(git._backend, 'ls_remote')
+
+    assert {} == git.ls_remote(clone_dir, ['v1', 'master'])
+    assert not spy.called
+
+
+def test_get_ref_types_handles_branch_named_like_a_commit(temp_dir,
+                                                          git_repository):
+    sh.git('-C', git_repository, 'branch', 'deadbeef')
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+
+    assert {'deadbeef': 'branch'} == git.get_ref_types(clone_dir, ['deadbeef'])
+
+
+def test_read_ref_types_handles_missing_file(temp_dir):
+    assert {} == git._read_ref_types(temp_dir.strpath)
+
+
+def test_resolve(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    git.clone('upstream', git_repository, clone_dir)
+    master = git._get_commit(clone_dir, 'master')
+    tag = git._get_commit(clone_dir, 'v1')
+    result = git.resolve(clone_dir, ['master', 'v1', tag[:7], 'v2'])
+
+    assert {'master': master, 'v1': tag, tag[:7]: tag} == result
+
+
+def test_extract_with_commit_does_not_resolve(mocker, temp_dir,
+                                              git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    git.clone('upstream', git_repository, clone_dir)
+    commit = git._get_commit(clone_dir, 'v1')
+    spy = mocker.spy(git, '_get_commit')
+    git.extract(clone_dir, dst_dir, 'v1', commit=commit)
+
+    assert not spy.called
+    assert 'one' == open(os.path.join(dst_dir, 'README')).read()
+
+
+def test_extract_incremental(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file)
+
+    assert os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+    state = git.util.read_json(state_file)
+    assert git._get_commit(clone_dir, 'v1') == state['commit']
+
+    # Unchanged paths are left alone.
+    open(os.path.join(dst_dir, 'foo_manage'), 'w').write('local')
+    git.extract(clone_dir, dst_dir, 'master', state_file=state_file)
+
+    assert 'two' == open(os.path.join(dst_dir, 'README')).read()
+    assert not os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+    assert 'local' == open(os.path.join(dst_dir, 'foo_manage')).read()
+    state = git.util.read_json(state_file)
+    assert git._get_commit(clone_dir, 'master') == state['commit']
+
+
+def test_extract_subtree(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'v1', subtree='roles/')
+
+    assert ['foo'] == os.listdir(dst_dir)
+    assert os.path.exists(os.path.join(dst_dir, 'foo', 'tasks', 'main.yml'))
+
+
+def test_extract_include_and_exclude(temp_dir, git_repository, git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(
+        clone_dir,
+        dst_dir,
+        'v1',
+        state_file=state_file,
+        include=['*_manage', 'README'],
+        exclude=['foo_*'])
+
+    assert ['README', 'bar_manage', 'baz_manage'] == sorted(
+        os.listdir(dst_dir))
+
+    git.extract(
+        clone_dir,
+        dst_dir,
+        'master',
+        state_file=state_file,
+        include=['*_manage', 'README'],
+        exclude=['foo_*'])
+
+    assert ['README', 'bar_manage'] == sorted(os.listdir(dst_dir))
+    assert 'two' == open(os.path.join(dst_dir, 'README')).read()
+
+
+def test_extract_removes_paths_filtered_out(temp_dir, git_repository,
+                                            git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'master', state_file=state_file)
+    git.extract(
+        clone_dir,
+        dst_dir,
+        'master',
+        state_file=state_file,
+        exclude=['roles', 'tests'])
+
+    x = ['README', 'bar_manage', 'foo_manage']
+    assert x == sorted(os.listdir(dst_dir))
+    state = git.util.read_json(state_file)
+    assert ['roles', 'tests'] == state['filters']['exclude']
+
+
+def test_extract_subtree_hardlinks_from_worktree(temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(
+        clone_dir, dst_dir, 'v1', subtree='roles/foo', strategy='hardlink')
+    commit = git._get_commit(clone_dir, 'v1')
+    worktree = os.path.join(clone_dir, git.WORKTREE_DIR, commit)
+
+    assert os.path.samefile(
+        os.path.join(worktree, 'roles', 'foo', 'tasks', 'main.yml'),
+        os.path.join(dst_dir, 'tasks', 'main.yml'))
+
+
+def test_get_filter_pathspecs():
+    assert [] == git._get_filter_pathspecs([], [])
+    x = [':(literal)README', ':(exclude,glob)t*', ':(exclude,glob)t*/**']
+    assert x == git._get_filter_pathspecs(['README'], ['t*'])
+    x = [
+        ':(glob)**', ':(glob)**/**', ':(exclude,glob)t*',
+        ':(exclude,glob)t*/**'
+    ]
+    assert x == git._get_filter_pathspecs([], ['t*'])
+
+
+def test_get_treeish():
+    assert 'abc^{tree}' == git._get_treeish('abc')
+    assert 'abc:roles' == git._get_treeish('abc', 'roles')
+
+
+def test_extract_skips_up_to_date(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file)
+    spy = mocker.spy(git, '_checkout')
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file)
+
+    assert not spy.called
+
+
+def test_extract_full_without_previous_state(mocker, temp_dir, git_repository):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.util.write_json(state_file, {
+        'repository': '/other',
+        'commit': git._get_commit(clone_dir, 'v1')
+    })
+    os.mkdir(dst_dir)
+    spy = mocker.spy(git, '_checkout_changes')
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file)
+
+    assert not spy.called
+    assert os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+
+
+def test_extract_hardlinks_from_worktree(temp_dir, git_repository,
+                                         git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(
+        clone_dir, dst_dir, 'v1', state_file=state_file, strategy='hardlink')
+    commit = git._get_commit(clone_dir, 'v1')
+    worktree = os.path.join(clone_dir, git.WORKTREE_DIR, commit)
+
+    assert os.path.samefile(
+        os.path.join(worktree, 'README'), os.path.join(dst_dir, 'README'))
+    assert os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+
+    git.extract(
+        clone_dir,
+        dst_dir,
+        'master',
+        state_file=state_file,
+        strategy='hardlink')
+
+    assert 'one' == open(os.path.join(worktree, 'README')).read()
+    assert 'two' == open(os.path.join(dst_dir, 'README')).read()
+    assert not os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+
+
+def test_extract_force_rewrites_and_removes(temp_dir, git_repository,
+                                            git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file)
+    with open(os.path.join(dst_dir, 'README'), 'w') as f:
+        f.write('edited')
+    git.extract(clone_dir, dst_dir, 'v1', state_file=state_file, force=True)
+
+    assert 'one' == open(os.path.join(dst_dir, 'README')).read()
+
+    with open(os.path.join(dst_dir, 'README'), 'w') as f:
+        f.write('edited')
+    git.extract(
+        clone_dir, dst_dir, 'master', state_file=state_file, force=True)
+
+    assert 'two' == open(os.path.join(dst_dir, 'README')).read()
+    assert not os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+
+
+def test_extract_rewrites_on_new_strategy(temp_dir, git_repository,
+                                          git_backend):
+    clone_dir = os.path.join(temp_dir.strpath, 'clone')
+    dst_dir = os.path.join(temp_dir.strpath, 'dst', '')
+    state_file = os.path.join(temp_dir.strpath, 'state')
+    git.clone('upstream', git_repository, clone_dir)
+    git.extract(
+        clone_dir, dst_dir, 'v1', state_file=state_file, strategy='hardlink')
+    git.extract(
+        clone_dir, dst_dir, 'v1', state_file=state_file, strategy='copy')
+
+    assert 1 == os.stat(os.path.join(dst_dir, 'README')).st_nlink
+
+    git.extract(
+        clone_dir,
+        dst_dir,
+        'master',
+        state_file=state_file,
+        strategy='hardlink')
+
+    assert 2 == os.stat(os.path.join(dst_dir, 'README')).st_nlink
+    assert not os.path.exists(os.path.join(dst_dir, 'baz_manage'))
+
+
+def test_remove_prunes_empty_directories(temp_dir):
+    temp_dir.ensure('a', 'b', 'c', 'file')
+    temp_dir.ensure('a', 'other')
+    git._remove(temp_dir.strpath, os.path.join('a', 'b', 'c', 'file'))
+
+    assert not temp_dir.join('a', 'b').check()
+    assert temp_dir.join('a', 'other').check()
+
+
+def test_remove_removes_submodule_directories(temp_dir):
+    temp_dir.ensure('a', 'empty', dir=True)
+    temp_dir.ensure('a', 'full', 'file')
+    git._remove(temp_dir.strpath, os.path.join('a', 'empty'))
+    git._remove(temp_dir.strpath, os.path.join('a', 'full'))
+
+    assert not temp_dir.join('a', 'empty').check()
+    assert temp_dir.join('a', 'full', 'file').check()
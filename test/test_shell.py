@@ -20,11 +20,1000 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import os
+
 import pytest
 
+from gilt import config
 from gilt import shell
 
 
 def test_cli():
     with pytest.raises(SystemExit):
         shell.main()
+
+
+def _config(mocker, name, lock_file=None):
+    c = mocker.Mock(lock_file=lock_file or '/lock/{}'.format(name))
+    c.name = name
+
+    return c
+
+
+def test_group_by_repository(mocker):
+    a1 = _config(mocker, 'a')
+    b = _config(mocker, 'b')
+    a2 = _config(mocker, 'a')
+
+    result = shell._group_by_repository([a1, b, a2])
+
+    assert [[a1, a2], [b]] == list(result)
+
+
+def test_get_overlay_lanes(mocker):
+    FilesConfig = collections.namedtuple('FilesConfig', ['src', 'dst'])
+    a = _config(mocker, 'a')
+    a.dst = '/out2/'
+    b = _config(mocker, 'b')
+    b.dst = None
+    b.files = [FilesConfig('file', '/out2/file')]
+    c = _config(mocker, 'c')
+    c.dst = '/out/'
+    d = _config(mocker, 'd')
+    d.dst = '/out2'
+
+    e = _config(mocker, 'c')
+    e.dst = '/other/'
+
+    result = shell._get_overlay_lanes([a, b, c, d, e])
+
+    assert [[a, b, d], [c, e]] == list(result)
+
+
+def test_overlay_lane(mocker, temp_dir):
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.return_value = {'master': 'abc'}
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+    c.version = 'master'
+
+    assert shell._overlay_lane([c, c], copy_jobs=4)
+    assert 1 == patched_update.call_count
+    assert 2 == patched_overlay.call_count
+    patched_overlay.assert_called_with(c, 'abc', 4, (), False)
+
+
+def test_overlay_lane_with_commits(mocker, temp_dir):
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+    c.version = 'master'
+
+    assert shell._overlay_lane([c], commits={c.lock_file: {'master': 'abc'}})
+    assert not patched_update.called
+    patched_overlay.assert_called_with(c, 'abc', 1, (), False)
+
+
+def test_overlay_lane_passes_shared_paths(mocker, temp_dir):
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+    c.version = 'master'
+    c.state_file = 'state'
+
+    shell._overlay_lane(
+        [c],
+        commits={c.lock_file: {
+            'master': 'abc'
+        }},
+        shared={'state': ['/dst/foo']})
+    patched_overlay.assert_called_with(c, 'abc', 1, ['/dst/foo'], False)
+
+
+def test_get_shared_paths(mocker, temp_dir):
+    extract = _config(mocker, 'a')
+    extract.state_file = temp_dir.join('a').strpath
+    files = _config(mocker, 'b')
+    files.state_file = temp_dir.join('b').strpath
+    missing = _config(mocker, 'c')
+    missing.state_file = temp_dir.join('c').strpath
+    shell.util.write_json(extract.state_file, {'paths': ['/dst/']})
+    shell.util.write_json(files.state_file,
+                          {'paths': ['/dst/library/foo', '/other/bar']})
+
+    result = shell._get_shared_paths([extract, files, missing])
+
+    assert {
+        extract.state_file: ['/dst/library/foo'],
+        files.state_file: [],
+        missing.state_file: [],
+    } == result
+
+
+def test_overlay_lane_in_config_order(mocker, temp_dir):
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.side_effect = [{'master': 'abc'}, {'master': 'def'}]
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    a1 = _config(mocker, 'a')
+    a1.version = 'master'
+    b = _config(mocker, 'b')
+    b.version = 'master'
+    a2 = _config(mocker, 'a')
+    a2.version = 'master'
+
+    assert shell._overlay_lane([a1, b, a2])
+    assert [a1, b, a2] == [
+        args[0][0] for args in patched_overlay.call_args_list
+    ]
+    assert ['abc', 'def', 'abc'] == [
+        args[0][1] for args in patched_overlay.call_args_list
+    ]
+    assert [a1, a2] == patched_update.call_args_list[0][0][0]
+
+
+def test_overlay_lane_updates_failed_repository_once(mocker, temp_dir, capsys):
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.side_effect = RuntimeError('unreachable')
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+
+    assert not shell._overlay_lane([c, c, c])
+    assert 1 == patched_update.call_count
+    assert not patched_overlay.called
+
+    result, _ = capsys.readouterr()
+    assert 3 == result.count('unreachable')
+
+
+def test_overlay_lane_reports_failure(mocker, temp_dir, capsys):
+    mocker.patch('gilt.shell._update_repository', return_value={})
+    patched_overlay = mocker.patch('gilt.shell._overlay_config')
+    patched_overlay.side_effect = [RuntimeError('boom'), None]
+    c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+
+    assert not shell._overlay_lane([c, c])
+    assert 2 == patched_overlay.call_count
+
+    result, _ = capsys.readouterr()
+    assert 'boom' in result
+
+
+@pytest.fixture()
+def patched_git(mocker):
+    for f in [
+            'clone', 'convert', 'fetch', 'get_ref_types', 'resolve',
+            'fetch_objects', 'count_objects', 'mark_used'
+    ]:
+        mocker.patch('gilt.git.{}'.format(f))
+
+    return shell.git
+
+
+def _repository_configs(mocker, temp_dir, *versions):
+    configs = []
+    for version in versions:
+        c = _config(mocker, 'a', lock_file=temp_dir.join('a').strpath)
+        c.src = temp_dir.join('clone').strpath
+        c.fetch_file = temp_dir.join('a.fetched').strpath
+        c.version = version
+        c.depth = c.filter = c.single_branch = c.pool = None
+        configs.append(c)
+
+    return configs
+
+
+def test_prefetch_group(mocker, temp_dir, patched_git, capsys):
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.return_value = {'master': 'abc', 'v1': 'abc'}
+    patched_git.count_objects.side_effect = [{
+        'objects': 0,
+        'bytes': 0
+    }, {
+        'objects': 12,
+        'bytes': 4096
+    }]
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+
+    assert shell._prefetch_group(configs)
+    patched_git.fetch_objects.assert_called_once_with(
+        configs[0].src, ['abc'], debug=False)
+    result, _ = capsys.readouterr()
+    assert 'transferred 12 objects, 4096 bytes' in result
+
+
+def test_prefetch_group_fails_on_missing_version(mocker, temp_dir, patched_git,
+                                                 capsys):
+    mocker.patch('gilt.shell._update_repository', return_value={})
+    configs = _repository_configs(mocker, temp_dir, 'master')
+
+    assert not shell._prefetch_group(configs)
+    assert not patched_git.fetch_objects.called
+    result, _ = capsys.readouterr()
+    assert 'failed to prefetch' in result
+
+
+def test_update_repository_clones(mocker, temp_dir, patched_git):
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    result = shell._update_repository(configs)
+
+    assert patched_git.clone.called
+    assert not patched_git.fetch.called
+    assert patched_git.resolve.return_value == result
+
+
+def test_update_repository_shares_objects(mocker, temp_dir, patched_git):
+    patched_share = mocker.patch('gilt.shell._share_objects')
+    mocker.patch('gilt.git.init_pool')
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    configs[0].pool = temp_dir.join('pool').strpath
+    configs[0].pool_lock_file = temp_dir.join('pool.lock').strpath
+    shell._update_repository(configs)
+
+    assert configs[0].pool == patched_git.clone.call_args[1]['reference']
+    patched_share.assert_called_once_with(configs[0], False)
+
+
+def test_update_repository_skips_sharing_pooled(mocker, temp_dir, patched_git):
+    patched_share = mocker.patch('gilt.shell._share_objects')
+    mocker.patch('gilt.git.is_pooled', return_value=True)
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'v1': 'tag'}
+    configs = _repository_configs(mocker, temp_dir, 'v1')
+    configs[0].pool = temp_dir.join('pool').strpath
+    shell._update_repository(configs)
+
+    assert not patched_share.called
+
+
+def test_share_objects_skips_narrow_clones(mocker, temp_dir):
+    patched_share = mocker.patch('gilt.git.share_objects')
+    mocker.patch('gilt.git.is_complete', return_value=False)
+    c = _repository_configs(mocker, temp_dir, 'master')[0]
+    shell._share_objects(c)
+
+    assert not patched_share.called
+
+
+def test_update_repository_fetches_once(mocker, temp_dir, patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'master': 'branch', 'v1': 'tag'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1', 'master')
+    shell._update_repository(configs)
+
+    assert not patched_git.clone.called
+    patched_git.get_ref_types.assert_called_once_with(
+        configs[0].src, ['master', 'v1'], debug=False)
+    assert 1 == patched_git.fetch.call_count
+    patched_git.resolve.assert_called_once_with(
+        configs[0].src, ['master', 'v1'], debug=False)
+
+
+def test_update_repository_narrow_clone_fetches_missing_versions(
+        mocker, temp_dir, patched_git):
+    patched_git.get_ref_types.return_value = {'master': 'branch', 'v1': None}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    configs[0].depth = 1
+    shell._update_repository(configs)
+
+    patched_git.clone.assert_called_once_with(
+        'a',
+        configs[0].git,
+        configs[0].src,
+        depth=1,
+        filter=None,
+        single_branch=None,
+        reference=None,
+        debug=False)
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['v1'], depth=1, debug=False)
+
+
+def test_update_repository_narrow_fetches_versions(mocker, temp_dir,
+                                                   patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {
+        'master': 'branch',
+        'v1': 'tag',
+        'v2': None
+    }
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1', 'v2')
+    configs[0].single_branch = True
+    shell._update_repository(configs)
+
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['v2', 'master'], depth=None, debug=False)
+
+
+def test_update_repository_fetches_missing_versions(mocker, temp_dir,
+                                                    patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'v1': 'tag', 'v2': None}
+    configs = _repository_configs(mocker, temp_dir, 'v1', 'v2')
+    shell._update_repository(configs)
+
+    assert 1 == patched_git.fetch.call_count
+
+
+def test_update_repository_skips_fetch_of_pinned_versions(mocker, temp_dir,
+                                                          patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'v1': 'tag', 'e14ebe0': 'commit'}
+    configs = _repository_configs(mocker, temp_dir, 'v1', 'e14ebe0')
+    shell._update_repository(configs)
+
+    assert not patched_git.fetch.called
+
+
+def test_update_repository_skips_fetch_of_unmoved_versions(mocker, temp_dir,
+                                                           patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'master': 'branch', 'v1': 'tag'}
+    patched_git.resolve.return_value = {'master': 'abc', 'v1': 'def'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    result = shell._update_repository(configs, {'master': 'abc'})
+
+    assert not patched_git.fetch.called
+    assert 1 == patched_git.resolve.call_count
+    assert {'master': 'abc', 'v1': 'def'} == result
+
+
+def test_update_repository_fetches_moved_versions(mocker, temp_dir,
+                                                  patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {
+        'master': 'branch',
+        'v1': 'tag',
+        'v2': None
+    }
+    patched_git.resolve.return_value = {'master': 'abc', 'v1': 'def'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1', 'v2')
+    configs[0].depth = 1
+    shell._update_repository(configs, {'master': 'moved'})
+
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['v2', 'master'], depth=1, debug=False)
+    assert 2 == patched_git.resolve.call_count
+
+
+def test_update_repository_fetches_branches_not_asked_for(mocker, temp_dir,
+                                                          patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {
+        'master': 'branch',
+        'dev': 'branch',
+        'v1': 'tag'
+    }
+    patched_git.resolve.return_value = {
+        'master': 'abc',
+        'dev': 'def',
+        'v1': 'ghi'
+    }
+    configs = _repository_configs(mocker, temp_dir, 'master', 'dev', 'v1')
+    shell._update_repository(configs, {'master': None})
+
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['dev'], depth=None, debug=False)
+
+
+def test_ls_remotes(mocker, temp_dir):
+    def ls_remote(src, versions, debug=False):
+        if src.endswith('b'):
+            raise RuntimeError('down')
+        return {'master': 'abc'}
+
+    patched_ls_remote = mocker.patch('gilt.git.ls_remote')
+    patched_ls_remote.side_effect = ls_remote
+    groups = []
+    for name in ['a', 'b', 'c']:
+        configs = _repository_configs(mocker, temp_dir, 'master', 'master')
+        for c in configs:
+            c.lock_file = name
+            c.src = temp_dir.join(name).strpath
+            c.fetch_file = temp_dir.join(name + '.fetched').strpath
+        groups.append(configs)
+    temp_dir.mkdir('a')
+    temp_dir.mkdir('b')
+    result = shell._ls_remotes(groups)
+
+    assert {'a': {'master': 'abc'}} == result
+    patched_ls_remote.assert_any_call(
+        groups[0][0].src, ['master'], debug=False)
+    assert 2 == patched_ls_remote.call_count
+
+
+def test_update_repository_records_fetch(mocker, temp_dir, patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'master': 'branch', 'v1': 'tag'}
+    patched_git.resolve.return_value = {'master': 'abc', 'v1': 'def'}
+    mocker.patch('time.time', return_value=100)
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    shell._update_repository(configs)
+    result = shell.util.read_json(configs[0].fetch_file)
+
+    assert {'master': {'commit': 'abc', 'time': 100}} == result
+
+
+def test_update_repository_skips_fresh_versions(mocker, temp_dir, patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {
+        'master': 'branch',
+        'dev': 'branch',
+        'v1': None
+    }
+    patched_git.resolve.return_value = {'master': 'abc', 'dev': 'def'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'dev', 'v1')
+    shell.util.write_json(configs[0].fetch_file, {
+        'master': {
+            'commit': 'abc',
+            'time': 100
+        },
+        'dev': {
+            'commit': 'moved',
+            'time': 100
+        },
+        'v1': {
+            'commit': 'ghi',
+            'time': 100
+        },
+    })
+    mocker.patch('time.time', return_value=159)
+    shell._update_repository(configs, fetch_ttl=60)
+
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['v1', 'dev'], depth=None, debug=False)
+    result = shell.util.read_json(configs[0].fetch_file)
+    assert 100 == result['master']['time']
+    assert 159 == result['dev']['time']
+
+
+def test_update_repository_fetches_expired_versions(mocker, temp_dir,
+                                                    patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'master': 'branch'}
+    patched_git.resolve.return_value = {'master': 'abc'}
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    shell.util.write_json(configs[0].fetch_file,
+                          {'master': {
+                              'commit': 'abc',
+                              'time': 100
+                          }})
+    mocker.patch('time.time', return_value=160)
+    shell._update_repository(configs, fetch_ttl=60)
+
+    assert patched_git.fetch.called
+
+
+def test_ls_remotes_skips_fresh_repositories(mocker, temp_dir):
+    patched_ls_remote = mocker.patch('gilt.git.ls_remote')
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    temp_dir.mkdir('clone')
+    shell.util.write_json(configs[0].fetch_file,
+                          {'master': {
+                              'commit': 'abc',
+                              'time': 100
+                          }})
+    mocker.patch('time.time', return_value=130)
+
+    assert {} == shell._ls_remotes([configs], fetch_ttl=60)
+    assert not patched_ls_remote.called
+
+    shell._ls_remotes([configs])
+    assert patched_ls_remote.called
+
+
+def test_update_repository_skips_fetch_of_locked_versions(mocker, temp_dir,
+                                                          patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.get_ref_types.return_value = {'master': 'branch'}
+    patched_git.resolve.return_value = {'master': 'abc', 'e14ebe0': 'e14ebe0'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    result = shell._update_repository(
+        configs, {'master': 'abc'}, pinned={'v1': 'e14ebe0'})
+
+    assert not patched_git.fetch.called
+    patched_git.get_ref_types.assert_called_once_with(
+        configs[0].src, ['master'], debug=False)
+    assert 'e14ebe0' == result['v1']
+    assert 'abc' == result['master']
+
+
+def test_update_repository_fetches_missing_locked_commits(mocker, temp_dir,
+                                                          patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.resolve.side_effect = [{}, {'e14ebe0': 'e14ebe0'}]
+    configs = _repository_configs(mocker, temp_dir, 'v1')
+    result = shell._update_repository(configs, pinned={'v1': 'e14ebe0'})
+
+    patched_git.fetch.assert_called_once_with(
+        configs[0].src, versions=['e14ebe0'], depth=None, debug=False)
+    assert not patched_git.get_ref_types.called
+    assert {'v1': 'e14ebe0'} == result
+    assert not os.path.exists(configs[0].fetch_file)
+
+
+def test_update_repository_raises_on_unknown_locked_commit(mocker, temp_dir,
+                                                           patched_git):
+    temp_dir.mkdir('clone')
+    patched_git.resolve.return_value = {}
+    configs = _repository_configs(mocker, temp_dir, 'v1')
+    with pytest.raises(shell.git.NotFoundError):
+        shell._update_repository(configs, pinned={'v1': 'e14ebe0'})
+
+
+def test_ls_remotes_skips_locked_versions(mocker, temp_dir):
+    patched_ls_remote = mocker.patch('gilt.git.ls_remote')
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    temp_dir.mkdir('clone')
+    pinned = {configs[0].lock_file: {'v1': 'abc'}}
+    shell._ls_remotes([configs], pinned=pinned)
+
+    patched_ls_remote.assert_called_once_with(
+        configs[0].src, ['master'], debug=False)
+
+    pinned[configs[0].lock_file]['master'] = 'def'
+    patched_ls_remote.reset_mock()
+    assert {} == shell._ls_remotes([configs], pinned=pinned)
+    assert not patched_ls_remote.called
+
+
+def test_resolve_offline(mocker, temp_dir, patched_git):
+    patched_git.resolve.return_value = {'master': 'abc', 'e14ebe0': 'e14ebe0'}
+    groups = []
+    for name in ['a', 'b']:
+        configs = _repository_configs(mocker, temp_dir, 'master', 'v1', 'v2')
+        for c in configs:
+            c.name = name
+            c.lock_file = temp_dir.join(name).strpath
+            c.src = temp_dir.join(name + '.clone').strpath
+        groups.append(configs)
+    temp_dir.mkdir('a.clone')
+    pinned = {groups[0][0].lock_file: {'v1': 'e14ebe0', 'v2': 'def'}}
+    result, missing = shell._resolve_offline(groups, pinned)
+
+    assert {
+        groups[0][0].lock_file: {
+            'master': 'abc',
+            'v1': 'e14ebe0'
+        }
+    } == result
+    patched_git.resolve.assert_called_once_with(
+        groups[0][0].src, ['master', 'e14ebe0', 'def'], debug=False)
+    assert not patched_git.fetch.called
+    assert not patched_git.clone.called
+    assert [
+        'a (v2): locked commit def',
+        'b (master): not cloned',
+        'b (v1): not cloned',
+        'b (v2): not cloned',
+    ] == missing
+
+
+def test_resolve_offline_reports_missing_objects(mocker, temp_dir,
+                                                 patched_git):
+    patched_git.resolve.return_value = {'master': 'abc', 'v1': 'def'}
+    mocker.patch(
+        'gilt.git.list_missing_objects',
+        side_effect=lambda src, commits, debug: commits == ['abc'])
+    temp_dir.mkdir('clone')
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    result, missing = shell._resolve_offline([configs])
+
+    assert {configs[0].lock_file: {'v1': 'def'}} == result
+    assert ['a (master): objects of abc not fetched'] == missing
+
+
+def test_get_pinned(mocker):
+    configs = [_config(mocker, 'a'), _config(mocker, 'a')]
+    configs[0].version, configs[1].version = 'master', 1.0
+    for c in configs:
+        c.git = 'https://example.com/a.git'
+    pins = {'https://example.com/a.git': {'1.0': 'abc', 'dev': 'def'}}
+
+    assert {1.0: 'abc'} == shell._get_pinned(configs, pins)
+    assert {} == shell._get_pinned(configs, {})
+
+
+def test_lock_groups(mocker, temp_dir):
+    mocker.patch('gilt.shell._ls_remotes', return_value={})
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.return_value = {'master': 'abc', 'v1': 'def'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+    for c in configs:
+        c.git = 'https://example.com/a.git'
+    result = shell._lock_groups([configs])
+
+    assert {
+        'https://example.com/a.git': {
+            'master': 'abc',
+            'v1': 'def'
+        }
+    } == result
+
+
+def test_lock_groups_fails_on_missing_version(mocker, temp_dir, capsys):
+    mocker.patch('gilt.shell._ls_remotes', return_value={})
+    patched_update = mocker.patch('gilt.shell._update_repository')
+    patched_update.return_value = {'master': 'abc'}
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1')
+
+    assert shell._lock_groups([configs]) is None
+    result, _ = capsys.readouterr()
+    assert 'failed to lock' in result
+
+
+def test_update_pins(mocker, temp_dir):
+    configs = []
+    for name in ['a', 'b']:
+        c = _repository_configs(mocker, temp_dir, 'master')[0]
+        c.name = name
+        c.git = 'https://example.com/{}.git'.format(name)
+        c.lock_file = temp_dir.join(name).strpath
+        configs.append(c)
+    patched_lock = mocker.patch('gilt.shell._lock_groups')
+    patched_lock.return_value = {
+        'https://example.com/b.git': {
+            'master': 'new'
+        }
+    }
+    pins = {
+        'https://example.com/a.git': {
+            'master': 'abc',
+            'gone': 'def'
+        },
+        'https://example.com/b.git': {
+            'master': 'old'
+        },
+        'https://example.com/gone.git': {
+            'master': 'ghi'
+        },
+    }
+    result = shell._update_pins(configs, pins, ['b'])
+
+    assert {
+        'https://example.com/a.git': {
+            'master': 'abc'
+        },
+        'https://example.com/b.git': {
+            'master': 'new'
+        },
+    } == result
+    assert [[configs[1]]] == patched_lock.call_args[0][0]
+
+
+def test_update_pins_raises_on_unknown_name(mocker, temp_dir):
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    with pytest.raises(ValueError):
+        shell._update_pins(configs, {}, ['nope'])
+
+
+@pytest.mark.parametrize('name', ['bundles', 'bundles.tar'])
+def test_bundle_dir_round_trips(temp_dir, name):
+    path = temp_dir.join(name).strpath
+    with shell._bundle_dir(path, write=True) as directory:
+        with open(os.path.join(directory, 'a.bundle'), 'w') as f:
+            f.write('bundle')
+
+    with shell._bundle_dir(path) as directory:
+        assert ['a.bundle'] == os.listdir(directory)
+    assert [name] == os.listdir(temp_dir.strpath)
+
+
+def test_bundle_dir_skips_unsafe_members(temp_dir):
+    temp_dir.join('a.bundle').write('bundle')
+    temp_dir.join('README').write('readme')
+    path = temp_dir.join('bundles.tar').strpath
+    with shell.tarfile.open(path, 'w') as tar:
+        tar.add(temp_dir.join('a.bundle').strpath, arcname='a.bundle')
+        tar.add(temp_dir.join('a.bundle').strpath, arcname='../b.bundle')
+        tar.add(temp_dir.join('README').strpath, arcname='README')
+
+    with shell._bundle_dir(path) as directory:
+        assert ['a.bundle'] == os.listdir(directory)
+
+
+def test_export_group(mocker, temp_dir):
+    patched_create = mocker.patch('gilt.git.create_bundle')
+    mocker.patch('gilt.git.is_complete', return_value=True)
+    configs = _repository_configs(mocker, temp_dir, 'master', 'v1', 'master')
+
+    assert shell._export_group(configs, '/bundles', pinned={'v1': 'abc'})
+    patched_create.assert_called_once_with(
+        configs[0].src,
+        '/bundles/a.bundle', ['master'],
+        commits=['abc'],
+        debug=False)
+
+
+def test_export_group_skips_narrow_clones(mocker, temp_dir):
+    patched_create = mocker.patch('gilt.git.create_bundle')
+    mocker.patch('gilt.git.is_complete', return_value=False)
+    configs = _repository_configs(mocker, temp_dir, 'master')
+
+    assert shell._export_group(configs, '/bundles')
+    assert not patched_create.called
+
+
+def test_import_group(mocker, temp_dir):
+    patched_clone = mocker.patch('gilt.git.clone_bundle')
+    mocker.patch('gilt.git.mark_used')
+    configs = _repository_configs(mocker, temp_dir, 'master')
+    temp_dir.join('a.bundle').write('bundle')
+
+    assert shell._import_group(configs, temp_dir.strpath)
+    patched_clone.assert_called_once_with(
+        'a',
+        temp_dir.join('a.bundle').strpath,
+        configs[0].src,
+        configs[0].git,
+        debug=False)
+
+    patched_clone.reset_mock()
+    temp_dir.mkdir('clone')
+    assert shell._import_group(configs, temp_dir.strpath)
+    assert not patched_clone.called
+
+
+def test_import_group_skips_missing_bundle(mocker, temp_dir):
+    patched_clone = mocker.patch('gilt.git.clone_bundle')
+    configs = _repository_configs(mocker, temp_dir, 'master')
+
+    assert shell._import_group(configs, temp_dir.strpath)
+    assert not patched_clone.called
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0', 0),
+    ('90', 90),
+    ('60s', 60),
+    ('5m', 300),
+    ('1h', 3600),
+    (' 2d', 172800),
+])
+def test_parse_duration(value, expected):
+    assert expected == shell._parse_duration(value)
+
+
+def test_parse_duration_invalid():
+    with pytest.raises(shell.click.BadParameter):
+        shell._parse_duration('1w')
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1024', 1024),
+    ('10k', 10240),
+    ('500M', 500 << 20),
+    (' 2GB', 2 << 30),
+    ('1t', 1 << 40),
+])
+def test_parse_size(value, expected):
+    assert expected == shell._parse_size(value)
+
+
+def test_parse_size_invalid():
+    assert shell._parse_size(None) is None
+    with pytest.raises(shell.click.BadParameter):
+        shell._parse_size('1.5G')
+
+
+@pytest.fixture()
+def clone_cache(mocker, temp_dir):
+    clone_dir = temp_dir.mkdir('clone')
+    lock_dir = temp_dir.mkdir('lock')
+    mocker.patch('gilt.config._get_clone_dir', return_value=clone_dir.strpath)
+    mocker.patch(
+        'gilt.config._get_lock_file',
+        side_effect=lambda n: lock_dir.join(n).strpath)
+    mocker.patch(
+        'gilt.config._get_fetch_file',
+        side_effect=lambda n: lock_dir.join(n + '.fetched').strpath)
+    mocker.patch(
+        'gilt.config._get_pool_dir',
+        return_value=temp_dir.join('pool').strpath)
+    for name, used in [('a', 300), ('b', 100), ('c', 200), ('d', 50)]:
+        clone_dir.ensure(name, 'objects').write('x' * 4096)
+        os.utime(clone_dir.join(name).strpath, (used, used))
+        lock_dir.ensure(name + '.fetched')
+    mocker.patch('time.time', return_value=10000)
+
+    return clone_dir
+
+
+def test_evict_clones(mocker, clone_cache):
+    mocker.patch('gilt.util.get_disk_usage', return_value=100)
+    keep = [clone_cache.join('d').strpath]
+    result = shell._evict_clones(250, keep)
+
+    assert ['b', 'c'] == result
+    assert ['a', 'd'] == sorted(os.listdir(clone_cache.strpath))
+    assert not os.path.exists(shell.config._get_fetch_file('b'))
+
+
+def test_evict_clones_keeps_recently_used(mocker, clone_cache):
+    mocker.patch('gilt.util.get_disk_usage', return_value=100)
+    mocker.patch('time.time', return_value=200 + shell.EVICT_GRACE - 1)
+
+    assert ['d', 'b'] == shell._evict_clones(0)
+
+
+def test_evict_clones_skips_locked(mocker, clone_cache):
+    mocker.patch('gilt.util.get_disk_usage', return_value=100)
+    mocker.patch(
+        'fasteners.InterProcessLock.acquire',
+        autospec=True,
+        side_effect=lambda lock, blocking=True: not lock.path.endswith('d'))
+    mocker.patch('fasteners.InterProcessLock.release')
+
+    assert ['b'] == shell._evict_clones(300)
+
+
+def test_evict_clones_removes_forks_from_pools(mocker, temp_dir, clone_cache):
+    mocker.patch('gilt.util.get_disk_usage', return_value=100)
+    pool = temp_dir.join('pool', 'p').strpath
+    pool_lock_file = temp_dir.join('p.lock').strpath
+    mocker.patch(
+        'gilt.shell._list_pools', return_value=[('p', pool, pool_lock_file)])
+    mocker.patch(
+        'gilt.git.is_pooled', side_effect=lambda src, p: src.endswith('b'))
+    patched_remove = mocker.patch('gilt.git.remove_fork')
+    patched_prune = mocker.patch('gilt.shell._prune_pool', return_value=50)
+    keep = [clone_cache.join('d').strpath]
+
+    # The pool counts toward the cache, and pruning it frees some more.
+    assert ['b', 'c'] == shell._evict_clones(250, keep)
+    patched_remove.assert_called_once_with(pool, 'b', debug=False)
+    patched_prune.assert_called_once_with('p', pool, pool_lock_file, False)
+
+
+def test_prune_pool_skips_partial_borrowers(mocker, temp_dir, clone_cache):
+    mocker.patch('gilt.git.is_pooled', return_value=True)
+    mocker.patch(
+        'gilt.git.is_complete', side_effect=lambda src: not src.endswith('c'))
+    patched_prune = mocker.patch('gilt.git.prune_pool')
+    pool = temp_dir.join('pool', 'p').strpath
+
+    assert 0 == shell._prune_pool('p', pool, temp_dir.join('p.lock').strpath)
+    assert not patched_prune.called
+
+
+def test_lock_pool_excludes_threads(temp_dir):
+    lock_file = temp_dir.join('p.lock').strpath
+    with shell._lock_pool(lock_file):
+        assert not shell._pool_locks[lock_file].acquire(False)
+    assert shell._pool_locks[lock_file].acquire(False)
+    shell._pool_locks[lock_file].release()
+
+
+def test_evict_clones_prunes_worktrees(mocker, clone_cache):
+    worktree_dir = clone_cache.join('a', shell.git.WORKTREE_DIR)
+    for name, used in [('old', 0), ('new', 10000 - shell.EVICT_GRACE + 1)]:
+        worktree_dir.ensure(name, 'README')
+        os.utime(worktree_dir.join(name).strpath, (used, used))
+
+    assert [] == shell._evict_clones(1 << 30)
+    assert ['new'] == os.listdir(worktree_dir.strpath)
+
+
+def test_maintain_repository(mocker, clone_cache):
+    patched_maintain = mocker.patch('gilt.git.maintain')
+    src = clone_cache.join('a').strpath
+    lock_file = shell.config._get_lock_file('a')
+
+    clone_cache.ensure('a', shell.git.WORKTREE_DIR, 'old', 'README')
+    os.utime(
+        clone_cache.join('a', shell.git.WORKTREE_DIR, 'old').strpath, (0, 0))
+
+    assert shell._maintain_repository('a', src, lock_file)
+    patched_maintain.assert_called_once_with(src, prune=True, debug=False)
+    assert [] == clone_cache.join('a', shell.git.WORKTREE_DIR).listdir()
+
+    assert shell._maintain_repository('a', src, lock_file, pool=True)
+    patched_maintain.assert_called_with(src, prune=False, debug=False)
+
+    patched_maintain.side_effect = RuntimeError('boom')
+    assert not shell._maintain_repository('a', src, lock_file)
+
+
+def test_unique():
+    assert ['b', 'a', 'c'] == shell._unique(['b', 'a', 'b', 'c', 'a'])
+
+
+def test_apply_defaults():
+    Config = collections.namedtuple('Config', ['name', 'depth', 'filter'])
+    configs = [Config('a', None, None), Config('b', 5, 'tree:0')]
+    result = shell._apply_defaults(configs, depth=1, filter='blob:none')
+
+    assert Config('a', 1, 'blob:none') == result[0]
+    assert Config('b', 5, 'tree:0') == result[1]
+
+
+@pytest.mark.parametrize(
+    'gilt_config_file', ['gilt_data'], indirect=['gilt_config_file'])
+def test_apply_defaults_updates_checksum(gilt_config_file):
+    configs = config.config(gilt_config_file)
+    result = shell._apply_defaults(configs, copy_strategy='hardlink')
+    unchanged = shell._apply_defaults(configs, copy_strategy=None)
+
+    assert configs[0].checksum != result[0].checksum
+    assert configs == unchanged
+
+
+@pytest.fixture()
+def state_config(mocker, temp_dir):
+    c = _config(mocker, 'a')
+    c.dst = temp_dir.mkdir('dst').strpath
+    c.state_file = temp_dir.join('state').strpath
+    c.checksum = 'checksum'
+
+    return c
+
+
+def test_overlay_config_writes_state(mocker, state_config):
+    patched_extract = mocker.patch('gilt.git.extract')
+    shell._overlay_config(state_config, 'abc')
+    state = shell.util.read_json(state_config.state_file)
+
+    patched_extract.assert_called_once_with(
+        state_config.src,
+        state_config.dst,
+        state_config.version,
+        commit='abc',
+        state_file=state_config.state_file,
+        strategy=state_config.copy_strategy,
+        subtree=state_config.path,
+        include=state_config.include,
+        exclude=state_config.exclude,
+        force=False,
+        debug=False)
+    assert 'checksum' == state['checksum']
+    assert 'abc' == state['commit']
+    assert [state_config.dst] == state['paths']
+    assert shell.util.fingerprint([state_config.dst]) == state['fingerprint']
+
+
+def test_overlay_config_skips_up_to_date(mocker, state_config):
+    patched_extract = mocker.patch('gilt.git.extract')
+    shell._overlay_config(state_config, 'abc')
+    shell._overlay_config(state_config, 'abc')
+
+    assert 1 == patched_extract.call_count
+
+
+def test_overlay_config_reruns_on_new_commit(mocker, state_config):
+    patched_extract = mocker.patch('gilt.git.extract')
+    shell._overlay_config(state_config, 'abc')
+    shell._overlay_config(state_config, 'def')
+
+    assert 2 == patched_extract.call_count
+
+
+def test_overlay_config_ignores_shared_paths(mocker, temp_dir, state_config):
+    patched_extract = mocker.patch('gilt.git.extract')
+    shared = [temp_dir.join('dst', 'library').strpath]
+    shell._overlay_config(state_config, 'abc', shared=shared)
+    temp_dir.ensure('dst', 'library', 'foo').write('foo')
+    shell._overlay_config(state_config, 'abc', shared=shared)
+
+    assert 1 == patched_extract.call_count
+
+
+def test_overlay_config_reruns_on_modified_destination(mocker, temp_dir,
+                                                       state_config):
+    patched_extract = mocker.patch('gilt.git.extract')
+    shell._overlay_config(state_config, 'abc')
+    temp_dir.join('dst', 'foo').write('foo')
+    shell._overlay_config(state_config, 'abc')
+
+    assert 2 == patched_extract.call_count
+    assert not patched_extract.call_args_list[0][1]['force']
+    assert patched_extract.call_args_list[1][1]['force']
+
+
+def test_overlay_config_files(mocker, state_config):
+    state_config.dst = None
+    patched_overlay = mocker.patch('gilt.git.overlay')
+    patched_overlay.return_value = ['/dst/foo']
+    shell._overlay_config(state_config, 'abc', copy_jobs=4)
+    state = shell.util.read_json(state_config.state_file)
+
+    assert ['/dst/foo'] == state['paths']
+    assert 4 == patched_overlay.call_args[1]['jobs']
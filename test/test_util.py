@@ -20,10 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import errno
 import os
 
 import pytest
-import sh
 
 from gilt import util
 
@@ -43,22 +43,82 @@ def test_print_warn(capsys):
 
 
 def test_run_command(capsys):
-    cmd = sh.git.bake(version=True)
-    util.run_command(cmd)
+    result = util.run_command(['git', '--version'])
 
-    result, _ = capsys.readouterr()
-    assert '' == result
+    assert 0 == result.exit_code
+    assert result.stdout.startswith('git version')
+    assert ['git', '--version'] == result.cmd
+    assert 0 <= result.duration
+    out, _ = capsys.readouterr()
+    assert '' == out
 
 
 def test_run_command_with_debug(temp_dir, capsys):
-    cmd = sh.git.bake(version=True)
-    util.run_command(cmd, debug=True)
+    util.run_command(['git', '--version'], debug=True)
 
     result, _ = capsys.readouterr()
-    x = 'COMMAND: {} --version'.format(sh.git)
-    assert x in result
+    assert 'COMMAND: git --version' in result
     x = 'PWD: {}'.format(temp_dir)
     assert x in result
+    assert 'EXIT: 0' in result
+
+
+def test_run_command_with_input_and_env(temp_dir):
+    data = 'x' * (1 << 20)
+    cmd = ['sh', '-c', 'wc -c; echo "$FOO" >&2']
+    result = util.run_command(cmd, input=data, env={'FOO': 'bar'})
+
+    assert str(len(data)) == result.stdout.strip()
+    assert 'bar\n' == result.stderr
+
+
+def test_run_command_streams_output():
+    chunks = []
+    result = util.run_command(['echo', 'foo'], output=chunks.append)
+
+    assert 'foo\n' == ''.join(chunks)
+    assert '' == result.stdout
+
+
+def test_split_records():
+    records = []
+    output = util.split_records(records.append, '\0')
+    for chunk in ['a\0b', 'c\0\0', 'd\0']:
+        output(chunk)
+
+    assert ['a', 'bc', 'd'] == records
+
+
+def test_run_command_keeps_tail_of_stderr(temp_dir):
+    cmd = [
+        'sh', '-c', 'head -c 100000 /dev/zero | tr "\\0" x >&2; echo end >&2'
+    ]
+    result = util.run_command(cmd)
+
+    assert util._STDERR_LIMIT == len(result.stderr)
+    assert result.stderr.endswith('xend\n')
+
+
+def test_run_command_raises_on_failure(temp_dir):
+    with pytest.raises(util.CommandError) as e:
+        util.run_command(['sh', '-c', 'echo oops >&2; exit 3'])
+
+    assert 3 == e.value.result.exit_code
+    assert 'exited 3: oops' in str(e.value)
+
+
+def test_run_command_times_out():
+    with pytest.raises(util.CommandTimeout) as e:
+        util.run_command(['sleep', '10'], timeout=0.1)
+
+    assert 1 > e.value.result.duration
+    assert e.value.result.exit_code
+
+
+def test_run_command_ignores_unread_input():
+    result = util.run_command(['true'], input='x' * (1 << 20))
+
+    assert 0 == result.exit_code
 
 
 def test_saved_cwd_contextmanager(temp_dir):
@@ -103,3 +163,299 @@ def test_copy_dir(temp_dir):
 def test_copy_raises(temp_dir):
     with pytest.raises(OSError):
         util.copy('invalid-src', 'invalid-dst')
+
+
+@pytest.mark.parametrize('strategy', util.COPY_STRATEGIES)
+def test_copy_dir_strategies(temp_dir, strategy):
+    src_dir = os.path.join(temp_dir.strpath, 'src')
+    os.makedirs(os.path.join(src_dir, 'bin'))
+    src = os.path.join(src_dir, 'bin', 'foo')
+    with open(src, 'w') as f:
+        f.write('foo')
+    os.chmod(src, 0755)
+    dst_dir = os.path.join(temp_dir.strpath, 'dst')
+    util.copy(src_dir, dst_dir, strategy)
+
+    dst = os.path.join(dst_dir, 'bin', 'foo')
+    assert 'foo' == open(dst).read()
+    assert os.access(dst, os.X_OK)
+
+
+def test_copy_file_falls_back_to_userspace(mocker, temp_dir):
+    for f in ['_reflink', '_copy_file_range', '_sendfile']:
+        mocker.patch('gilt.util.{}'.format(f), return_value=False)
+    src = os.path.join(temp_dir.strpath, 'foo')
+    with open(src, 'w') as f:
+        f.write('foo')
+    dst = os.path.join(temp_dir.strpath, 'bar')
+    util.copy_file(src, dst)
+
+    assert 'foo' == open(dst).read()
+
+
+def test_copy_file_copy_strategy_skips_kernel(mocker, temp_dir):
+    patched_reflink = mocker.patch('gilt.util._reflink')
+    src = os.path.join(temp_dir.strpath, 'foo')
+    open(src, 'w').close()
+    util.copy_file(src, os.path.join(temp_dir.strpath, 'bar'), 'copy')
+
+    assert not patched_reflink.called
+
+
+def test_copy_file_hardlink(temp_dir):
+    src = os.path.join(temp_dir.strpath, 'foo')
+    open(src, 'w').close()
+    dst = os.path.join(temp_dir.strpath, 'bar')
+    util.copy_file(src, dst, 'hardlink')
+
+    assert os.path.samefile(src, dst)
+
+
+def test_copy_file_hardlink_falls_back(mocker, temp_dir):
+    mocker.patch('os.link', side_effect=OSError(errno.EXDEV, 'cross-device'))
+    src = os.path.join(temp_dir.strpath, 'foo')
+    with open(src, 'w') as f:
+        f.write('foo')
+    dst = os.path.join(temp_dir.strpath, 'bar')
+    util.copy_file(src, dst, 'hardlink')
+
+    assert not os.path.samefile(src, dst)
+    assert 'foo' == open(dst).read()
+
+
+def test_copy_file_replaces_linked_destination(temp_dir):
+    src = os.path.join(temp_dir.strpath, 'foo')
+    with open(src, 'w') as f:
+        f.write('foo')
+    dst = os.path.join(temp_dir.strpath, 'bar')
+    util.copy_file(src, dst, 'hardlink')
+    other = os.path.join(temp_dir.strpath, 'baz')
+    with open(other, 'w') as f:
+        f.write('baz')
+    util.copy_file(other, dst)
+
+    assert 'foo' == open(src).read()
+    assert 'baz' == open(dst).read()
+
+
+def test_kernel_copy_unsupported(mocker):
+    mocker.patch('ctypes.get_errno', return_value=errno.ENOSYS)
+
+    assert not util._kernel_copy(lambda: -1)
+
+
+def test_kernel_copy_raises_after_partial_copy(mocker):
+    mocker.patch('ctypes.get_errno', return_value=errno.EXDEV)
+    results = iter([10, -1])
+
+    with pytest.raises(OSError):
+        util._kernel_copy(lambda: next(results))
+
+
+@pytest.fixture()
+def glob_tree(temp_dir):
+    root = temp_dir.strpath
+    for path in [
+            'a/b/c.yml', 'a/b/d.py', 'a/e.yml', 'a/.hidden/f.yml', 'g.yml',
+            'x/tests/h.yml', 'x/i.yml'
+    ]:
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    return root
+
+
+def _iglob(root, pattern, exclude=()):
+    return [
+        os.path.relpath(p, root) for p in util.iglob(root, pattern, exclude)
+    ]
+
+
+def test_is_glob():
+    assert util.is_glob('*_manage')
+    assert util.is_glob('foo?')
+    assert util.is_glob('[ab]')
+    assert not util.is_glob('roles/foo')
+
+
+def test_iglob(glob_tree):
+    assert ['a/e.yml', 'x/i.yml'] == _iglob(glob_tree, '*/*.yml')
+    assert ['a/e.yml'] == _iglob(glob_tree, 'a/*.yml')
+    assert ['a', 'x'] == _iglob(glob_tree, '[a-x]')
+    assert ['a/b/d.py'] == _iglob(glob_tree, 'a/?/d.py')
+    assert [] == _iglob(glob_tree, 'missing/*')
+
+
+def test_iglob_with_listdir():
+    tree = {
+        '': [('a', True), ('b.yml', False)],
+        'a': [('.c.yml', False), ('d.yml', False)],
+    }
+    result = util.iglob('', '**/*.yml', listdir=lambda d: tree.get(d, []))
+
+    assert ['a/d.yml', 'b.yml'] == sorted(result)
+
+
+def test_iglob_recursive(glob_tree):
+    x = ['a/b/c.yml', 'a/e.yml', 'g.yml', 'x/i.yml', 'x/tests/h.yml']
+    assert x == sorted(_iglob(glob_tree, '**/*.yml'))
+    x = ['a/b', 'a/b/c.yml', 'a/b/d.py', 'a/e.yml']
+    assert x == _iglob(glob_tree, 'a/**')
+    assert ['a/b/c.yml'] == _iglob(glob_tree, 'a/**/c.yml')
+
+
+def test_iglob_exclude(glob_tree):
+    x = ['a/b/c.yml', 'a/e.yml', 'g.yml', 'x/i.yml']
+    assert x == sorted(_iglob(glob_tree, '**/*.yml', ['**/tests']))
+    assert ['g.yml'] == _iglob(glob_tree, '**/*.yml', ['a', 'x/*'])
+
+
+def test_iglob_prunes_directories(mocker, glob_tree):
+    spy = mocker.spy(util, '_list_dir')
+    _iglob(glob_tree, 'a/b/*.yml')
+
+    assert [os.path.join(glob_tree, 'a/b')] == [
+        c[0][0] for c in spy.call_args_list
+    ]
+
+
+def test_list_dir_without_scandir(mocker, glob_tree):
+    mocker.patch('gilt.util._scandir', None)
+    os.symlink('a', os.path.join(glob_tree, 'link'))
+    spy = mocker.spy(os, 'lstat')
+    result = util._list_dir(glob_tree)
+
+    assert [('a', True), ('g.yml', False), ('link', False),
+            ('x', True)] == result
+    assert 4 == spy.call_count
+
+
+def test_get_pattern_matcher():
+    matcher = util.get_pattern_matcher(['docs', '**/tests', '*.pyc'])
+
+    assert matcher('docs')
+    assert matcher('docs/index.rst')
+    assert matcher('roles/foo/tests/test.yml')
+    assert matcher('foo.pyc')
+    assert not matcher('roles/docs')
+    assert not matcher('roles/foo.pyc')
+
+
+def test_copy_ignore(glob_tree, temp_dir):
+    dst = os.path.join(temp_dir.strpath, 'dst')
+    util.copy(
+        os.path.join(glob_tree, 'a'),
+        dst,
+        ignore=lambda path: path.endswith('.yml'))
+
+    assert ['b', '.hidden'] == sorted(os.listdir(dst), reverse=True)
+    assert ['d.py'] == os.listdir(os.path.join(dst, 'b'))
+
+
+def test_print_error(capsys):
+    util.print_error('foo')
+
+    result, _ = capsys.readouterr()
+    assert 'foo' in result
+
+
+def test_buffered_output(capsys):
+    with util.buffered_output():
+        util.print_info('foo')
+        util.print_warn('bar')
+
+        result, _ = capsys.readouterr()
+        assert '' == result
+
+    result, _ = capsys.readouterr()
+    assert 'foo\n' in result
+    assert 'bar' in result
+    assert result.index('foo') < result.index('bar')
+
+
+def test_buffered_output_flushes_on_error(capsys):
+    with pytest.raises(RuntimeError):
+        with util.buffered_output():
+            util.print_info('foo')
+            raise RuntimeError()
+
+    result, _ = capsys.readouterr()
+    assert 'foo\n' == result
+
+
+def test_write_json(temp_dir):
+    filename = os.path.join(temp_dir.strpath, 'foo.json')
+    util.write_json(filename, {'foo': 'bar'})
+
+    assert {'foo': 'bar'} == util.read_json(filename)
+    assert ['foo.json'] == os.listdir(temp_dir.strpath)
+
+
+def test_write_json_indent(temp_dir):
+    filename = os.path.join(temp_dir.strpath, 'foo.json')
+    util.write_json(filename, {'foo': {'baz': 1, 'bar': 2}}, indent=2)
+
+    with open(filename) as f:
+        x = '{\n  "foo": {\n    "bar": 2,\n    "baz": 1\n  }\n}\n'
+        assert x == f.read()
+
+
+def test_read_json_handles_missing_file(temp_dir):
+    assert util.read_json(os.path.join(temp_dir.strpath, 'foo')) is None
+
+
+def test_get_disk_usage(temp_dir):
+    temp_dir.ensure('dir', 'foo').write('x' * (1 << 20))
+    temp_dir.ensure('bar').write('bar')
+    os.symlink(temp_dir.join('dir').strpath, temp_dir.join('link').strpath)
+    dir_usage = util.get_disk_usage(temp_dir.join('dir').strpath)
+
+    assert 1 << 20 <= dir_usage
+    assert dir_usage < util.get_disk_usage(temp_dir.strpath) < 2 * dir_usage
+
+
+def test_get_disk_usage_handles_missing_path(temp_dir):
+    assert 0 == util.get_disk_usage(temp_dir.join('foo').strpath)
+
+
+def test_fingerprint(temp_dir):
+    temp_dir.ensure('dir', 'foo').write('foo')
+    temp_dir.ensure('bar').write('bar')
+    paths = [temp_dir.join('dir').strpath, temp_dir.join('bar').strpath]
+    result = util.fingerprint(paths)
+
+    assert result == util.fingerprint(paths)
+
+    temp_dir.ensure('dir', 'baz')
+    assert result != util.fingerprint(paths)
+
+
+def test_fingerprint_detects_modification(temp_dir):
+    f = temp_dir.ensure('dir', 'foo')
+    f.write('foo')
+    paths = [temp_dir.join('dir').strpath]
+    result = util.fingerprint(paths)
+    f.write('foobar')
+
+    assert result != util.fingerprint(paths)
+
+
+def test_fingerprint_excludes_paths(temp_dir):
+    temp_dir.ensure('dir', 'foo').write('foo')
+    paths = [temp_dir.join('dir').strpath]
+    exclude = [temp_dir.join('dir', 'sub').strpath]
+    result = util.fingerprint(paths, exclude)
+    temp_dir.ensure('dir', 'sub', 'bar').write('bar')
+
+    assert result == util.fingerprint(paths, exclude)
+    assert result != util.fingerprint(paths)
+
+
+def test_fingerprint_handles_missing_path(temp_dir):
+    path = temp_dir.join('missing').strpath
+    result = util.fingerprint([path])
+
+    temp_dir.ensure('missing')
+    assert result != util.fingerprint([path])